@@ -159,6 +159,10 @@ class Londiste(skytools.DBScript):
                 help="repair: apply fixes automatically")
         g.add_option("--count-only", action="store_true",
                 help="compare: just count rows, do not compare data")
+        g.add_option("--ranges", action="store_true",
+                help="compare: find mismatching pkey ranges")
+        g.add_option("--range-file", metavar = "FILE",
+                help="repair: check only ranges from compare --ranges")
         p.add_option_group(g)
 
         return p
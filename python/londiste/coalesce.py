@@ -0,0 +1,165 @@
+"""Per-batch coalescing of urlenc row events.
+
+Chain of I/U/D events on single row is collapsed into net change,
+which is applied in order of first change of each row.  Changes of
+different rows are thus reordered, so coalescing can be used only
+on tables without foreign keys (referencing or referenced) and
+without unique constraints besides primary key - same as with
+bulk handler.  Pending rows are applied before any non-row event.
+
+Tests:
+
+>>> def mkev(typ, data, tbl = 'public.tbl'):
+...     return Event('q', {'ev_type': typ, 'ev_data': data, 'ev_extra1': tbl})
+>>> def show(res):
+...     for h, ev, row in res:
+...         print h, ev.ev_extra1, ev.ev_type, ev.ev_data, row['v']
+>>> def add(c, ev, h = 'h'):
+...     return c.add(ev, skytools.db_urldecode(ev.data), h)
+>>> c = RowCoalescer('q')
+>>> c.can_coalesce(mkev('I', 'insert into tbl ...'))
+False
+>>> c.can_coalesce(mkev('I:', 'id=1&v=a'))
+False
+>>> for typ, data in [('I:id', 'id=1&v=a'), ('U:id', 'id=1&v=b'), ('U:id', 'id=1&v=c'),
+...                   ('U:id', 'id=2&v=x'), ('D:id', 'id=2&v=x'), ('I:id', 'id=2&v=y'),
+...                   ('I:id', 'id=3&v=z'), ('D:id', 'id=3&v=z')]:
+...     add(c, mkev(typ, data))
+False
+True
+True
+False
+True
+True
+False
+True
+>>> show(c.flush())
+h public.tbl I:id id=1&v=c c
+h public.tbl D:id id=2&v=y y
+h public.tbl I:id id=2&v=y y
+>>> len(c)
+0
+
+Interleaved updates of several rows are coalesced too:
+
+>>> merged = 0
+>>> for i in range(30):
+...     for id in (1, 2, 3):
+...         merged += add(c, mkev('U:id', 'id=%d&v=%d' % (id, i)))
+>>> merged
+87
+>>> show(c.flush())
+h public.tbl U:id id=1&v=29 29
+h public.tbl U:id id=2&v=29 29
+h public.tbl U:id id=3&v=29 29
+
+Same pkey in different tables is different row:
+
+>>> add(c, mkev('I:id', 'id=1&v=a', 'public.a'), 'a')
+False
+>>> add(c, mkev('I:id', 'id=1&v=b', 'public.b'), 'b')
+False
+>>> show(c.flush())
+a public.a I:id id=1&v=a a
+b public.b I:id id=1&v=b b
+"""
+
+import skytools
+
+from pgq.event import Event
+
+__all__ = ['RowCoalescer']
+
+class CoalescedRow(object):
+    """Collapses I/U/D chain on single pkey to net change.
+
+    Only first and last operation matter, plus whether
+    row was deleted in between.
+    """
+    __slots__ = ('first_op', 'last_op', 'deleted', 'last_ev', 'last_row', 'handler', 'seq')
+
+    def __init__(self, op, ev, row, handler, seq):
+        self.first_op = op
+        self.last_op = op
+        self.deleted = (op == 'D')
+        self.last_ev = ev
+        self.last_row = row
+        self.handler = handler
+        self.seq = seq
+
+    def add(self, op, ev, row):
+        self.last_op = op
+        if op == 'D':
+            self.deleted = True
+        self.last_ev = ev
+        self.last_row = row
+
+    def get_net_events(self, queue_name):
+        """Return list of events that give same end result."""
+        if self.first_op == 'I':
+            # row did not exist before
+            if self.last_op == 'D':
+                return []
+            ops = ['I']
+        elif self.last_op == 'D':
+            ops = ['D']
+        elif self.deleted:
+            # keep delete+insert, row may differ from update target
+            ops = ['D', 'I']
+        else:
+            ops = ['U']
+
+        ev = self.last_ev
+        if len(ops) == 1 and ops[0] == ev.type[0]:
+            return [ev]
+        res = []
+        for op in ops:
+            row = dict(ev.items())
+            row['ev_type'] = op + ev.type[1:]
+            res.append(Event(queue_name, row))
+        return res
+
+class RowCoalescer(object):
+    """Keeps net change per (table, pkey) for pending row events."""
+
+    def __init__(self, queue_name):
+        self.queue_name = queue_name
+        self.row_map = {}
+        self.seq = 0
+
+    def __len__(self):
+        return len(self.row_map)
+
+    def can_coalesce(self, ev):
+        """Only urlenc events with pkey info can be coalesced."""
+        return len(ev.type) > 2 and ev.type[1] == ':'
+
+    def add(self, ev, row, handler):
+        """Remember event with its decoded row.
+
+        Returns True if it was merged with pending row.
+        """
+        self.seq += 1
+        op = ev.type[0]
+        key = (ev.extra1, tuple([row.get(k) for k in ev.type[2:].split(',')]))
+        crow = self.row_map.get(key)
+        if crow is None:
+            self.row_map[key] = CoalescedRow(op, ev, row, handler, self.seq)
+            return False
+        crow.add(op, ev, row)
+        return True
+
+    def flush(self):
+        """Return (handler, event, row) list of net changes, in order of first change."""
+        rows = self.row_map.values()
+        self.row_map = {}
+        rows.sort(key = lambda r: r.seq)
+        res = []
+        for crow in rows:
+            for ev in crow.get_net_events(self.queue_name):
+                res.append((crow.handler, ev, crow.last_row))
+        return res
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -2,10 +2,12 @@
 
 """Compares tables in replication set.
 
-Currently just does count(1) on both sides.
+By default does count(1) and checksum over whole table on both sides.
+With --ranges, finds mismatching pkey ranges by comparing checksums
+of ranges and subdividing mismatching ones.
 """
 
-import sys, skytools
+import sys, os, threading, skytools
 
 __all__ = ['Comparator']
 
@@ -18,6 +20,9 @@ class Comparator(Syncer):
     def process_sync(self, t1, t2, src_db, dst_db):
         """Actual comparison."""
 
+        if self.options.ranges:
+            return self.compare_ranges(t1, t2, src_db, dst_db)
+
         src_tbl = t1.dest_table
         dst_tbl = t2.dest_table
 
@@ -80,6 +85,311 @@ class Comparator(Syncer):
             return 1
         return 0
 
+    def compare_ranges(self, t1, t2, src_db, dst_db):
+        """Compare table by pkey ranges, Merkle-tree style.
+
+        Each level hashes ranges on both sides in parallel, only
+        mismatching ranges are split further.  Divergent ranges are
+        written into <table>.ranges, one SQL condition per line,
+        which can be given to repair --range-file.  Progress is kept
+        in <table>.ranges.state, so interrupted compare continues
+        from last finished level.
+
+        Single integer pkey is split arithmetically, other pkeys
+        on their own ordering.  Only on 8.1 and older, which lack
+        row-wise comparison, is hash of pkey used as split key -
+        then each level needs full table scan.
+        """
+        src_tbl = t1.dest_table
+        dst_tbl = t2.dest_table
+
+        src_curs = src_db.cursor()
+        dst_curs = dst_db.cursor()
+
+        where = t2.plugin.get_copy_condition(src_curs, dst_curs)
+        cols = self.calc_cols(src_curs, src_tbl, dst_curs, dst_tbl)
+        hash_expr = "sum(('x'||substr(md5(%s::text),1,16))::bit(64)::bigint)" % cols
+        fanout = self.cf.getint('compare_fanout', 16)
+        min_rows = self.cf.getint('compare_min_rows', 1000)
+
+        pkeys = skytools.get_table_pkeys(src_curs, src_tbl)
+        if not pkeys:
+            self.log.error("%s: table has no pkey, cannot compare ranges", dst_tbl)
+            return 1
+        qkeys = [skytools.quote_ident(k) for k in pkeys]
+        key_expr = self.get_range_key(src_curs, src_tbl, pkeys)
+        if key_expr is None:
+            if src_db.server_version >= 80200 and dst_db.server_version >= 80200:
+                key_expr = "order:" + ",".join(qkeys)
+            else:
+                key_expr = "('x'||substr(md5((%s)::text),1,7))::bit(28)::int4" % ",".join(qkeys)
+
+        result_fn = dst_tbl + ".ranges"
+        state_fn = result_fn + ".state"
+        state = None
+        if os.path.isfile(state_fn):
+            state = skytools.json_decode(open(state_fn).read())
+            if state['key'] != key_expr:
+                state = None
+            else:
+                self.log.info("%s: continuing from %s", dst_tbl, state_fn)
+
+        args = (src_curs, dst_curs, src_tbl, dst_tbl, hash_expr, where, fanout, min_rows, state_fn)
+        if key_expr.startswith("order:"):
+            found = self.compare_key_ranges(qkeys, state, *args)
+        else:
+            found = self.compare_int_ranges(key_expr, state, *args)
+
+        src_db.commit()
+        dst_db.commit()
+        if found is None:
+            self.log.info("%s: both tables empty", dst_tbl)
+            return 0
+
+        # write result
+        lines = [cond + "\n" for cond in found]
+        skytools.write_atomic(result_fn, "".join(lines))
+        if os.path.isfile(state_fn):
+            os.remove(state_fn)
+
+        if found:
+            self.log.warning("%s: %d ranges do not match, see %s",
+                             dst_tbl, len(found), result_fn)
+            return 1
+        self.log.info("%s: all ranges match", dst_tbl)
+        return 0
+
+    def compare_int_ranges(self, key_expr, state, src_curs, dst_curs, src_tbl, dst_tbl,
+                           hash_expr, where, fanout, min_rows, state_fn):
+        """Find mismatching ranges of integer key expression.
+
+        Returns list of range conditions, None if both tables are empty.
+        """
+        if not state:
+            kmin, kmax = self.get_key_limits(src_curs, dst_curs, src_tbl, dst_tbl, key_expr)
+            if kmin is None:
+                return None
+            # top-level width is power of fanout, so sub-ranges align
+            width = 1
+            while (kmax - kmin + 1) / width > 1024:
+                width *= fanout
+            state = {'key': key_expr, 'base': kmin, 'width': width,
+                     'pending': None, 'found': []}
+
+        while 1:
+            self.log.info("%s: checking %s ranges of width %d", dst_tbl,
+                          state['pending'] is None and 'all' or len(state['pending']),
+                          state['width'])
+            bad = self.compare_level(src_curs, dst_curs, src_tbl, dst_tbl,
+                                     key_expr, hash_expr, where, state)
+            width = state['width']
+            state['pending'] = []
+            for b, cnt in bad:
+                lo = state['base'] + b * width
+                if width <= 1 or cnt <= min_rows:
+                    state['found'].append([lo, lo + width])
+                else:
+                    state['pending'].append([lo, lo + width])
+            if not state['pending']:
+                break
+            state['width'] = max(width / fanout, 1)
+            skytools.write_atomic(state_fn, skytools.json_encode(state))
+
+        return [self.range_cond(key_expr, lo, hi) for lo, hi in state['found']]
+
+    def compare_key_ranges(self, qkeys, state, src_curs, dst_curs, src_tbl, dst_tbl,
+                           hash_expr, where, fanout, min_rows, state_fn):
+        """Find mismatching ranges of pkey, split on pkey ordering.
+
+        Boundaries of sub-ranges are sampled with ORDER BY pkey
+        from the side that has more rows in range, ranges are row-wise
+        comparisons, so both sampling and hashing use pkey index.
+        Range bounds are kept as lists of key values in text form,
+        None means unbounded.
+
+        Returns list of range conditions, None if both tables are empty.
+        """
+        if not state:
+            q = "select count(1) from only %%s where %s" % (where or 'true')
+            res = self.run_both(src_curs, q % skytools.quote_fqident(src_tbl),
+                                dst_curs, q % skytools.quote_fqident(dst_tbl))
+            scnt, dcnt = res[0][0][0], res[1][0][0]
+            if not scnt and not dcnt:
+                return None
+            state = {'key': "order:" + ",".join(qkeys),
+                     'pending': [[None, None, scnt, dcnt]], 'found': []}
+
+        while state['pending']:
+            self.log.info("%s: checking %d key ranges", dst_tbl, len(state['pending']))
+            sub_list = []
+            for lo, hi, scnt, dcnt in state['pending']:
+                if scnt >= dcnt:
+                    curs, tbl = src_curs, src_tbl
+                else:
+                    curs, tbl = dst_curs, dst_tbl
+                step = max(max(scnt, dcnt) / fanout, 1)
+                bounds = self.sample_key_bounds(curs, tbl, qkeys, where, lo, hi, step, fanout)
+                if not bounds:
+                    # single key in range
+                    state['found'].append([lo, hi])
+                    continue
+                bounds = [lo] + bounds + [hi]
+                for i in range(len(bounds) - 1):
+                    sub_list.append([bounds[i], bounds[i + 1]])
+
+            res = self.hash_key_ranges(src_curs, dst_curs, src_tbl, dst_tbl,
+                                       qkeys, hash_expr, where, sub_list)
+            state['pending'] = []
+            for (lo, hi), (s, d) in zip(sub_list, res):
+                if s == d:
+                    continue
+                if max(s[0], d[0]) <= min_rows:
+                    state['found'].append([lo, hi])
+                else:
+                    state['pending'].append([lo, hi, s[0], d[0]])
+            if state['pending']:
+                skytools.write_atomic(state_fn, skytools.json_encode(state))
+
+        return [self.key_range_cond(qkeys, lo, hi) for lo, hi in state['found']]
+
+    def key_range_cond(self, qkeys, lo, hi):
+        """Row-wise range condition, lo inclusive, hi exclusive."""
+        klist = "(%s)" % ",".join(qkeys)
+        cond = []
+        if lo is not None:
+            cond.append("%s >= (%s)" % (klist, ",".join([skytools.quote_literal(v) for v in lo])))
+        if hi is not None:
+            cond.append("%s < (%s)" % (klist, ",".join([skytools.quote_literal(v) for v in hi])))
+        return " and ".join(cond) or "true"
+
+    def sample_key_bounds(self, curs, tbl, qkeys, where, lo, hi, step, fanout):
+        """Return up to fanout-1 keys inside range, step rows apart."""
+        cols = ",".join(["%s::text" % k for k in qkeys])
+        bounds = []
+        cur = lo
+        while len(bounds) < fanout - 1:
+            cond = self.key_range_cond(qkeys, cur, hi)
+            if where:
+                cond = "%s and %s" % (cond, where)
+            q = "select %s from only %s where %s order by %s offset %d limit 1" % (
+                    cols, skytools.quote_fqident(tbl), cond, ",".join(qkeys), step)
+            self.log.debug("%s", q)
+            curs.execute(q)
+            row = curs.fetchone()
+            if not row:
+                break
+            cur = list(row)
+            bounds.append(cur)
+        return bounds
+
+    def hash_key_ranges(self, src_curs, dst_curs, src_tbl, dst_tbl,
+                        qkeys, hash_expr, where, sub_list):
+        """Hash key ranges on both sides.
+
+        Returns list of ((src_cnt, src_chksum), (dst_cnt, dst_chksum)).
+        """
+        res = []
+        for i in range(0, len(sub_list), 100):
+            qlist = []
+            for n, (lo, hi) in enumerate(sub_list[i:i+100]):
+                cond = self.key_range_cond(qkeys, lo, hi)
+                if where:
+                    cond = "%s and %s" % (cond, where)
+                qlist.append("select %d as b, count(1) as cnt, %s as chksum from only _TABLE_ where %s" % (
+                             n, hash_expr, cond))
+            q = " union all ".join(qlist) + " order by 1"
+            both = self.run_both(src_curs, q.replace('_TABLE_', skytools.quote_fqident(src_tbl)),
+                                 dst_curs, q.replace('_TABLE_', skytools.quote_fqident(dst_tbl)))
+            for s, d in zip(both[0], both[1]):
+                res.append(((s[1], s[2]), (d[1], d[2])))
+        return res
+
+    def get_range_key(self, curs, tbl, pkeys):
+        """Return integer pkey to split table on, None if pkey is not integer."""
+        if len(pkeys) == 1:
+            q = "select t.typname from pg_catalog.pg_attribute a, pg_catalog.pg_type t"\
+                " where a.attrelid = %s::regclass and a.attname = %s and t.oid = a.atttypid"
+            curs.execute(q, [skytools.quote_fqident(tbl), pkeys[0]])
+            if curs.fetchone()[0] in ('int2', 'int4', 'int8'):
+                return skytools.quote_ident(pkeys[0])
+        return None
+
+    def get_key_limits(self, src_curs, dst_curs, src_tbl, dst_tbl, key_expr):
+        """Return key range covering both tables."""
+        q = "select min(%s), max(%s) from only %%s" % (key_expr, key_expr)
+        res = self.run_both(src_curs, q % skytools.quote_fqident(src_tbl),
+                            dst_curs, q % skytools.quote_fqident(dst_tbl))
+        vals = [v for v in (res[0][0][0], res[0][0][1], res[1][0][0], res[1][0][1]) if v is not None]
+        if not vals:
+            return None, None
+        return min(vals), max(vals)
+
+    def range_cond(self, key_expr, lo, hi):
+        return "%s >= %d and %s < %d" % (key_expr, lo, key_expr, hi)
+
+    def compare_level(self, src_curs, dst_curs, src_tbl, dst_tbl,
+                      key_expr, hash_expr, where, state):
+        """Hash sub-ranges of pending ranges on both sides.
+
+        Returns list of (bucket, rowcount) for mismatching buckets.
+        """
+        bexpr = "(%s - %d) / %d" % (key_expr, state['base'], state['width'])
+        q = "select %s as b, count(1) as cnt, %s as chksum from only %%s where %s group by 1" % (
+                bexpr, hash_expr, where or 'true')
+
+        # range conditions for index scan, in groups
+        cond_list = [None]
+        if state['pending'] is not None:
+            cond_list = []
+            for i in range(0, len(state['pending']), 100):
+                rlist = [self.range_cond(key_expr, lo, hi) for lo, hi in state['pending'][i:i+100]]
+                cond_list.append("(%s)" % " or ".join(rlist))
+
+        src_map = {}
+        dst_map = {}
+        for cond in cond_list:
+            xq = q
+            if cond:
+                xq = xq.replace(" group by", " and %s group by" % cond)
+            res = self.run_both(src_curs, xq % skytools.quote_fqident(src_tbl),
+                                dst_curs, xq % skytools.quote_fqident(dst_tbl))
+            for row in res[0]:
+                src_map[row[0]] = (row[1], row[2])
+            for row in res[1]:
+                dst_map[row[0]] = (row[1], row[2])
+
+        bad = []
+        for b in src_map.keys() + [b for b in dst_map if b not in src_map]:
+            s = src_map.get(b, (0, None))
+            d = dst_map.get(b, (0, None))
+            if s != d:
+                bad.append((b, max(s[0], d[0])))
+        bad.sort()
+        return bad
+
+    def run_both(self, src_curs, src_q, dst_curs, dst_q):
+        """Run queries on both sides in parallel, return both results."""
+        res = [None, None]
+        err = []
+        def run_dst():
+            try:
+                self.log.debug("dstdb: %s", dst_q)
+                dst_curs.execute(dst_q)
+                res[1] = dst_curs.fetchall()
+            except:
+                err.append(sys.exc_info())
+        th = threading.Thread(target = run_dst)
+        th.start()
+        try:
+            self.log.debug("srcdb: %s", src_q)
+            src_curs.execute(src_q)
+            res[0] = src_curs.fetchall()
+        finally:
+            th.join()
+        if err:
+            raise err[0][0], err[0][1], err[0][2]
+        return res
+
     def calc_cols(self, src_curs, src_tbl, dst_curs, dst_tbl):
         cols1 = self.load_cols(src_curs, src_tbl)
         cols2 = self.load_cols(dst_curs, dst_tbl)
@@ -119,6 +429,7 @@ class Comparator(Syncer):
         """Initialize cmdline switches."""
         p = super(Comparator, self).init_optparse(p)
         p.add_option("--count-only", action="store_true", help="just count rows, do not compare data")
+        p.add_option("--ranges", action="store_true", help="find mismatching pkey ranges")
         return p
 
 if __name__ == '__main__':
@@ -31,6 +31,7 @@ plain londiste:
 
 import sys
 import logging
+import hashlib
 import skytools
 import londiste.handlers
 
@@ -71,6 +72,14 @@ class BaseHandler:
     handler_name = 'nop'
     log = logging.getLogger('basehandler')
 
+    # real_copy() accepts range_cond, so table can be
+    # copied in parallel by key ranges
+    range_copy = True
+
+    # run source and destination COPY concurrently,
+    # set from copy_relay config option
+    copy_relay = True
+
     def __init__(self, table_name, args, dest_table):
         self.table_name = table_name
         self.dest_table = dest_table or table_name
@@ -157,19 +166,36 @@ class BaseHandler:
         """ Use if you want to filter data """
         return ''
 
-    def real_copy(self, src_tablename, src_curs, dst_curs, column_list):
+    def get_range_copy_condition(self, src_curs, dst_curs, range_cond):
+        """Copy condition, combined with range condition of parallel copy."""
+        cond = self.get_copy_condition(src_curs, dst_curs)
+        if not range_cond:
+            return cond
+        if not cond:
+            return range_cond
+        return "(%s) and (%s)" % (cond, range_cond)
+
+    def real_copy(self, src_tablename, src_curs, dst_curs, column_list, range_cond = None):
         """do actual table copy and return tuple with number of bytes and rows
         copied
         """
-        condition = self.get_copy_condition(src_curs, dst_curs)
+        condition = self.get_range_copy_condition(src_curs, dst_curs, range_cond)
         return skytools.full_copy(src_tablename, src_curs, dst_curs,
                                   column_list, condition,
-                                  dst_tablename = self.dest_table)
+                                  dst_tablename = self.dest_table,
+                                  relay = self.copy_relay)
 
     def needs_table(self):
         """Does the handler need the table to exist on destination."""
         return True
 
+    def remove_table(self, dst_curs):
+        """Called when table is removed from local node.
+
+        Handler can drop its helper objects there.
+        """
+        pass
+
 class TableHandler(BaseHandler):
     """Default Londiste handler, inserts events into tables with plain SQL.
 
@@ -177,6 +203,11 @@ class TableHandler(BaseHandler):
       encoding=ENC - Validate and fix incoming data from encoding.
                      Only 'utf8' is supported at the moment.
       ignore_truncate=BOOL - Ignore truncate event. Default: 0; Values: 0,1.
+      prepared=BOOL - Apply row events via prepared statements. Default: 0; Values: 0,1.
+      coalesce=BOOL - Apply only net change per pkey in batch. Changes of
+                      different rows get reordered, so table must not have
+                      foreign keys or unique constraints besides pkey.
+                      Default: 0; Values: 0,1.
     """
     handler_name = 'londiste'
 
@@ -188,6 +219,10 @@ class TableHandler(BaseHandler):
 
     allow_sql_event = 1
 
+    # row already decoded by caller, see set_parsed_row()
+    _parsed_ev = None
+    _parsed_row = None
+
     def __init__(self, table_name, args, dest_table):
         BaseHandler.__init__(self, table_name, args, dest_table)
 
@@ -197,9 +232,15 @@ class TableHandler(BaseHandler):
         else:
             self.encoding_validator = None
 
+        # (op, columns, pkeys) -> (statement name, argument columns)
+        self._prepared = {}
+        self._prepared_conn = None
+
     def get_config (self):
         conf = BaseHandler.get_config(self)
         conf.ignore_truncate = self.get_arg('ignore_truncate', [0, 1], 0)
+        conf.prepared = self.get_arg('prepared', [0, 1], 0)
+        conf.coalesce = self.get_arg('coalesce', [0, 1], 0)
         return conf
 
     def process_event(self, ev, sql_queue_func, arg):
@@ -214,7 +255,9 @@ class TableHandler(BaseHandler):
             pklist = ev.type[2:].split(',')
             op = ev.type[0]
             tbl = self.dest_table
-            if op == 'I':
+            if self.conf.prepared:
+                sql = self.mk_execute_sql(op, row, pklist, arg)
+            elif op == 'I':
                 sql = skytools.mk_insert_sql(row, tbl, pklist)
             elif op == 'U':
                 sql = skytools.mk_update_sql(row, tbl, pklist)
@@ -223,12 +266,77 @@ class TableHandler(BaseHandler):
 
         sql_queue_func(sql, arg)
 
+    def mk_execute_sql(self, op, row, pklist, curs):
+        """Generate EXECUTE statement for urlenc event.
+
+        Statement is prepared on first use for each (op, column set)
+        combination, so server does not need to parse and plan
+        every row separately.  Ordering with other queued SQL
+        is kept, as EXECUTE goes to same queue.
+        """
+
+        # prepared statements are per-connection
+        if curs.connection is not self._prepared_conn:
+            self._prepared = {}
+            self._prepared_conn = curs.connection
+
+        if op == 'D':
+            key = (op, None, tuple(pklist))
+        else:
+            key = (op, tuple(sorted(row.keys())), tuple(pklist))
+        try:
+            name, arg_cols = self._prepared[key]
+        except KeyError:
+            name, arg_cols = self._prepare_stmt(op, key[1], pklist, curs)
+            self._prepared[key] = (name, arg_cols)
+
+        vals = [skytools.quote_literal(row[c]) for c in arg_cols]
+        return "execute %s (%s);" % (name, ", ".join(vals))
+
+    def _prepare_stmt(self, op, cols, pklist, curs):
+        """Prepare statement on connection, returns name and argument columns."""
+
+        qtbl = skytools.quote_fqident(self.dest_table)
+        pkwhere = []
+        for i, c in enumerate(pklist):
+            pkwhere.append("%s = $%d" % (skytools.quote_ident(c), i + 1))
+        if op == 'I':
+            arg_cols = list(cols)
+            qcols = [skytools.quote_ident(c) for c in arg_cols]
+            params = ["$%d" % (i + 1) for i in range(len(arg_cols))]
+            sql = "insert into %s (%s) values (%s)" % (qtbl, ", ".join(qcols), ", ".join(params))
+        elif op == 'U':
+            set_cols = [c for c in cols if c not in pklist]
+            setlist = []
+            for i, c in enumerate(set_cols):
+                setlist.append("%s = $%d" % (skytools.quote_ident(c), len(pklist) + i + 1))
+            arg_cols = list(pklist) + set_cols
+            sql = "update only %s set %s where %s" % (qtbl, ", ".join(setlist), " and ".join(pkwhere))
+        elif op == 'D':
+            arg_cols = list(pklist)
+            sql = "delete from only %s where %s" % (qtbl, " and ".join(pkwhere))
+        else:
+            raise Exception('Unknown row op: %s' % op)
+
+        # name depends on statement, so existing one can be reused
+        name = "londiste_" + hashlib.md5(sql).hexdigest()[:16]
+        q = "select 1 from pg_catalog.pg_prepared_statements where name = %s"
+        curs.execute(q, [name])
+        if not curs.fetchall():
+            self.log.debug("%s: prepare %s as %s", self.table_name, name, sql)
+            curs.execute("prepare %s as %s" % (name, sql))
+        return name, arg_cols
+
     def parse_row_data(self, ev):
         """Extract row data from event, with optional encoding fixes.
 
         Returns either string (sql event) or dict (urlenc event).
         """
 
+        if ev is self._parsed_ev:
+            row = self._parsed_row
+            self._parsed_ev = self._parsed_row = None
+            return row
         if len(ev.type) == 1:
             if not self.allow_sql_event:
                 raise Exception('SQL events not supported by this handler')
@@ -241,7 +349,12 @@ class TableHandler(BaseHandler):
                 return self.encoding_validator.validate_dict(row, self.table_name)
             return row
 
-    def real_copy(self, src_tablename, src_curs, dst_curs, column_list):
+    def set_parsed_row(self, ev, row):
+        """Give row returned earlier by parse_row_data() for next process_event()."""
+        self._parsed_ev = ev
+        self._parsed_row = row
+
+    def real_copy(self, src_tablename, src_curs, dst_curs, column_list, range_cond = None):
         """do actual table copy and return tuple with number of bytes and rows
         copied
         """
@@ -251,11 +364,12 @@ class TableHandler(BaseHandler):
                 return self.encoding_validator.validate_copy(data, column_list, src_tablename)
         else:
             _write_hook = None
-        condition = self.get_copy_condition(src_curs, dst_curs)
+        condition = self.get_range_copy_condition(src_curs, dst_curs, range_cond)
         return skytools.full_copy(src_tablename, src_curs, dst_curs,
                                   column_list, condition,
                                   dst_tablename = self.dest_table,
-                                  write_hook = _write_hook)
+                                  write_hook = _write_hook,
+                                  relay = self.copy_relay)
 
 
 #------------------------------------------------------------------------------
@@ -11,6 +11,9 @@ then add table with:
 or:
   londiste3 add-table xx --handler="bulk(method=X)"
 
+or, to load through long-lived staging table:
+  londiste3 add-table xx --handler="bulk(method=X,staged=1)"
+
 Methods:
 
   0 (correct) - inserts as COPY into table,
@@ -21,6 +24,15 @@ Methods:
 
 Default is 0.
 
+Staged mode:
+
+  All rows of a batch are loaded with one COPY into unlogged
+  staging table, tagged with operation and sequence number, then
+  applied with set-based statements in D/U/I order.  The staging
+  table is created once per destination table and reused, so there
+  is no temp table DDL per batch.  It is dropped when the table
+  is removed from replication.
+
 """
 
 import skytools
@@ -42,6 +54,10 @@ USE_LONGLIVED_TEMP_TABLES = True
 
 USE_REAL_TABLE = False
 
+# extra columns in staging table
+STAGE_OP_COL = '_londiste_op'
+STAGE_SEQ_COL = '_londiste_seq'
+
 class BulkEvent(object):
     """Helper class for BulkLoader to store relevant data."""
     __slots__ = ('op', 'data', 'pk_data')
@@ -57,6 +73,7 @@ class BulkLoader(BaseHandler):
 
     Parameters:
       method=TYPE - method to use for copying [0..2] (default: 0)
+      staged=BOOL - load via long-lived unlogged staging table (default: 0)
 
     Methods:
       0 (correct) - inserts as COPY into table,
@@ -76,20 +93,28 @@ class BulkLoader(BaseHandler):
         self.pkey_list = None
         self.dist_fields = None
         self.col_list = None
+        self.stage_cols = None
 
         self.pkey_ev_map = {}
+        self.event_list = []
         self.method = int(args.get('method', DEFAULT_METHOD))
         if not self.method in (0,1,2):
             raise Exception('unknown method: %s' % self.method)
+        self.staged = int(args.get('staged', 0))
 
         self.log.debug('bulk_init(%r), method=%d', args, self.method)
 
     def reset(self):
         self.pkey_ev_map = {}
+        self.event_list = []
         BaseHandler.reset(self)
 
     def finish_batch(self, batch_info, dst_curs):
-        self.bulk_flush(dst_curs)
+        self.decode_events()
+        if self.staged:
+            self.staged_flush(dst_curs)
+        else:
+            self.bulk_flush(dst_curs)
 
     def process_event(self, ev, sql_queue_func, arg):
         if len(ev.ev_type) < 2 or ev.ev_type[1] != ':':
@@ -98,35 +123,52 @@ class BulkLoader(BaseHandler):
         op = ev.ev_type[0]
         if op not in 'IUD':
             raise Exception('Unknown event type: '+ev.ev_type)
-        # pkey_list = ev.ev_type[2:].split(',')
-        data = skytools.db_urldecode(ev.ev_data)
-
-        # get pkey value
         if self.pkey_list is None:
-            #self.pkey_list = pkey_list
             self.pkey_list = ev.ev_type[2:].split(',')
+
+        # data is decoded for whole batch in finish_batch()
+        self.event_list.append((op, ev.ev_data))
+
+    def decode_events(self):
+        """Decode data of all events at once, group row versions by pkey.
+
+        Rows are kept as tuples in col_list order, pkey columns first,
+        so no dict is created per row.
+        """
+        if not self.event_list:
+            return
+        op_list = [op for op, data in self.event_list]
+        keys, columns = skytools.db_urldecode_batch([data for op, data in self.event_list])
+        self.event_list = []
+        col_map = dict(zip(keys, columns))
+
+        # full column list, pkey first
+        self.col_list = self.pkey_list[:]
+        for k in keys:
+            if k not in self.pkey_list:
+                self.col_list.append(k)
+        for k in self.pkey_list:
+            if k not in col_map:
+                raise Exception('pkey column %s missing in data: %s' % (k, self.table_name))
+        row_list = zip(*[col_map[k] for k in self.col_list])
+
+        # get pkey values
         if len(self.pkey_list) > 0:
-            pk_data = tuple(data[k] for k in self.pkey_list)
-        elif op == 'I':
-            # fake pkey, just to get them spread out
-            pk_data = self.fake_seq
-            self.fake_seq += 1
-        else:
+            pk_list = zip(*[col_map[k] for k in self.pkey_list])
+        elif 'U' in op_list or 'D' in op_list:
             raise Exception('non-pk tables not supported: %s' % self.table_name)
-
-        # get full column list, detect added columns
-        if not self.col_list:
-            self.col_list = data.keys()
-        elif self.col_list != data.keys():
-            # ^ supposedly python guarantees same order in keys()
-            self.col_list = data.keys()
+        else:
+            # fake pkey, just to get them spread out
+            pk_list = range(self.fake_seq, self.fake_seq + len(row_list))
+            self.fake_seq += len(row_list)
 
         # keep all versions of row data
-        ev = BulkEvent(op, data, pk_data)
-        if ev.pk_data in self.pkey_ev_map:
-            self.pkey_ev_map[ev.pk_data].append(ev)
-        else:
-            self.pkey_ev_map[ev.pk_data] = [ev]
+        for op, data, pk_data in zip(op_list, row_list, pk_list):
+            ev = BulkEvent(op, data, pk_data)
+            if pk_data in self.pkey_ev_map:
+                self.pkey_ev_map[pk_data].append(ev)
+            else:
+                self.pkey_ev_map[pk_data] = [ev]
 
     def prepare_data(self):
         """Got all data, prepare for insertion."""
@@ -315,6 +357,148 @@ class BulkLoader(BaseHandler):
 
         self.reset()
 
+    def staged_flush(self, curs):
+        """Apply batch via staging table.
+
+        All ops are loaded with single COPY, then applied
+        with one statement per op type.
+        """
+        ins_list, upd_list, del_list = self.prepare_data()
+        if not ins_list and not upd_list and not del_list:
+            self.reset()
+            return
+
+        # reorder cols, put pks first
+        col_list = self.pkey_list[:]
+        for k in self.col_list:
+            if k not in self.pkey_list:
+                col_list.append(k)
+
+        self.log.debug("staged_flush: %s  (I/U/D = %d/%d/%d)",
+                self.table_name, len(ins_list), len(upd_list), len(del_list))
+
+        if self.dist_fields is None:
+            self.dist_fields = self.find_dist_fields(curs)
+        key_fields = self.pkey_list[:]
+        for fld in self.dist_fields:
+            if fld not in key_fields:
+                key_fields.append(fld)
+
+        qstage = self.get_stage_table(curs, col_list)
+        qtbl = self.fq_dest_table
+        qop = quote_ident(STAGE_OP_COL)
+
+        # with delete method, updates are done as delete + insert
+        del_ops = "'D'"
+        ins_ops = "'I'"
+        upd_ops = None
+        if self.method == METH_CORRECT:
+            upd_ops = "'U'"
+        else:
+            del_ops = "'D','U'"
+            ins_ops = "'I','U'"
+
+        slist = []
+        for col in col_list:
+            if col not in key_fields:
+                exp = "%s = s.%s" % (quote_ident(col), quote_ident(col))
+                slist.append(exp)
+        if not slist:
+            # pk-only table, nothing to update
+            upd_list = []
+
+        # tag rows with op and seq, stream all with single copy
+        def stage_rows():
+            seq = 0
+            for op, lst in (('D', del_list), ('U', upd_list), ('I', ins_list)):
+                for data in lst:
+                    seq += 1
+                    yield (op, seq) + data
+        fields = [STAGE_OP_COL, STAGE_SEQ_COL] + col_list
+        self.log.debug("bulk: COPY %d rows into %s",
+                len(del_list) + len(upd_list) + len(ins_list), qstage)
+        skytools.magic_insert(curs, qstage, stage_rows(), fields, quoted_table=1)
+
+        klist = []
+        for pk in key_fields:
+            klist.append("t.%s = s.%s" % (quote_ident(pk), quote_ident(pk)))
+        whe_expr = " and ".join(klist)
+
+        if del_list or (upd_list and not upd_ops):
+            q = "delete from only %s t using %s s where s.%s in (%s) and %s" % (
+                    qtbl, qstage, qop, del_ops, whe_expr)
+            self.log.debug('bulk: %s', q)
+            curs.execute(q)
+            self.log.debug("bulk: %s - %d", curs.statusmessage, curs.rowcount)
+            expect = len(del_list)
+            if not upd_ops:
+                expect += len(upd_list)
+            if expect != curs.rowcount:
+                self.log.warning("Delete mismatch: expected=%s deleted=%d",
+                        expect, curs.rowcount)
+
+        if upd_list and upd_ops:
+            q = "update only %s t set %s from %s s where s.%s in (%s) and %s" % (
+                    qtbl, ", ".join(slist), qstage, qop, upd_ops, whe_expr)
+            self.log.debug('bulk: %s', q)
+            curs.execute(q)
+            self.log.debug("bulk: %s - %d", curs.statusmessage, curs.rowcount)
+            if len(upd_list) != curs.rowcount:
+                self.log.warning("Update mismatch: expected=%s updated=%d",
+                        len(upd_list), curs.rowcount)
+
+        if ins_list or (upd_list and not upd_ops):
+            colstr = ",".join([quote_ident(c) for c in col_list])
+            q = "insert into %s (%s) select %s from %s where %s in (%s) order by %s" % (
+                    qtbl, colstr, colstr, qstage, qop, ins_ops,
+                    quote_ident(STAGE_SEQ_COL))
+            self.log.debug('bulk: %s', q)
+            curs.execute(q)
+            self.log.debug('bulk: %s', curs.statusmessage)
+
+        # truncate keeps the table small, no dead rows left for vacuum
+        q = "truncate %s" % qstage
+        self.log.debug('bulk: %s', q)
+        curs.execute(q)
+
+        self.reset()
+
+    def get_stage_table(self, curs, col_list):
+        """Return quoted name of staging table, create if needed.
+
+        Table is recreated if it misses some columns.
+        """
+        stage = self.dest_table + "_loaderstage"
+        qstage = quote_fqident(stage)
+        if self.stage_cols is None:
+            if skytools.exists_table(curs, stage):
+                self.stage_cols = skytools.get_table_columns(curs, stage)
+        if self.stage_cols is not None:
+            missing = [c for c in col_list if c not in self.stage_cols]
+            if not missing:
+                return qstage
+            self.log.info("bulk: Recreating %s, missing columns: %s",
+                          stage, ",".join(missing))
+            curs.execute("drop table %s" % qstage)
+
+        # no constraints, delete events may not carry full row
+        q = "create unlogged table %s as select null::text as %s, 0::int8 as %s, t.*"\
+            " from only %s t where false" % (
+                qstage, quote_ident(STAGE_OP_COL), quote_ident(STAGE_SEQ_COL),
+                self.fq_dest_table)
+        self.log.debug("bulk: Creating staging table: %s", q)
+        curs.execute(q)
+        self.stage_cols = skytools.get_table_columns(curs, stage)
+        return qstage
+
+    def remove_table(self, dst_curs):
+        """Drop staging table, if any."""
+        stage = self.dest_table + "_loaderstage"
+        if skytools.exists_table(dst_curs, stage):
+            self.log.info("bulk: Dropping staging table %s", stage)
+            dst_curs.execute("drop table %s" % quote_fqident(stage))
+        self.stage_cols = None
+
     def create_temp_table(self, curs):
         if USE_REAL_TABLE:
             tempname = self.dest_table + "_loadertmpx"
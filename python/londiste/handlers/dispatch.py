@@ -950,12 +950,12 @@ class Dispatcher (ShardHandler):
         """
         return ShardHandler.get_copy_condition(self, src_curs, dst_curs)
 
-    def real_copy(self, tablename, src_curs, dst_curs, column_list):
+    def real_copy(self, tablename, src_curs, dst_curs, column_list, range_cond = None):
         """do actual table copy and return tuple with number of bytes and rows
         copied
         """
         _src_cols = _dst_cols = column_list
-        condition = self.get_copy_condition (src_curs, dst_curs)
+        condition = self.get_range_copy_condition(src_curs, dst_curs, range_cond)
 
         if self.conf.skip_fields:
             _src_cols = [col for col in column_list
@@ -976,7 +976,8 @@ class Dispatcher (ShardHandler):
                                   _src_cols, condition,
                                   dst_tablename = self.dest_table,
                                   dst_column_list = _dst_cols,
-                                  write_hook = _write_hook)
+                                  write_hook = _write_hook,
+                                  relay = self.copy_relay)
 
 
 # add arguments' description to handler's docstring
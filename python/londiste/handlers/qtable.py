@@ -26,6 +26,7 @@ class QueueTableHandler(BaseHandler):
     Event-processing: do nothing.
     """
     handler_name = 'qtable'
+    range_copy = False
 
     def add(self, trigger_arg_list):
         """Create SKIP and BEFORE INSERT trigger"""
@@ -2,13 +2,14 @@
 
 """Basic replication core."""
 
-import sys, os, time
+import sys, os, time, threading
 import skytools
 
 from pgq.cascade.worker import CascadedWorker
 
 from londiste.handler import *
 from londiste.exec_attrs import ExecAttrs
+from londiste.coalesce import RowCoalescer
 
 __all__ = ['Replicator', 'TableState',
     'TABLE_MISSING', 'TABLE_IN_COPY', 'TABLE_CATCHING_UP',
@@ -28,6 +29,9 @@ SYNC_EXIT = 2  # nothing to do, exit script
 
 MAX_PARALLEL_COPY = 8 # default number of allowed max parallel copy processes
 
+APPLY_DB_PREFIX = 'db_apply' # connection cache name prefix for apply workers
+COPY_DB_PREFIX = 'db_copy' # connection cache name prefix for copy workers
+
 class Counter(object):
     """Counts table statuses."""
 
@@ -268,6 +272,67 @@ class TableState(object):
     def get_plugin(self):
         return self.plugin
 
+class ApplyWorker(object):
+    """Applies row events for subset of tables on separate connection.
+
+    Work is done in prepared transaction, that is committed only
+    after main transaction has stored the batch as completed.
+    """
+
+    def __init__(self, repl, num):
+        self.repl = repl
+        self.log = repl.log
+        self.num = num
+        self.cache_name = '%s_%d' % (APPLY_DB_PREFIX, num)
+        self.db = None
+        self.reset()
+
+    def reset(self):
+        self.row_list = []
+        self.sql_list = []
+        self.error = None
+
+    def add_row(self, p, ev, row = None):
+        self.row_list.append((p, ev, row))
+
+    def get_db(self):
+        return self.repl.get_database('db', cache = self.cache_name)
+
+    def begin(self, gid):
+        """Start prepared transaction.  Called from main thread."""
+        self.db = self.get_db()
+        self.db.tpc_begin(gid)
+
+    def run(self, batch_info):
+        """Apply rows and prepare transaction.  Called in worker thread."""
+        try:
+            curs = self.db.cursor()
+            used = []
+            for p, ev, row in self.row_list:
+                if p not in used:
+                    p.prepare_batch(batch_info, curs)
+                    used.append(p)
+                if row is not None:
+                    p.set_parsed_row(ev, row)
+                p.process_event(ev, self.apply_sql, curs)
+            self.flush_sql(curs)
+            for p in used:
+                p.finish_batch(batch_info, curs)
+            self.db.tpc_prepare()
+        except:
+            self.error = sys.exc_info()
+
+    def apply_sql(self, sql, curs):
+        self.sql_list.append(sql)
+        if len(self.sql_list) >= 200:
+            self.flush_sql(curs)
+
+    def flush_sql(self, curs):
+        if self.sql_list:
+            buf = "\n".join(self.sql_list)
+            self.sql_list = []
+            curs.execute(buf)
+
 class Replicator(CascadedWorker):
     """Replication core.
 
@@ -285,6 +350,25 @@ class Replicator(CascadedWorker):
         # how many tables can be copied in parallel
         #parallel_copies = 1
 
+        # split copy of single table into this many pkey or ctid
+        # ranges, copied in parallel over separate connections that
+        # share exported snapshot.  Needs PostgreSQL 9.2+ on provider,
+        # tables without integer pkey are split only on 14+.
+        # Table stays empty on subscriber until copy is finished.
+        #copy_workers = 1
+
+        # run source and destination COPY concurrently, with data
+        # passed between them by separate thread.  With 0, data is
+        # buffered in chunks and written from the copy thread.
+        #copy_relay = 1
+
+        # apply row events of different tables in parallel, over this
+        # many extra connections.  Uses prepared transactions, so
+        # target needs max_prepared_transactions > 0.  Batch must be
+        # checked for conflicting events before apply, so this needs
+        # pgq_lazy_fetch = 0, otherwise batches are applied serially.
+        #apply_workers = 1
+
         # accept only events for locally present tables
         #local_only = true
 
@@ -296,6 +380,12 @@ class Replicator(CascadedWorker):
         # workaround for hashtext change between 8.3 and 8.4
         #compare_sql = select count(1) as cnt, sum(('x'||substr(md5(t.*::text),1,16))::bit(64)::bigint) as chksum from only _TABLE_ t
         #compare_fmt = %(cnt)d rows, checksum=%(chksum)s
+        # compare --ranges: how many sub-ranges to split mismatching range into
+        #compare_fanout = 16
+        # compare --ranges: ranges with less rows are not split further
+        #compare_min_rows = 1000
+        # repair: number of ranges compared in parallel
+        #repair_workers = 1
 
         ## Parameters for initial node creation: create-root/branch/leaf ##
 
@@ -320,6 +410,14 @@ class Replicator(CascadedWorker):
     copy_table_name = None # filled by Copytable()
     sql_list = []
 
+    # pending row changes of tables with coalesce=1
+    coalescer = None
+
+    # parallel apply state
+    parallel_apply = False
+    apply_prepared = []
+    apply_recover_needed = True
+
     current_event = None
 
     def __init__(self, args):
@@ -337,12 +435,26 @@ class Replicator(CascadedWorker):
         if self.parallel_copies < 1:
             raise Exception('Bad value for parallel_copies: %d' % self.parallel_copies)
 
+        self.apply_workers = self.cf.getint('apply_workers', 1)
+        if self.apply_workers < 1:
+            raise Exception('Bad value for apply_workers: %d' % self.apply_workers)
+        self.apply_worker_list = []
+        for i in range(self.apply_workers):
+            self.apply_worker_list.append(ApplyWorker(self, i))
+        self.apply_table_map = {}
+        if self.apply_workers > 1 and self.pgq_lazy_fetch:
+            self.log.warning("apply_workers needs pgq_lazy_fetch = 0, batches will be applied serially")
+
         self.consumer_filter = None
 
         load_handler_modules(self.cf)
 
     def connection_hook(self, dbname, db):
-        if dbname == 'db' and db.server_version >= 80300:
+        # all connections that write into replicated tables
+        if dbname != 'db' and not dbname.startswith(APPLY_DB_PREFIX) \
+                and not dbname.startswith(COPY_DB_PREFIX + '_dst'):
+            return
+        if db.server_version >= 80300:
             curs = db.cursor()
             curs.execute("set session_replication_role = 'replica'")
             db.commit()
@@ -391,12 +503,24 @@ class Replicator(CascadedWorker):
         # and the transaction must be kept open so that
         # the cascade-consumer can save last tick and commit.
 
+        # also when apply_workers was lowered since last run
+        if self.apply_recover_needed:
+            self.recover_apply_workers()
+
         self.sql_list = []
+        self.coalescer = RowCoalescer(self.queue_name)
+        self.parallel_apply = self.can_apply_parallel(ev_list)
         CascadedWorker.process_remote_batch(self, src_db, tick_id, ev_list, dst_db)
+        self.flush_coalesced(dst_curs)
         self.flush_sql(dst_curs)
 
-        for p in self.used_plugins.values():
-            p.finish_batch(self.batch_info, dst_curs)
+        if self.parallel_apply:
+            self.run_apply_workers()
+        else:
+            for p in self.used_plugins.values():
+                t = time.time()
+                p.finish_batch(self.batch_info, dst_curs)
+                self.stat_phase('handler_finish.' + p.handler_name, t)
         self.used_plugins = {}
 
         # finalize table changes
@@ -622,6 +746,11 @@ class Replicator(CascadedWorker):
         if self.work_state < 0:
             self.current_event = ev
 
+        # pending coalesced rows must be applied before non-row events
+        if self.coalescer and ev.type not in ('I', 'U', 'D') \
+                and ev.type[:2] not in ('I:', 'U:', 'D:'):
+            self.flush_coalesced(dst_curs)
+
         if ev.type in ('I', 'U', 'D'):
             self.handle_data_event(ev, dst_curs)
         elif ev.type[:2] in ('I:', 'U:', 'D:'):
@@ -662,9 +791,160 @@ class Replicator(CascadedWorker):
         except KeyError:
             p = t.get_plugin()
             self.used_plugins[ev.extra1] = p
-            p.prepare_batch(self.batch_info, dst_curs)
+            if not self.parallel_apply:
+                p.prepare_batch(self.batch_info, dst_curs)
+
+        # coalescing is skipped when looking for failing event
+        if p.conf.get('coalesce') and self.work_state != -1:
+            if self.coalesce_event(ev, p):
+                return
+
+        if self.phase_stats is None:
+            self.apply_row(p, ev, dst_curs)
+        else:
+            t = time.time()
+            self.apply_row(p, ev, dst_curs)
+            self.stat_phase('apply.' + p.handler_name, t)
+
+    def apply_row(self, p, ev, dst_curs, row = None):
+        """Pass row event to handler, or to apply worker of the table.
+
+        Row already decoded by handler can be given in row.
+        """
+        if self.parallel_apply:
+            n = self.apply_table_map.get(ev.extra1)
+            if n is None:
+                n = len(self.apply_table_map) % self.apply_workers
+                self.apply_table_map[ev.extra1] = n
+            self.apply_worker_list[n].add_row(p, ev, row)
+        else:
+            if row is not None:
+                p.set_parsed_row(ev, row)
+            p.process_event(ev, self.apply_sql, dst_curs)
+
+    def coalesce_event(self, ev, p):
+        """Remember urlenc row event for later apply.
+
+        Returns False if event cannot be coalesced.
+        """
+        if not self.coalescer.can_coalesce(ev):
+            return False
+        row = p.parse_row_data(ev)
+        if self.coalescer.add(ev, row, p):
+            self.stat_increase('coalesced_events')
+        return True
+
+    def flush_coalesced(self, dst_curs):
+        """Apply net change of coalesced rows, in order of first change."""
+
+        if not self.coalescer:
+            return
+        for p, ev, row in self.coalescer.flush():
+            self.apply_row(p, ev, dst_curs, row)
+
+    def can_apply_parallel(self, ev_list):
+        """Parallel apply is possible only if batch has no events
+        that may conflict with row changes in worker transactions.
+        """
+        if self.apply_workers < 2 or self.copy_thread or self.work_state == -1:
+            return False
+        if not isinstance(ev_list, list):
+            # lazy fetch, cannot look ahead
+            return False
+        for ev in ev_list:
+            t = ev.type
+            if t in ('I', 'U', 'D') or t[:2] in ('I:', 'U:', 'D:'):
+                continue
+            if t[:4] == 'pgq.' or t == 'londiste.update-seq':
+                continue
+            return False
+        return True
+
+    def get_apply_gid_prefix(self):
+        return 'londiste:%s:%s:' % (self.queue_name, self.consumer_name)
+
+    def run_apply_workers(self):
+        """Run apply workers in parallel, leave their transactions prepared."""
+
+        active = [w for w in self.apply_worker_list if w.row_list]
+        if not active:
+            return
+
+        prefix = self.get_apply_gid_prefix()
+        for w in active:
+            w.begin('%s%d:%d' % (prefix, self.cur_tick, w.num))
+        self.apply_recover_needed = True
+
+        thread_list = []
+        for w in active:
+            th = threading.Thread(target = w.run, args = (self.batch_info,),
+                                  name = 'apply-%d' % w.num)
+            th.start()
+            thread_list.append(th)
+        for th in thread_list:
+            th.join()
+
+        err = None
+        for w in active:
+            if w.error and not err:
+                err = w.error
+            w.reset()
+        if err:
+            for w in active:
+                try:
+                    w.db.tpc_rollback()
+                except Exception, d:
+                    self.log.warning("apply-%d: rollback failed: %s", w.num, d)
+            raise err[0], err[1], err[2]
+
+        self.log.debug("Applied batch over %d connections", len(active))
+        self.apply_prepared = active
+
+    def commit_apply_workers(self):
+        """Commit prepared transactions after main transaction is committed."""
+        for w in self.apply_prepared:
+            w.db.tpc_commit()
+        self.apply_prepared = []
+        self.apply_recover_needed = False
+
+    def recover_apply_workers(self):
+        """Resolve prepared transactions left over from failure.
+
+        Transaction of a batch is committed if main transaction
+        has marked the batch as completed, otherwise rolled back.
+        """
+        self.apply_prepared = []
+        done_tick = self._consumer_state['completed_tick']
+        prefix = self.get_apply_gid_prefix()
+
+        db = self.apply_worker_list[0].get_db()
+        curs = db.cursor()
+        q = "select gid from pg_catalog.pg_prepared_xacts"\
+            " where database = current_database()"\
+            "   and substr(gid, 1, length(%s)) = %s"
+        curs.execute(q, [prefix, prefix])
+        gid_list = [row[0] for row in curs.fetchall()]
+        db.commit()
+
+        for gid in gid_list:
+            tick = int(gid[len(prefix):].split(':')[0])
+            if tick <= done_tick:
+                self.log.info("Committing prepared transaction %s", gid)
+                db.tpc_commit(gid)
+            else:
+                self.log.info("Rolling back prepared transaction %s", gid)
+                db.tpc_rollback(gid)
+        self.apply_recover_needed = False
+
+        # not needed for serial apply
+        if self.apply_workers < 2 or self.pgq_lazy_fetch:
+            self.close_database(self.apply_worker_list[0].cache_name)
 
-        p.process_event(ev, self.apply_sql, dst_curs)
+    def finish_remote_batch(self, src_db, dst_db, tick_id):
+        """Commit worker transactions after batch is tagged as done."""
+        CascadedWorker.finish_remote_batch(self, src_db, dst_db, tick_id)
+        if self.apply_prepared:
+            self.commit_apply_workers()
 
     def handle_truncate_event(self, ev, dst_curs):
         """handle one truncate event"""
@@ -764,7 +1044,9 @@ class Replicator(CascadedWorker):
         buf = "\n".join(self.sql_list)
         self.sql_list = []
 
+        t = time.time()
         dst_curs.execute(buf)
+        self.stat_phase('flush_sql', t)
 
     def add_set_table(self, dst_curs, tbl):
         """There was new table added to root, remember it."""
@@ -778,6 +1060,7 @@ class Replicator(CascadedWorker):
             t = self.table_map[tbl]
             del self.table_map[tbl]
             self.table_list.remove(t)
+            t.get_plugin().remove_table(dst_curs)
         q = "select londiste.global_remove_table(%s, %s)"
         dst_curs.execute(q, [self.set_name, tbl])
 
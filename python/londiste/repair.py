@@ -2,9 +2,12 @@
 """Repair data on subscriber.
 
 Walks tables by primary key and searches for missing inserts/updates/deletes.
+
+Both tables are streamed in pkey order and merged in memory,
+nothing is dumped to local disk.
 """
 
-import sys, os, skytools, subprocess
+import sys, os, threading, Queue, skytools
 
 from londiste.syncer import Syncer
 
@@ -24,12 +27,14 @@ class Repairer(Syncer):
     total_dst = 0
     pkey_list = []
     common_fields = []
+    key_order = []
     apply_curs = None
 
     def init_optparse(self, p=None):
         """Initialize cmdline switches."""
         p = super(Repairer, self).init_optparse(p)
         p.add_option("--apply", action="store_true", help="apply fixes")
+        p.add_option("--range-file", help="check only ranges from compare --ranges")
         return p
 
     def process_sync(self, t1, t2, src_db, dst_db):
@@ -54,55 +59,163 @@ class Repairer(Syncer):
         self.fq_common_fields = []
         self.pkey_list = []
         self.load_common_columns(src_tbl, dst_tbl, src_curs, dst_curs)
+        self.load_key_order(src_tbl, src_curs)
+
+        where = t2.plugin.get_copy_condition(src_curs, dst_curs)
+        range_list = self.get_repair_ranges(src_tbl, src_curs, dst_tbl, dst_curs)
+        if not range_list:
+            self.log.info("%s: no ranges to check", dst_tbl)
+            return
+
+        fix = "fix.%s.sql" % dst_tbl
+        if os.path.isfile(fix):
+            os.unlink(fix)
+
+        self.fix_lock = threading.Lock()
+        self.cnt_insert = 0
+        self.cnt_update = 0
+        self.cnt_delete = 0
+        self.total_src = 0
+        self.total_dst = 0
+
+        workers = min(self.cf.getint('repair_workers', 1), len(range_list))
+        if workers > 1:
+            self.parallel_compare(src_db, dst_db, src_tbl, dst_tbl, where, range_list, workers)
+        else:
+            for rcond in range_list:
+                self.stream_compare(src_tbl, src_curs, dst_tbl, dst_curs, where, rcond)
+
+        self.log.info("finished %s: src: %d rows, dst: %d rows,"
+                " missed: %d inserts, %d updates, %d deletes",
+                dst_tbl, self.total_src, self.total_dst,
+                self.cnt_insert, self.cnt_update, self.cnt_delete)
+
+    def load_key_order(self, tbl, curs):
+        """Decide how to order rows by pkey.
 
-        dump_src = dst_tbl + ".src"
-        dump_dst = dst_tbl + ".dst"
-        dump_src_sorted = dump_src + ".sorted"
-        dump_dst_sorted = dump_dst + ".sorted"
-
-        dst_where = t2.plugin.get_copy_condition(src_curs, dst_curs)
-        src_where = dst_where
-
-        self.log.info("Dumping src table: %s", src_tbl)
-        self.dump_table(src_tbl, src_curs, dump_src, src_where)
-        src_db.commit()
-        self.log.info("Dumping dst table: %s", dst_tbl)
-        self.dump_table(dst_tbl, dst_curs, dump_dst, dst_where)
-        dst_db.commit()
-
-        self.log.info("Sorting src table: %s", dump_src)
-        self.do_sort(dump_src, dump_src_sorted)
-        self.log.info("Sorting dst table: %s", dump_dst)
-        self.do_sort(dump_dst, dump_dst_sorted)
-
-        self.dump_compare(dst_tbl, dump_src_sorted, dump_dst_sorted)
-
-        os.unlink(dump_src)
-        os.unlink(dump_dst)
-        os.unlink(dump_src_sorted)
-        os.unlink(dump_dst_sorted)
-
-    def do_sort(self, src, dst):
-        """ Sort contents of src file, write them to dst file. """
-
-        p = subprocess.Popen(["sort", "--version"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        s_ver = p.communicate()[0]
-        del p
-
-        xenv = os.environ.copy()
-        xenv['LANG'] = 'C'
-        xenv['LC_ALL'] = 'C'
-
-        cmdline = ['sort', '-T', '.']
-        if s_ver.find("coreutils") > 0:
-            cmdline.append('-S')
-            cmdline.append('30%')
-        cmdline.append('-o')
-        cmdline.append(dst)
-        cmdline.append(src)
-        p = subprocess.Popen(cmdline, env = xenv)
-        if p.wait() != 0:
-            raise Exception('sort failed')
+        Integer keys are ordered by value, others by text
+        representation in C collation, which sorts same as
+        Python str comparison.  Sets self.key_order to list
+        of (order_expr, is_int).
+        """
+        q = "select a.attname, t.typname from pg_catalog.pg_attribute a, pg_catalog.pg_type t"\
+            " where a.attrelid = %s::regclass and a.attnum > 0 and t.oid = a.atttypid"
+        curs.execute(q, [skytools.quote_fqident(tbl)])
+        typemap = dict(curs.fetchall())
+        self.key_order = []
+        for k in self.pkey_list:
+            qk = skytools.quote_ident(k)
+            if typemap.get(k) in ('int2', 'int4', 'int8'):
+                self.key_order.append((qk, True))
+            else:
+                self.key_order.append(('%s::text collate "C"' % qk, False))
+
+    def get_repair_ranges(self, src_tbl, src_curs, dst_tbl, dst_curs):
+        """Return list of conditions that split the table.
+
+        Ranges are taken from --range-file, or with repair_workers
+        set and integer pkey, key space is split evenly.
+        Returns [None] for whole table.
+        """
+        if self.options.range_file:
+            return [ln.strip() for ln in open(self.options.range_file) if ln.strip()]
+
+        workers = self.cf.getint('repair_workers', 1)
+        kexpr, is_int = self.key_order[0]
+        if workers <= 1 or not is_int:
+            return [None]
+
+        q = "select min(%s), max(%s) from only %%s" % (kexpr, kexpr)
+        vals = []
+        for curs, tbl in ((src_curs, src_tbl), (dst_curs, dst_tbl)):
+            curs.execute(q % skytools.quote_fqident(tbl))
+            vals.extend([v for v in curs.fetchone() if v is not None])
+        if not vals:
+            return [None]
+        kmin, kmax = min(vals), max(vals) + 1
+        step = max((kmax - kmin) / workers, 1)
+        res = []
+        lo = kmin
+        while lo < kmax:
+            hi = lo + step
+            if hi + step > kmax:
+                hi = kmax
+            res.append("%s >= %d and %s < %d" % (kexpr, lo, kexpr, hi))
+            lo = hi
+        return res
+
+    def stream_compare(self, src_tbl, src_curs, dst_tbl, dst_curs, where, rcond):
+        """Stream both sides of one range in pkey order and compare."""
+        src = self.open_stream(src_tbl, src_curs, where, rcond)
+        try:
+            dst = self.open_stream(dst_tbl, dst_curs, where, rcond)
+            try:
+                cnt_src, cnt_dst = self.dump_compare(dst_tbl, src, dst)
+            finally:
+                dst.close()
+        finally:
+            src.close()
+        self.fix_lock.acquire()
+        try:
+            self.total_src += cnt_src
+            self.total_dst += cnt_dst
+        finally:
+            self.fix_lock.release()
+
+    def parallel_compare(self, src_db, dst_db, src_tbl, dst_tbl, where, range_list, workers):
+        """Compare ranges in worker threads.
+
+        Workers import snapshots of main connections, so they
+        see tables in same synced state.
+        """
+        src_curs = src_db.cursor()
+        dst_curs = dst_db.cursor()
+        src_curs.execute("select pg_catalog.pg_export_snapshot()")
+        src_snap = src_curs.fetchone()[0]
+        dst_curs.execute("select pg_catalog.pg_export_snapshot()")
+        dst_snap = dst_curs.fetchone()[0]
+
+        self.log.info("%s: comparing %d ranges with %d workers", dst_tbl, len(range_list), workers)
+        rq = Queue.Queue()
+        for rcond in range_list:
+            rq.put(rcond)
+        errors = []
+
+        def run_worker(src_wdb, dst_wdb):
+            try:
+                src_wcurs = src_wdb.cursor()
+                src_wcurs.execute("set transaction snapshot %s", [src_snap])
+                dst_wcurs = dst_wdb.cursor()
+                dst_wcurs.execute("set transaction snapshot %s", [dst_snap])
+                while not errors:
+                    try:
+                        rcond = rq.get_nowait()
+                    except Queue.Empty:
+                        break
+                    self.log.debug("%s: range %s", dst_tbl, rcond)
+                    self.stream_compare(src_tbl, src_wcurs, dst_tbl, dst_wcurs, where, rcond)
+            except:
+                errors.append(sys.exc_info())
+
+        thread_list = []
+        try:
+            for i in range(workers):
+                src_wdb = self.get_database('repair_src_%d' % i, connstr = self.provider_loc,
+                            profile = 'remote', isolation_level = skytools.I_REPEATABLE_READ)
+                dst_wdb = self.get_database('db', cache = 'repair_dst_%d' % i,
+                            isolation_level = skytools.I_REPEATABLE_READ)
+                th = threading.Thread(target = run_worker, args = (src_wdb, dst_wdb),
+                                      name = 'repair-%d' % i)
+                th.start()
+                thread_list.append(th)
+        finally:
+            for th in thread_list:
+                th.join()
+            for i in range(workers):
+                self.close_database('repair_src_%d' % i)
+                self.close_database('repair_dst_%d' % i)
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
 
     def load_common_columns(self, src_tbl, dst_tbl, src_curs, dst_curs):
         """Get common fields, put pkeys in start."""
@@ -132,18 +245,19 @@ class Repairer(Syncer):
         cols = ",".join(fqlist)
         self.log.debug("using columns: %s", cols)
 
-    def dump_table(self, tbl, curs, fn, whr):
-        """Dump table to disk."""
+    def open_stream(self, tbl, curs, whr, rcond):
+        """Start COPY of table in pkey order."""
         cols = ','.join(self.fq_common_fields)
-        if len(whr) == 0:
-            whr = 'true'
-        q = "copy (SELECT %s FROM %s WHERE %s) to stdout" % (cols, skytools.quote_fqident(tbl), whr)
+        cond = [c for c in (whr, rcond) if c]
+        if not cond:
+            cond = ['true']
+        order = ','.join([expr for expr, is_int in self.key_order])
+        q = "copy (SELECT %s FROM ONLY %s WHERE %s ORDER BY %s) to stdout" % (
+                cols, skytools.quote_fqident(tbl), ' and '.join(cond), order)
         self.log.debug("Query: %s", q)
-        f = open(fn, "w", 64*1024)
-        curs.copy_expert(q, f)
-        size = f.tell()
-        f.close()
-        self.log.info('%s: Got %d bytes', tbl, size)
+        stream = skytools.CopyStream(curs, q)
+        stream.start()
+        return stream
 
     def get_row(self, ln):
         """Parse a row into dict."""
@@ -155,26 +269,17 @@ class Repairer(Syncer):
             row[self.common_fields[i]] = t[i]
         return row
 
-    def dump_compare(self, tbl, src_fn, dst_fn):
-        """ Compare two table dumps, create sql file to fix target table
+    def dump_compare(self, tbl, f1, f2):
+        """ Compare two ordered row streams, create sql file to fix target table
             or apply changes to target table directly.
+
+            Returns row counts of both sides.
         """
-        self.log.info("Comparing dumps: %s", tbl)
-        self.cnt_insert = 0
-        self.cnt_update = 0
-        self.cnt_delete = 0
-        self.total_src = 0
-        self.total_dst = 0
-        f1 = open(src_fn, "r", 64*1024)
-        f2 = open(dst_fn, "r", 64*1024)
+        total_src = total_dst = 0
         src_ln = f1.readline()
         dst_ln = f2.readline()
-        if src_ln: self.total_src += 1
-        if dst_ln: self.total_dst += 1
-
-        fix = "fix.%s.sql" % tbl
-        if os.path.isfile(fix):
-            os.unlink(fix)
+        if src_ln: total_src += 1
+        if dst_ln: total_dst += 1
 
         while src_ln or dst_ln:
             keep_src = keep_dst = 0
@@ -197,19 +302,15 @@ class Repairer(Syncer):
 
             if not keep_src:
                 src_ln = f1.readline()
-                if src_ln: self.total_src += 1
+                if src_ln: total_src += 1
             if not keep_dst:
                 dst_ln = f2.readline()
-                if dst_ln: self.total_dst += 1
+                if dst_ln: total_dst += 1
 
-        self.log.info("finished %s: src: %d rows, dst: %d rows,"
-                " missed: %d inserts, %d updates, %d deletes",
-                tbl, self.total_src, self.total_dst,
-                self.cnt_insert, self.cnt_update, self.cnt_delete)
+        return total_src, total_dst
 
     def got_missed_insert(self, tbl, src_row):
         """Create sql for missed insert."""
-        self.cnt_insert += 1
         fld_list = self.common_fields
         fq_list = []
         val_list = []
@@ -223,7 +324,6 @@ class Repairer(Syncer):
 
     def got_missed_update(self, tbl, src_row, dst_row):
         """Create sql for missed update."""
-        self.cnt_update += 1
         fld_list = self.common_fields
         set_list = []
         whe_list = []
@@ -244,7 +344,6 @@ class Repairer(Syncer):
 
     def got_missed_delete(self, tbl, dst_row):
         """Create sql for missed delete."""
-        self.cnt_delete += 1
         whe_list = []
         for f in self.pkey_list:
             self.addcmp(whe_list, skytools.quote_ident(f), unescape(dst_row[f]))
@@ -254,11 +353,22 @@ class Repairer(Syncer):
     def show_fix(self, tbl, q, desc):
         """Print/write/apply repair sql."""
         self.log.debug("missed %s: %s", desc, q)
-        if self.apply_curs:
-            self.apply_curs.execute(q)
-        else:
-            fn = "fix.%s.sql" % tbl
-            open(fn, "a").write("%s\n" % q)
+        # called from several workers
+        self.fix_lock.acquire()
+        try:
+            if desc == 'insert':
+                self.cnt_insert += 1
+            elif desc == 'update':
+                self.cnt_update += 1
+            else:
+                self.cnt_delete += 1
+            if self.apply_curs:
+                self.apply_curs.execute(q)
+            else:
+                fn = "fix.%s.sql" % tbl
+                open(fn, "a").write("%s\n" % q)
+        finally:
+            self.fix_lock.release()
 
     def addeq(self, list, f, v):
         """Add quoted SET."""
@@ -316,9 +426,12 @@ class Repairer(Syncer):
         elif dst_row is None:
             return -1
 
-        for k in self.pkey_list:
-            v1 = src_row[k]
-            v2 = dst_row[k]
+        for i, k in enumerate(self.pkey_list):
+            v1 = unescape(src_row[k])
+            v2 = unescape(dst_row[k])
+            if self.key_order[i][1]:
+                v1 = int(v1)
+                v2 = int(v2)
             if v1 < v2:
                 return -1
             elif v1 > v2:
@@ -330,9 +330,26 @@ class LondisteSetup(CascadeAdmin):
         """Detach table(s) from local node."""
         db = self.get_database('db')
         args = self.expand_arg_list(db, 'r', True, args)
+        self.remove_handler_objects(db, args)
         q = "select * from londiste.local_remove_table(%s, %s)"
         self.exec_cmd_many(db, q, [self.set_name], args)
 
+    def remove_handler_objects(self, db, tbl_list):
+        """Let handlers of removed tables drop their helper objects."""
+        curs = db.cursor()
+        q = "select table_name, table_attrs, dest_table"\
+            " from londiste.get_table_list(%s) where local"
+        curs.execute(q, [self.set_name])
+        for row in curs.fetchall():
+            if row['table_name'] not in tbl_list:
+                continue
+            attrs = skytools.db_urldecode(row['table_attrs'] or '')
+            hstr = attrs.get('handlers', '') # compat
+            hstr = attrs.get('handler', hstr)
+            p = londiste.handler.build_handler(row['table_name'], hstr, row['dest_table'])
+            p.remove_table(curs)
+        db.commit()
+
     def cmd_change_handler(self, tbl):
         """Change handler (table_attrs) of the replicated table."""
 
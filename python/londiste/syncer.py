@@ -23,6 +23,7 @@ class Syncer(skytools.DBScript):
     bad_tables = 0
 
     provider_info = None
+    provider_loc = None
 
     def __init__(self, args):
         """Syncer init."""
@@ -166,6 +167,7 @@ class Syncer(skytools.DBScript):
 
     def process_one_table(self, tbl, t2, dst_db, provider_node, provider_loc):
 
+        self.provider_loc = provider_loc
         lock_db = self.get_database('lock_db', connstr = provider_loc, profile = 'remote')
         setup_db = self.get_database('setup_db', autocommit = 1, connstr = provider_loc, profile = 'remote')
 
@@ -5,14 +5,54 @@
 For internal usage.
 """
 
-import sys, time, skytools
+import sys, time, threading, skytools
 
 from londiste.util import find_copy_source
 from skytools.dbstruct import *
 from londiste.playback import *
+from londiste.playback import COPY_DB_PREFIX
 
 __all__ = ['CopyTable']
 
+class CopyWorker(object):
+    """Copies one range of table, over separate connection pair.
+
+    Source connection imports snapshot of main copy transaction.
+    """
+
+    def __init__(self, script, num, range_cond):
+        self.script = script
+        self.num = num
+        self.range_cond = range_cond
+        self.src_cache = '%s_src_%d' % (COPY_DB_PREFIX, num)
+        self.dst_cache = '%s_dst_%d' % (COPY_DB_PREFIX, num)
+        self.src_db = None
+        self.dst_db = None
+        self.stats = None
+        self.error = None
+
+    def connect(self, src_location):
+        """Open connections.  Called from main thread."""
+        self.src_db = self.script.get_database(self.src_cache, connstr = src_location,
+                profile = 'remote', isolation_level = skytools.I_REPEATABLE_READ)
+        self.dst_db = self.script.get_database('db', cache = self.dst_cache)
+        self.script.sync_database_encodings(self.src_db, self.dst_db)
+
+    def run(self, snapshot_id, p, src_tablename, column_list):
+        """Copy the range.  Called in worker thread."""
+        try:
+            src_curs = self.src_db.cursor()
+            src_curs.execute("set transaction snapshot %s", [snapshot_id])
+            dst_curs = self.dst_db.cursor()
+            self.stats = p.real_copy(src_tablename, src_curs, dst_curs,
+                                     column_list, range_cond = self.range_cond)
+        except:
+            self.error = sys.exc_info()
+
+    def close(self):
+        self.script.close_database(self.src_cache)
+        self.script.close_database(self.dst_cache)
+
 class CopyTable(Replicator):
     """Table copy thread implementation."""
 
@@ -40,6 +80,14 @@ class CopyTable(Replicator):
         self.consumer_name += sfx
         self.copy_thread = 1
         self.main_worker = False
+        self.copy_workers = self.cf.getint('copy_workers', 1)
+        self.copy_relay = self.cf.getint('copy_relay', 1)
+        self.copy_src_location = None
+
+    def get_provider_db(self, state):
+        # remember location for copy workers
+        self.copy_src_location = state['provider_location']
+        return Replicator.get_provider_db(self, state)
 
     def get_copy_suffix(self, tblname):
         return ".copy.%s" % tblname
@@ -118,6 +166,11 @@ class CopyTable(Replicator):
         src_struct = TableStruct(src_curs, src_real_table)
         dst_struct = TableStruct(dst_curs, tbl_stat.dest_table)
 
+        # split table into ranges for parallel copy
+        p = tbl_stat.get_plugin()
+        p.copy_relay = bool(self.copy_relay)
+        range_list = self.get_copy_ranges(src_db, src_real_table, p)
+
         # take common columns, warn on missing ones
         dlist = dst_struct.get_column_list()
         slist = src_struct.get_column_list()
@@ -149,7 +202,8 @@ class CopyTable(Replicator):
                 q += skytools.quote_fqident(tbl_stat.dest_table)
                 dst_curs.execute(q)
 
-            if cmode == 2 and tbl_stat.dropped_ddl is None:
+            # with parallel copy the objects are restored in separate tx
+            if (cmode == 2 or range_list) and tbl_stat.dropped_ddl is None:
                 ddl = dst_struct.get_create_sql(objs)
                 if ddl:
                     q = "select * from londiste.local_set_table_struct(%s, %s, %s)"
@@ -161,8 +215,12 @@ class CopyTable(Replicator):
 
         # do truncate & copy
         self.log.info("%s: start copy", tbl_stat.name)
-        p = tbl_stat.get_plugin()
-        stats = p.real_copy(src_real_table, src_curs, dst_curs, common_cols)
+        if range_list:
+            # workers need to see truncate
+            dst_db.commit()
+            stats = self.parallel_copy(src_curs, p, src_real_table, common_cols, range_list)
+        else:
+            stats = p.real_copy(src_real_table, src_curs, dst_curs, common_cols)
         if stats:
             self.log.info("%s: copy finished: %d bytes, %d rows",
                           tbl_stat.name, stats[0], stats[1])
@@ -181,7 +239,11 @@ class CopyTable(Replicator):
         self.save_table_state(dst_curs)
 
         # create previously dropped objects
-        if cmode == 1:
+        if cmode == 1 and range_list:
+            dst_db.commit()
+            if tbl_stat.dropped_ddl is not None:
+                self.restore_copy_ddl(tbl_stat, dst_db)
+        elif cmode == 1:
             dst_struct.create(dst_curs, objs, log = self.log)
         elif cmode == 2:
             dst_db.commit()
@@ -221,6 +283,121 @@ class CopyTable(Replicator):
         src_curs.execute(q, [self.queue_name])
         src_db.commit()
 
+    def get_copy_ranges(self, src_db, tblname, p):
+        """Split table into ranges for parallel copy.
+
+        Integer pkey is split on value.  Otherwise table
+        is split on pages with ctid conditions, but only on
+        PostgreSQL 14+, older versions cannot scan ctid range
+        and each worker would read whole table.  Returns
+        list of conditions or None for single copy.
+        """
+        nworkers = self.copy_workers
+        if nworkers <= 1:
+            return None
+        if not p.range_copy:
+            self.log.info("%s: handler does not support parallel copy", tblname)
+            return None
+        if src_db.server_version < 90200:
+            self.log.info("%s: provider does not support exported snapshots", tblname)
+            return None
+
+        src_curs = src_db.cursor()
+
+        # conditions on parent would see child rows too
+        q = "select count(1) from pg_catalog.pg_inherits where inhparent = %s::regclass"
+        src_curs.execute(q, [skytools.quote_fqident(tblname)])
+        if src_curs.fetchone()[0] > 0:
+            self.log.info("%s: table has inheritance children, no parallel copy", tblname)
+            return None
+
+        pkeys = skytools.get_table_pkeys(src_curs, tblname)
+        q = "select t.typname from pg_catalog.pg_attribute a, pg_catalog.pg_type t"\
+            " where a.attrelid = %s::regclass and a.attname = %s and t.oid = a.atttypid"
+        typname = None
+        if pkeys:
+            src_curs.execute(q, [skytools.quote_fqident(tblname), pkeys[0]])
+            typname = src_curs.fetchone()[0]
+
+        if typname in ('int2', 'int4', 'int8'):
+            col = skytools.quote_ident(pkeys[0])
+            q = "select min(%s), max(%s) from only %s" % (col, col, skytools.quote_fqident(tblname))
+            src_curs.execute(q)
+            vmin, vmax = src_curs.fetchone()
+            if vmin is None:
+                return None
+            bounds = self.split_range(vmin, vmax + 1, nworkers)
+            fmt = "%s %%s %%d" % col
+        elif src_db.server_version < 140000:
+            self.log.info("%s: no integer pkey, parallel copy needs PostgreSQL 14+", tblname)
+            return None
+        else:
+            q = "select pg_catalog.pg_relation_size(%s::regclass)"\
+                " / pg_catalog.current_setting('block_size')::int4"
+            src_curs.execute(q, [skytools.quote_fqident(tblname)])
+            npages = src_curs.fetchone()[0]
+            bounds = self.split_range(0, npages, nworkers)
+            fmt = "ctid %s '(%d,0)'::tid"
+
+        if not bounds:
+            return None
+
+        # open-ended first and last range
+        cond_list = [fmt % ('<', bounds[0])]
+        for i in range(1, len(bounds)):
+            cond_list.append("%s and %s" % (fmt % ('>=', bounds[i-1]), fmt % ('<', bounds[i])))
+        cond_list.append(fmt % ('>=', bounds[-1]))
+        return cond_list
+
+    def split_range(self, start, end, count):
+        """Return inner boundaries for splitting [start, end) into count parts."""
+        step = (end - start) / count
+        if step < 1:
+            return []
+        return [start + step * i for i in range(1, count)]
+
+    def parallel_copy(self, src_curs, p, src_tablename, column_list, range_list):
+        """Copy ranges of table in parallel, in snapshot of src_curs.
+
+        Returns summed stats.
+        """
+        src_curs.execute("select pg_catalog.pg_export_snapshot()")
+        snapshot_id = src_curs.fetchone()[0]
+
+        self.log.info("%s: parallel copy with %d workers", p.table_name, len(range_list))
+        worker_list = []
+        thread_list = []
+        try:
+            for i, range_cond in enumerate(range_list):
+                self.log.debug("%s: range %d: %s", p.table_name, i, range_cond)
+                w = CopyWorker(self, i, range_cond)
+                worker_list.append(w)
+                w.connect(self.copy_src_location)
+            for w in worker_list:
+                th = threading.Thread(target = w.run, name = 'copy-%d' % w.num,
+                                      args = (snapshot_id, p, src_tablename, column_list))
+                th.start()
+                thread_list.append(th)
+            for th in thread_list:
+                th.join()
+
+            for w in worker_list:
+                if w.error:
+                    raise w.error[0], w.error[1], w.error[2]
+            for w in worker_list:
+                w.dst_db.commit()
+                w.src_db.commit()
+        finally:
+            for w in worker_list:
+                w.close()
+
+        total_bytes = total_rows = 0
+        for w in worker_list:
+            if w.stats:
+                total_bytes += w.stats[0]
+                total_rows += w.stats[1]
+        return (total_bytes, total_rows)
+
     def work(self):
         if not self.reg_ok:
             # check if needed? (table, not existing reg)
@@ -763,6 +763,168 @@ failed:
 	return NULL;
 }
 
+/*
+ * urldecode list of strings to columns
+ */
+
+/* check if src starts with raw key that was seen before */
+static inline bool raw_key_match(PyObject *raw, unsigned char *src, unsigned char *src_end)
+{
+	Py_ssize_t len = PyString_GET_SIZE(raw);
+
+	if (src_end - src < len)
+		return false;
+	if (memcmp(src, PyString_AS_STRING(raw), len) != 0)
+		return false;
+	return src + len == src_end || src[len] == '=' || src[len] == '&';
+}
+
+/* add new column, filled with None */
+static Py_ssize_t add_column(PyObject *keys, PyObject *raw_keys, PyObject *key_map, PyObject *columns,
+			     PyObject *key, unsigned char *raw, Py_ssize_t raw_len, Py_ssize_t nrows)
+{
+	PyObject *col = NULL, *raw_key = NULL, *idx_obj = NULL;
+	Py_ssize_t i, idx = PyList_GET_SIZE(keys);
+
+	col = PyList_New(nrows);
+	if (!col)
+		goto failed;
+	for (i = 0; i < nrows; i++) {
+		Py_INCREF(Py_None);
+		PyList_SET_ITEM(col, i, Py_None);
+	}
+	raw_key = PyString_FromStringAndSize((char *)raw, raw_len);
+	idx_obj = PyInt_FromSsize_t(idx);
+	if (!raw_key || !idx_obj)
+		goto failed;
+	if (PyList_Append(columns, col) < 0)
+		goto failed;
+	if (PyList_Append(keys, key) < 0)
+		goto failed;
+	if (PyList_Append(raw_keys, raw_key) < 0)
+		goto failed;
+	if (PyDict_SetItem(key_map, key, idx_obj) < 0)
+		goto failed;
+	Py_DECREF(col);
+	Py_DECREF(raw_key);
+	Py_DECREF(idx_obj);
+	return idx;
+failed:
+	Py_XDECREF(col);
+	Py_XDECREF(raw_key);
+	Py_XDECREF(idx_obj);
+	return -1;
+}
+
+static const char doc_db_urldecode_batch[] =
+"Urldecode list of strings to columns.\n"
+"Returns tuple (keys, columns), where columns[i][n] is value\n"
+"of keys[i] in n-th string.  Missing keys and keys without '='\n"
+"are decoded as None.\n"
+"\n"
+"C implementation.";
+
+static PyObject *db_urldecode_batch(PyObject *self, PyObject *args)
+{
+	unsigned char *src, *src_end, *start;
+	Py_ssize_t src_len, nrows, row, idx, fieldno;
+	PyObject *seq, *fast = NULL, *tmp_obj = NULL, *idx_obj;
+	PyObject *keys = NULL, *raw_keys = NULL, *key_map = NULL, *columns = NULL;
+	PyObject *key = NULL, *value = NULL, *res = NULL;
+	struct Buf buf;
+
+	if (!PyArg_ParseTuple(args, "O", &seq))
+		return NULL;
+	fast = PySequence_Fast(seq, "db_urldecode_batch() needs sequence of strings");
+	if (!fast)
+		return NULL;
+	nrows = PySequence_Fast_GET_SIZE(fast);
+	if (!buf_init(&buf, 256)) {
+		Py_DECREF(fast);
+		return PyErr_NoMemory();
+	}
+
+	keys = PyList_New(0);
+	raw_keys = PyList_New(0);
+	key_map = PyDict_New();
+	columns = PyList_New(0);
+	if (!keys || !raw_keys || !key_map || !columns)
+		goto failed;
+
+	for (row = 0; row < nrows; row++) {
+		src_len = get_buffer(PySequence_Fast_GET_ITEM(fast, row), &src, &tmp_obj);
+		if (src_len < 0)
+			goto failed;
+		if (!buf_get_target_for(&buf, src_len)) {
+			PyErr_NoMemory();
+			goto failed;
+		}
+
+		src_end = src + src_len;
+		fieldno = 0;
+		while (src < src_end) {
+			if (*src == '&') {
+				src++;
+				continue;
+			}
+
+			/* rows usually have same key order, so try next column first */
+			if (fieldno < PyList_GET_SIZE(raw_keys)
+			    && raw_key_match(PyList_GET_ITEM(raw_keys, fieldno), src, src_end)) {
+				idx = fieldno;
+				src += PyString_GET_SIZE(PyList_GET_ITEM(raw_keys, fieldno));
+			} else {
+				start = src;
+				key = get_elem(buf.ptr, &src, src_end);
+				if (!key)
+					goto failed;
+				idx_obj = PyDict_GetItem(key_map, key);
+				if (idx_obj) {
+					idx = PyInt_AS_LONG(idx_obj);
+				} else {
+					PyString_InternInPlace(&key);
+					idx = add_column(keys, raw_keys, key_map, columns,
+							 key, start, src - start, nrows);
+					if (idx < 0)
+						goto failed;
+				}
+				Py_CLEAR(key);
+			}
+
+			if (src < src_end && *src == '=') {
+				src++;
+				value = get_elem(buf.ptr, &src, src_end);
+				if (value == NULL)
+					goto failed;
+			} else {
+				Py_INCREF(Py_None);
+				value = Py_None;
+			}
+
+			/* steals reference */
+			if (PyList_SetItem(PyList_GET_ITEM(columns, idx), row, value) < 0) {
+				value = NULL;
+				goto failed;
+			}
+			value = NULL;
+			fieldno++;
+		}
+		Py_CLEAR(tmp_obj);
+	}
+	res = PyTuple_Pack(2, keys, columns);
+failed:
+	buf_free(&buf);
+	Py_XDECREF(fast);
+	Py_XDECREF(tmp_obj);
+	Py_XDECREF(key);
+	Py_XDECREF(value);
+	Py_XDECREF(keys);
+	Py_XDECREF(raw_keys);
+	Py_XDECREF(key_map);
+	Py_XDECREF(columns);
+	return res;
+}
+
 /*
  * Module initialization
  */
@@ -775,6 +937,7 @@ cquoting_methods[] = {
 	{ "unescape", unescape, METH_VARARGS, doc_unescape },
 	{ "db_urlencode", db_urlencode, METH_VARARGS, doc_db_urlencode },
 	{ "db_urldecode", db_urldecode, METH_VARARGS, doc_db_urldecode },
+	{ "db_urldecode_batch", db_urldecode_batch, METH_VARARGS, doc_db_urldecode_batch },
 	{ "unquote_literal", unquote_literal, METH_VARARGS, doc_unquote_literal },
 	{ NULL }
 };
@@ -4,6 +4,7 @@ __pychecker__ = 'no-miximport'
 
 import pgq.event
 import pgq.consumer
+import pgq.parallelconsumer
 import pgq.remoteconsumer
 import pgq.producer
 
@@ -18,6 +19,7 @@ import pgq.cascade.worker
 from pgq.event import *
 from pgq.consumer import *
 from pgq.coopconsumer import *
+from pgq.parallelconsumer import *
 from pgq.remoteconsumer import *
 from pgq.localconsumer import *
 from pgq.producer import *
@@ -33,6 +35,7 @@ __all__ = (
     pgq.event.__all__ +
     pgq.consumer.__all__ +
     pgq.coopconsumer.__all__ +
+    pgq.parallelconsumer.__all__ +
     pgq.remoteconsumer.__all__ +
     pgq.localconsumer.__all__ +
     pgq.cascade.nodeinfo.__all__ +
@@ -7,24 +7,115 @@ todo:
 
 """
 
-import sys, time, skytools
+import sys, time, threading, Queue, skytools
 
 from pgq.event import *
 
 __all__ = ['BaseConsumer', 'BaseBatchWalker']
 
 
+_copy_fldpos = FieldPositions(EVENT_FIELDS)
+
+def _parse_copy_event(ln):
+    r"""Parse COPY text line with EVENT_FIELDS into tuple.
+
+    >>> _parse_copy_event('5\t2012-01-02 10:20:30+02\t99\t\\N\tI:id\tid=1\\tx\tpublic.t\t\\N\t\\N\t\\N\n')[2:7]
+    (99, None, 'I:id', 'id=1\tx', 'public.t')
+    """
+    vals = ln[:-1].split('\t')
+    for i, v in enumerate(vals):
+        if '\\' in v:
+            vals[i] = skytools.unescape_copy(v)
+    vals[0] = int(vals[0])
+    vals[1] = skytools.parse_iso_timestamp(vals[1])
+    vals[2] = int(vals[2])
+    if vals[3] is not None:
+        vals[3] = int(vals[3])
+    return tuple(vals)
+
+class AdaptiveBatchSize(object):
+    """Tunes batch collection parameters from observed processing speed.
+
+    Keeps moving average of events processed per second and
+    asks for batches that take target_duration to process.
+    If a batch takes more than twice the target, the average
+    is reset to latest speed, so batch size drops quickly.
+
+    >>> ab = AdaptiveBatchSize(2.0, 1000)
+    >>> print ab.min_count, ab.min_interval
+    None None
+    >>> ab.update(100, 1.0)
+    >>> print ab.min_count, ab.min_interval
+    200 2.0 seconds
+    >>> ab.update(300, 1.0)
+    >>> ab.min_count
+    320
+    >>> ab.update(1000, 1.0)
+    >>> ab.min_count
+    824
+    >>> ab.update(500, 10.0)
+    >>> ab.min_count
+    100
+    """
+
+    # weight of latest batch in moving average
+    smoothing = 0.3
+
+    def __init__(self, target_duration, max_count, max_interval = None):
+        self.rate = None
+        self.configure(target_duration, max_count, max_interval)
+
+    def configure(self, target_duration, max_count, max_interval = None):
+        """Set new limits, keeps collected statistics."""
+        self.target_duration = target_duration
+        self.max_count = max_count
+        self.max_interval = max_interval
+
+    def update(self, count, duration):
+        """Register processed batch."""
+        if count <= 0 or duration <= 0:
+            return
+        rate = count / duration
+        if self.rate is None or duration > 2 * self.target_duration:
+            self.rate = rate
+        else:
+            self.rate += (rate - self.rate) * self.smoothing
+
+    @property
+    def min_count(self):
+        if self.rate is None:
+            return None
+        cnt = int(self.rate * self.target_duration)
+        return max(1, min(cnt, self.max_count))
+
+    @property
+    def min_interval(self):
+        if self.rate is None:
+            return None
+        if self.max_interval:
+            return self.max_interval
+        return '%s seconds' % self.target_duration
+
+
 class BaseBatchWalker(object):
     """Lazy iterator over batch events.
 
-    Events are loaded using cursor.  It will be given
-    as ev_list to process_batch(). It allows:
+    Events are loaded using cursor.  If the cursor returns
+    plain tuples, events use field positions from cursor
+    description.  It will be given as ev_list to process_batch().
+    It allows:
 
      - one for loop over events
      - len() after that
     """
 
-    def __init__(self, curs, batch_id, queue_name, fetch_size = 300, consumer_filter = None):
+    # COPY data is passed to parser in chunks of this size,
+    # at most copy_max_chunks of them are buffered
+    copy_chunk_size = 64*1024
+    copy_max_chunks = 16
+
+    def __init__(self, curs, batch_id, queue_name, fetch_size = 300, consumer_filter = None,
+                 prefetch = False, copy_fetch = False):
         self.queue_name = queue_name
         self.fetch_size = fetch_size
         self.sql_cursor = "batch_walker"
@@ -33,40 +124,143 @@ class BaseBatchWalker(object):
         self.batch_id = batch_id
         self.fetch_status = 0 # 0-not started, 1-in-progress, 2-done
         self.consumer_filter = consumer_filter
+        self.prefetch = prefetch
+        self.copy_fetch = copy_fetch
+        self.fldpos = None
 
     def _make_event(self, queue_name, row):
-        return Event(queue_name, row)
+        return Event(queue_name, row, self.fldpos)
 
     def __iter__(self):
         if self.fetch_status:
             raise Exception("BatchWalker: double fetch? (%d)" % self.fetch_status)
         self.fetch_status = 1
 
+        if self.copy_fetch:
+            self.fldpos = _copy_fldpos
+        if self.prefetch:
+            blocks = self._prefetch_blocks()
+        else:
+            blocks = self._fetch_blocks(self.curs)
+
+        for rows in blocks:
+            self.length += len(rows)
+            for row in rows:
+                ev = self._make_event(self.queue_name, row)
+                yield ev
+
+        self.fetch_status = 2
+
+    def _fetch_blocks(self, curs):
+        """Fetch batch events from cursor, one block of rows at a time."""
+
+        if self.copy_fetch:
+            for rows in self._fetch_copy_blocks(curs):
+                yield rows
+            return
+
         q = "select * from pgq.get_batch_cursor(%s, %s, %s, %s)"
-        self.curs.execute(q, [self.batch_id, self.sql_cursor, self.fetch_size, self.consumer_filter])
+        curs.execute(q, [self.batch_id, self.sql_cursor, self.fetch_size, self.consumer_filter])
         # this will return first batch of rows
 
         q = "fetch %d from %s" % (self.fetch_size, self.sql_cursor)
         while 1:
-            rows = self.curs.fetchall()
+            rows = curs.fetchall()
             if not len(rows):
                 break
 
-            self.length += len(rows)
-            for row in rows:
-                ev = self._make_event(self.queue_name, row)
-                yield ev
+            if self.fldpos is None and isinstance(rows[0], tuple):
+                self.fldpos = FieldPositions([d[0] for d in curs.description])
+
+            yield rows
 
             # if less rows than requested, it was final block
             if len(rows) < self.fetch_size:
                 break
 
             # request next block of rows
-            self.curs.execute(q)
+            curs.execute(q)
 
-        self.curs.execute("close %s" % self.sql_cursor)
+        curs.execute("close %s" % self.sql_cursor)
 
-        self.fetch_status = 2
+    def _fetch_copy_blocks(self, curs):
+        """Stream batch events with COPY, parse rows lazily into tuples.
+
+        Avoids per-row DictRow materialization.  COPY runs in
+        background thread while rows are parsed, so cursor
+        connection is busy until all events are read.
+        """
+
+        curs.execute("select pgq.batch_event_sql(%s)", [self.batch_id])
+        sql = curs.fetchone()[0]
+        if sql.endswith(' order by 1'):
+            sql = sql[:-len(' order by 1')]
+        where = ''
+        if self.consumer_filter is not None:
+            where = ' where %s' % self.consumer_filter
+        q = "copy (select %s from (%s) _evs%s order by 1) to stdout" % (
+                ', '.join(EVENT_FIELDS), sql, where)
+
+        buf = skytools.CopyStream(curs, q, self.copy_chunk_size, self.copy_max_chunks)
+        try:
+            buf.start()
+            rows = []
+            for ln in buf:
+                rows.append(_parse_copy_event(ln))
+                if len(rows) >= self.fetch_size:
+                    yield rows
+                    rows = []
+            if rows:
+                yield rows
+        finally:
+            buf.close()
+
+    def _prefetch_blocks(self):
+        """Run _fetch_blocks() in background thread.
+
+        Next block of rows is fetched from database while
+        the consumer is processing the current one.
+        """
+
+        curs = self.curs
+        conn = curs.connection
+        blockq = Queue.Queue(2)
+        stop = threading.Event()
+
+        def put(item):
+            # give up if consumer has abandoned the walker
+            while not stop.isSet() and not conn.closed:
+                try:
+                    blockq.put(item, True, 1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def fetcher():
+            try:
+                for rows in self._fetch_blocks(curs):
+                    if not put(('rows', rows)):
+                        return
+                put(('done', None))
+            except:
+                put(('error', sys.exc_info()))
+
+        th = threading.Thread(target = fetcher, name = 'batch_walker')
+        th.setDaemon(True)
+        th.start()
+        try:
+            while 1:
+                kind, val = blockq.get()
+                if kind == 'rows':
+                    yield val
+                elif kind == 'error':
+                    raise val[0], val[1], val[2]
+                else:
+                    break
+        finally:
+            stop.set()
+            th.join()
 
     def __len__(self):
         return self.length
@@ -92,6 +286,28 @@ class BaseConsumer(skytools.DBScript):
         # whether to use cursor to fetch events (0 disables)
         #pgq_lazy_fetch = 300
 
+        # whether to fetch events as plain tuples instead of dict rows,
+        # saves memory and makes field access cheaper.
+        # default depends on consumer class
+        #pgq_tuple_events = 1
+
+        # whether to fetch events with COPY instead of cursor,
+        # rows are parsed lazily into plain tuples.
+        # needs pgq_lazy_fetch, which also gives parse block size.
+        # queue db connection is busy until whole batch is read
+        #pgq_copy_fetch = 0
+
+        # whether to overlap event fetching with processing:
+        # next block of events is fetched in background thread
+        # and next batch is allocated in same transaction
+        # with finishing current one
+        #pgq_prefetch = 0
+
+        # whether to wait for tick notification from queue database
+        # instead of sleeping, loop_delay is then only upper limit
+        # for the wait
+        #pgq_listen = 0
+
         # whether to read from source size in autocommmit mode
         # not compatible with pgq_lazy_fetch
         # the actual user script on top of pgq.Consumer must also support it
@@ -108,14 +324,34 @@ class BaseConsumer(skytools.DBScript):
         # whether to stay behind queue top (postgres interval)
         #pgq_keep_lag =
 
+        # tune batch size at runtime, so that processing a batch takes
+        # about that many seconds (0 disables).  pgq_batch_collect_events
+        # is then used as upper limit for batch size and
+        # pgq_batch_collect_interval as max wait for events,
+        # which defaults to target duration
+        #pgq_batch_target_duration = 0
+
         # in how many seconds to write keepalive stats for idle consumers
         # this stats is used for detecting that consumer is still running
         #keepalive_stats = 300
+
+        # export latency histograms for each work phase: next_batch,
+        # fetch, process, finish_batch, commit.  File is rewritten
+        # in Prometheus text format, UDP target is given as host:port
+        #stats_phase_file = ~/stats/%(job_name)s.prom
+        #stats_phase_udp =
+
+        # how often to export phase stats, in seconds.
+        # exported values cover that period
+        #stats_phase_period = 60
     """
 
     # by default, use cursor-based fetch
     default_lazy_fetch = 300
 
+    # by default, use dict rows for events
+    default_tuple_events = 0
+
     # should reader connection be used in autocommit mode
     pgq_autocommit = 0
 
@@ -128,20 +364,34 @@ class BaseConsumer(skytools.DBScript):
     pgq_consumer_id = None
 
     pgq_lazy_fetch = None
+    pgq_prefetch = 0
+    pgq_copy_fetch = 0
+    pgq_tuple_events = 0
+    pgq_listen = 0
     pgq_min_count = None
     pgq_min_interval = None
     pgq_min_lag = None
 
     batch_info = None
 
+    # runtime tuning of pgq_min_count / pgq_min_interval
+    batch_sizer = None
+
     consumer_filter = None
 
     keepalive_stats = None
     # statistics: time spent waiting for events
     idle_start = None
 
+    # per-phase latency histograms, if enabled
+    phase_stats = None
+    phase_stats_next = 0
+
     _batch_walker_class = BaseBatchWalker
 
+    # batch allocated together with finishing previous one: (db, batch_id, batch_info)
+    _prefetch_batch = None
+
     def __init__(self, service_name, db_name, args):
         """Initialize new consumer.
 
@@ -150,26 +400,12 @@ class BaseConsumer(skytools.DBScript):
         @param args: cmdline args for DBScript
         """
 
-        skytools.DBScript.__init__(self, service_name, args)
-
         self.db_name = db_name
 
-        # compat params
-        self.consumer_name = self.cf.get("pgq_consumer_id", '')
-        self.queue_name = self.cf.get("pgq_queue_name", '')
-
-        # proper params
-        if not self.consumer_name:
-            self.consumer_name = self.cf.get("consumer_name", self.job_name)
-        if not self.queue_name:
-            self.queue_name = self.cf.get("queue_name")
+        skytools.DBScript.__init__(self, service_name, args)
 
         self.stat_batch_start = 0
 
-        # compat vars
-        self.pgq_queue_name = self.queue_name
-        self.consumer_id = self.consumer_name
-
         # set default just once
         self.pgq_autocommit = self.cf.getint("pgq_autocommit", self.pgq_autocommit)
         if self.pgq_autocommit and self.pgq_lazy_fetch:
@@ -181,13 +417,45 @@ class BaseConsumer(skytools.DBScript):
     def reload(self):
         skytools.DBScript.reload(self)
 
+        # names are loaded only once
+        if not self.queue_name:
+            # compat params
+            self.consumer_name = self.cf.get("pgq_consumer_id", '')
+            self.queue_name = self.cf.get("pgq_queue_name", '')
+
+            # proper params
+            if not self.consumer_name:
+                self.consumer_name = self.cf.get("consumer_name", self.job_name)
+            if not self.queue_name:
+                self.queue_name = self.cf.get("queue_name")
+
+            # compat vars
+            self.pgq_queue_name = self.queue_name
+            self.consumer_id = self.consumer_name
+
         self.pgq_lazy_fetch = self.cf.getint("pgq_lazy_fetch", self.default_lazy_fetch)
+        self.pgq_prefetch = self.cf.getint("pgq_prefetch", 0)
+        self.pgq_copy_fetch = self.cf.getint("pgq_copy_fetch", 0)
+        if self.pgq_copy_fetch and not self.pgq_lazy_fetch:
+            self.log.warning("pgq_copy_fetch needs pgq_lazy_fetch, events are fetched without COPY")
+        self.pgq_tuple_events = self.cf.getint("pgq_tuple_events", self.default_tuple_events)
 
         # set following ones to None if not set
         self.pgq_min_count = self.cf.getint("pgq_batch_collect_events", 0) or None
         self.pgq_min_interval = self.cf.get("pgq_batch_collect_interval", '') or None
         self.pgq_min_lag = self.cf.get("pgq_keep_lag", '') or None
 
+        target = self.cf.getfloat("pgq_batch_target_duration", 0)
+        if target > 0:
+            max_count = self.pgq_min_count or 100000
+            if self.batch_sizer:
+                self.batch_sizer.configure(target, max_count, self.pgq_min_interval)
+            else:
+                self.batch_sizer = AdaptiveBatchSize(target, max_count, self.pgq_min_interval)
+            self._apply_batch_sizer()
+        else:
+            self.batch_sizer = None
+
         # filter out specific tables only
         tfilt = []
         for t in self.cf.getlist('table_filter', ''):
@@ -198,6 +466,27 @@ class BaseConsumer(skytools.DBScript):
 
         self.keepalive_stats = self.cf.getint("keepalive_stats", 300)
 
+        self.pgq_listen = self.cf.getint("pgq_listen", 0)
+        self._update_listen()
+
+        self.stats_phase_file = self.cf.getfile("stats_phase_file", "")
+        self.stats_phase_udp = self.cf.get("stats_phase_udp", "")
+        self.stats_phase_period = self.cf.getfloat("stats_phase_period", 60)
+        if self.stats_phase_file or self.stats_phase_udp:
+            if not self.phase_stats:
+                self.phase_stats = skytools.PhaseStats()
+                self.phase_stats_next = time.time() + self.stats_phase_period
+        else:
+            self.phase_stats = None
+
+    def _update_listen(self):
+        """Listen for tick notifications on queue db, if configured."""
+        channel = "pgq." + self.queue_name
+        if self.pgq_listen:
+            self.listen(self.db_name, channel)
+        else:
+            self.unlisten(self.db_name, channel)
+
     def startup(self):
         """Handle commands here.  __init__ does not have error logging."""
         if self.options.register:
@@ -242,27 +531,48 @@ class BaseConsumer(skytools.DBScript):
         curs = db.cursor()
 
         self.stat_start()
+        t = self.stat_batch_start
 
         # acquire batch
-        batch_id = self._load_next_batch(curs)
-        db.commit()
+        batch_id = self._take_prefetch_batch(db)
+        if batch_id is None:
+            batch_id = self._load_next_batch(curs)
+            db.commit()
         if batch_id == None:
             return 0
+        batch_start = t = self.stat_phase('next_batch', t)
 
         # load events
         ev_list = self._load_batch_events(curs, batch_id)
         db.commit()
+        t = self.stat_phase('fetch', t)
 
         # process events
         self._launch_process_batch(db, batch_id, ev_list)
+        t = self.stat_phase('process', t)
 
         # done
         self._finish_batch(curs, batch_id, ev_list)
+        if self.pgq_prefetch:
+            self._prefetch_next_batch(db, curs)
+        t = self.stat_phase('finish_batch', t)
         db.commit()
+        self.stat_phase('commit', t)
         self.stat_end(len(ev_list))
 
+        if self.batch_sizer:
+            self.batch_sizer.update(len(ev_list), time.time() - batch_start)
+            self._apply_batch_sizer()
+
         return 1
 
+    def _apply_batch_sizer(self):
+        """Use batch collection parameters from batch_sizer. (internal)"""
+        if self.batch_sizer.min_count is None:
+            return
+        self.pgq_min_count = self.batch_sizer.min_count
+        self.pgq_min_interval = self.batch_sizer.min_interval
+
     def register_consumer(self):
         self.log.info("Registering consumer on source queue")
         db = self.get_database(self.db_name)
@@ -285,8 +595,8 @@ class BaseConsumer(skytools.DBScript):
     def _launch_process_batch(self, db, batch_id, ev_list):
         self.process_batch(db, batch_id, ev_list)
 
-    def _make_event(self, queue_name, row):
-        return Event(queue_name, row)
+    def _make_event(self, queue_name, row, fldpos = None):
+        return Event(queue_name, row, fldpos)
 
     def _load_batch_events_old(self, curs, batch_id):
         """Fetch all events for this batch."""
@@ -298,10 +608,14 @@ class BaseConsumer(skytools.DBScript):
         curs.execute(sql)
         rows = curs.fetchall()
 
+        fldpos = None
+        if rows and isinstance(rows[0], tuple):
+            fldpos = FieldPositions([d[0] for d in curs.description])
+
         # map them to python objects
         ev_list = []
         for r in rows:
-            ev = self._make_event(self.queue_name, r)
+            ev = self._make_event(self.queue_name, r, fldpos)
             ev_list.append(ev)
 
         return ev_list
@@ -309,8 +623,13 @@ class BaseConsumer(skytools.DBScript):
     def _load_batch_events(self, curs, batch_id):
         """Fetch all events for this batch."""
 
+        if self.pgq_tuple_events:
+            curs = curs.connection.cursor(plain = True)
+
         if self.pgq_lazy_fetch:
-            return self._batch_walker_class(curs, batch_id, self.queue_name, self.pgq_lazy_fetch, self.consumer_filter)
+            return self._batch_walker_class(curs, batch_id, self.queue_name, self.pgq_lazy_fetch, self.consumer_filter,
+                                            prefetch = bool(self.pgq_prefetch),
+                                            copy_fetch = bool(self.pgq_copy_fetch))
         else:
             return self._load_batch_events_old(curs, batch_id)
 
@@ -329,6 +648,29 @@ class BaseConsumer(skytools.DBScript):
         self.batch_info = inf
         return self.batch_info['batch_id']
 
+    def _prefetch_next_batch(self, db, curs):
+        """Allocate next batch in same transaction with finishing current one. (internal)
+
+        Saves a roundtrip per batch.  As pgq allows only one active batch
+        per consumer, finish_batch ordering stays strict.
+        """
+        self._prefetch_batch = None
+        batch_id = self._load_next_batch(curs)
+        if batch_id is not None:
+            self._prefetch_batch = (db, batch_id, self.batch_info)
+
+    def _take_prefetch_batch(self, db):
+        """Return id of prefetched batch or None. (internal)
+
+        Batch is used only if it was allocated on same connection.
+        """
+        pf = self._prefetch_batch
+        self._prefetch_batch = None
+        if not pf or pf[0] is not db or db.closed:
+            return None
+        self.batch_info = pf[2]
+        return pf[1]
+
     def _finish_batch(self, curs, batch_id, ev_list):
         """Tag events and notify that the batch is done."""
 
@@ -341,6 +683,34 @@ class BaseConsumer(skytools.DBScript):
             self.stat_put('idle', round(self.stat_batch_start - self.idle_start,4))
             self.idle_start = t
 
+    def stat_phase(self, phase, t0):
+        """Record duration of work phase that started at t0.
+
+        Returns current time, to be used as start of next phase.
+        """
+        t = time.time()
+        if self.phase_stats is not None:
+            self.phase_stats.add(phase, t - t0)
+        return t
+
+    def send_stats(self):
+        skytools.DBScript.send_stats(self)
+
+        if self.phase_stats is None or time.time() < self.phase_stats_next:
+            return
+        self.phase_stats_next = time.time() + self.stats_phase_period
+        name = 'pgq_phase_seconds'
+        labels = {'job': self.job_name}
+        try:
+            if self.stats_phase_file:
+                self.phase_stats.write_file(self.stats_phase_file, name, labels)
+            if self.stats_phase_udp:
+                host, port = self.stats_phase_udp.rsplit(':', 1)
+                self.phase_stats.send_udp(host, int(port), name, labels)
+        except (IOError, OSError, ValueError), d:
+            self.log.warning("Failed to export phase stats: %s", d)
+        self.phase_stats.reset()
+
     def stat_end(self, count):
         t = time.time()
         self.stat_put('count', count)
@@ -348,3 +718,7 @@ class BaseConsumer(skytools.DBScript):
         if count > 0: # reset timer if we got some events
             self.stat_put('idle', round(self.stat_batch_start - self.idle_start,4))
             self.idle_start = t
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
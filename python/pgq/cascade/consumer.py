@@ -20,6 +20,9 @@ class CascadedConsumer(BaseConsumer):
 
     _consumer_state = None
 
+    # events as plain tuples
+    default_tuple_events = 1
+
     def __init__(self, service_name, db_name, args):
         """Initialize new consumer.
 
@@ -169,10 +172,13 @@ class CascadedConsumer(BaseConsumer):
             return
 
         tick_id = self.batch_info['tick_id']
+        t = time.time()
         self.process_remote_batch(src_db, tick_id, event_list, dst_db)
+        t = self.stat_phase('process_remote', t)
 
         # this also commits
         self.finish_remote_batch(src_db, dst_db, tick_id)
+        self.stat_phase('finish_remote', t)
 
     def process_root_node(self, dst_db):
         """This is called on root node, where no processing should happen.
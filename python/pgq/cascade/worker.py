@@ -401,7 +401,7 @@ class CascadedWorker(CascadedConsumer):
             st = self._worker_state
             if st.sync_watermark:
                 # replace payload with synced global watermark
-                row = ev._event_row.copy()
+                row = dict(ev.items())
                 row['ev_data'] = str(st.global_watermark)
                 ev = Event(self.queue_name, row)
         self.ev_buf.append(ev)
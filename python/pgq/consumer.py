@@ -3,6 +3,8 @@
 
 """
 
+import skytools
+
 from pgq.baseconsumer import BaseConsumer, BaseBatchWalker
 from pgq.event import Event
 
@@ -22,8 +24,8 @@ class RetriableEvent(Event):
     """
     __slots__ = ('_status', )
 
-    def __init__(self, queue_name, row):
-        super(RetriableEvent, self).__init__(queue_name, row)
+    def __init__(self, queue_name, row, fldpos = None):
+        super(RetriableEvent, self).__init__(queue_name, row, fldpos)
         self._status = EV_DONE
 
     def tag_done(self):
@@ -45,8 +47,8 @@ class RetriableWalkerEvent(RetriableEvent):
     """
     __slots__ = ('_walker', )
 
-    def __init__(self, walker, queue_name, row):
-        super(RetriableWalkerEvent, self).__init__(queue_name, row)
+    def __init__(self, walker, queue_name, row, fldpos = None):
+        super(RetriableWalkerEvent, self).__init__(queue_name, row, fldpos)
         self._walker = walker
 
     def tag_done(self):
@@ -63,12 +65,14 @@ class RetriableBatchWalker(BaseBatchWalker):
     """BatchWalker that returns RetriableEvents
     """
 
-    def __init__(self, curs, batch_id, queue_name, fetch_size = 300, consumer_filter = None):
-        super(RetriableBatchWalker, self).__init__(curs, batch_id, queue_name, fetch_size, consumer_filter)
+    def __init__(self, curs, batch_id, queue_name, fetch_size = 300, consumer_filter = None,
+                 prefetch = False, copy_fetch = False):
+        super(RetriableBatchWalker, self).__init__(curs, batch_id, queue_name, fetch_size, consumer_filter,
+                                                   prefetch, copy_fetch)
         self.status_map = {}
 
     def _make_event(self, queue_name, row):
-        return RetriableWalkerEvent(self, queue_name, row)
+        return RetriableWalkerEvent(self, queue_name, row, self.fldpos)
 
     def tag_event_done(self, event):
         if event.id in self.status_map:
@@ -88,36 +92,82 @@ class RetriableBatchWalker(BaseBatchWalker):
 class Consumer(BaseConsumer):
     """Normal consumer base class.
     Can retry events
+
+    Config template::
+
+        ## Parameters for pgq.Consumer ##
+
+        # tag retry events with single pgq.event_retry_list() call
+        # when there are at least that many of them in batch (0 disables)
+        #pgq_bulk_retry = 20
     """
 
     _batch_walker_class = RetriableBatchWalker
 
-    def _make_event(self, queue_name, row):
-        return RetriableEvent(queue_name, row)
+    # events as plain tuples
+    default_tuple_events = 1
+
+    # minimal number of retry events for bulk tagging
+    default_bulk_retry = 20
+
+    pgq_bulk_retry = None
+
+    # connection where pgq.event_retry_list() was looked up, and result
+    _bulk_retry_conn = None
+    _bulk_retry_ok = False
+
+    def reload(self):
+        super(Consumer, self).reload()
+
+        self.pgq_bulk_retry = self.cf.getint("pgq_bulk_retry", self.default_bulk_retry)
+
+    def _make_event(self, queue_name, row, fldpos = None):
+        return RetriableEvent(queue_name, row, fldpos)
 
     def _flush_retry(self, curs, batch_id, list):
         """Tag retry events."""
 
-        retry = 0
+        retry_list = []
         if self.pgq_lazy_fetch:
             for ev_id, stat in list.iter_status():
                 if stat[0] == EV_RETRY:
-                    self._tag_retry(curs, batch_id, ev_id, stat[1])
-                    retry += 1
+                    retry_list.append((ev_id, stat[1]))
                 elif stat[0] != EV_DONE:
                     raise Exception("Untagged event: id=%d" % ev_id)
         else:
             for ev in list:
                 if ev._status == EV_RETRY:
-                    self._tag_retry(curs, batch_id, ev.id, ev.retry_time)
-                    retry += 1
+                    retry_list.append((ev.id, ev.retry_time))
                 elif ev._status != EV_DONE:
                     raise Exception("Untagged event: (id=%d, type=%s, data=%s, ex1=%s" % (
                                     ev.id, ev.type, ev.data, ev.extra1))
 
+        if not retry_list:
+            return
+
+        if self._use_bulk_retry(curs, len(retry_list)):
+            self._tag_retry_list(curs, batch_id, retry_list)
+        else:
+            for ev_id, retry_time in retry_list:
+                self._tag_retry(curs, batch_id, ev_id, retry_time)
+
         # report weird events
-        if retry:
-            self.stat_increase('retry-events', retry)
+        self.stat_increase('retry-events', len(retry_list))
+
+    def _use_bulk_retry(self, curs, count):
+        """Decide whether to tag retry events with one call. (internal)
+
+        Older pgq versions do not have pgq.event_retry_list().
+        """
+        if not self.pgq_bulk_retry or count < self.pgq_bulk_retry:
+            return False
+        # look it up once per connection
+        if curs.connection is not self._bulk_retry_conn:
+            self._bulk_retry_ok = skytools.exists_function(curs, 'pgq.event_retry_list', 3)
+            self._bulk_retry_conn = curs.connection
+            if not self._bulk_retry_ok:
+                self.log.debug("pgq.event_retry_list() not available, tagging events one by one")
+        return self._bulk_retry_ok
 
     def _finish_batch(self, curs, batch_id, list):
         """Tag events and notify that the batch is done."""
@@ -130,3 +180,10 @@ class Consumer(BaseConsumer):
         """Tag event for retry. (internal)"""
         cx.execute("select pgq.event_retry(%s, %s, %s)",
                     [batch_id, ev_id, retry_time])
+
+    def _tag_retry_list(self, cx, batch_id, retry_list):
+        """Tag list of (ev_id, retry_time) for retry with one call. (internal)"""
+        ids = [ev_id for ev_id, retry_time in retry_list]
+        secs = [int(retry_time) for ev_id, retry_time in retry_list]
+        cx.execute("select pgq.event_retry_list(%s, %s::int8[], %s::int4[])",
+                    [batch_id, ids, secs])
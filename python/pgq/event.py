@@ -2,7 +2,7 @@
 """PgQ event container.
 """
 
-__all__ = ['Event']
+__all__ = ['Event', 'EVENT_FIELDS', 'FieldPositions']
 
 _fldmap = {
         'ev_id': 'ev_id',
@@ -28,20 +28,60 @@ _fldmap = {
         'retry': 'ev_retry',
 }
 
+# column order in pgq.get_batch_events() and pgq.get_batch_cursor()
+EVENT_FIELDS = ('ev_id', 'ev_time', 'ev_txid', 'ev_retry', 'ev_type', 'ev_data',
+                'ev_extra1', 'ev_extra2', 'ev_extra3', 'ev_extra4')
+
+class FieldPositions(dict):
+    """Maps event field names and their short aliases
+    to positions in plain row tuple.
+
+    >>> pos = FieldPositions(['ev_id', 'ev_type', 'ev_data'])
+    >>> pos['ev_type'], pos['type'], pos['data']
+    (1, 1, 2)
+    >>> pos.fields
+    ('ev_id', 'ev_type', 'ev_data')
+    >>> 'extra1' in pos
+    False
+    """
+    def __init__(self, fields):
+        dict.__init__(self)
+        self.fields = tuple(fields)
+        for i, f in enumerate(self.fields):
+            self[f] = i
+        for alias, f in _fldmap.items():
+            if f in self and alias not in self:
+                self[alias] = self[f]
+
 class Event(object):
     """Event data for consumers.
 
     Will be removed from the queue by default.
+
+    Row can be dict-like or plain tuple, in latter case
+    fldpos must be FieldPositions for the tuple.
+
+    >>> row = (1, None, 2, None, 'ins', 'data', 'tbl', None, None, None)
+    >>> ev = Event('q', row, FieldPositions(EVENT_FIELDS))
+    >>> ev.type, ev.ev_data, ev['ev_extra1'], ev.get('ev_extra2', 'x')
+    ('ins', 'data', 'tbl', None)
+    >>> str(ev)
+    '<id=1 type=ins data=data e1=tbl e2=None e3=None e4=None>'
+    >>> ev.items()[:2]
+    [('ev_id', 1), ('ev_time', None)]
     """
-    __slots__ = ('_event_row', 'retry_time', 'queue_name')
+    __slots__ = ('_event_row', '_fldpos', 'retry_time', 'queue_name')
 
-    def __init__(self, queue_name, row):
+    def __init__(self, queue_name, row, fldpos = None):
         self._event_row = row
+        self._fldpos = fldpos
         self.retry_time = 60
         self.queue_name = queue_name
 
     def __getattr__(self, key):
-        return self._event_row[_fldmap[key]]
+        if self._fldpos is None:
+            return self._event_row[_fldmap[key]]
+        return self._event_row[self._fldpos[key]]
 
     # would be better in RetriableEvent only since we don't care but
     # unfortunately it needs to be defined here due to compatibility concerns
@@ -49,16 +89,56 @@ class Event(object):
         pass
 
     # be also dict-like
-    def __getitem__(self, k): return self._event_row.__getitem__(k)
-    def __contains__(self, k): return self._event_row.__contains__(k)
-    def get(self, k, d=None): return self._event_row.get(k, d)
-    def has_key(self, k): return self._event_row.has_key(k)
-    def keys(self): return self._event_row.keys()
-    def values(self): return self._event_row.keys()
-    def items(self): return self._event_row.items()
-    def iterkeys(self): return self._event_row.iterkeys()
-    def itervalues(self): return self._event_row.itervalues()
+    def __getitem__(self, k):
+        if self._fldpos is None:
+            return self._event_row.__getitem__(k)
+        return self._event_row[self._fldpos[k]]
+
+    def __contains__(self, k):
+        if self._fldpos is None:
+            return self._event_row.__contains__(k)
+        return k in self._fldpos
+
+    def get(self, k, d=None):
+        if self._fldpos is None:
+            return self._event_row.get(k, d)
+        pos = self._fldpos.get(k)
+        if pos is None:
+            return d
+        return self._event_row[pos]
+
+    def has_key(self, k):
+        return self.__contains__(k)
+
+    def keys(self):
+        if self._fldpos is None:
+            return self._event_row.keys()
+        return list(self._fldpos.fields)
+
+    def values(self):
+        if self._fldpos is None:
+            return self._event_row.keys()
+        return list(self._event_row)
+
+    def items(self):
+        if self._fldpos is None:
+            return self._event_row.items()
+        return zip(self._fldpos.fields, self._event_row)
+
+    def iterkeys(self):
+        if self._fldpos is None:
+            return self._event_row.iterkeys()
+        return iter(self._fldpos.fields)
+
+    def itervalues(self):
+        if self._fldpos is None:
+            return self._event_row.itervalues()
+        return iter(self._event_row)
 
     def __str__(self):
         return "<id=%d type=%s data=%s e1=%s e2=%s e3=%s e4=%s>" % (
                 self.id, self.type, self.data, self.extra1, self.extra2, self.extra3, self.extra4)
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
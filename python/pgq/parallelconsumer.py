@@ -0,0 +1,180 @@
+"""PgQ consumer that processes events in parallel threads.
+
+For consumers that spend most of the time waiting on external
+services in process_event().
+"""
+
+import sys, threading, Queue
+
+import skytools
+
+from pgq.consumer import Consumer
+
+__all__ = ['ParallelConsumer']
+
+
+class ParallelConsumer(Consumer):
+    """Consumer that dispatches events of a batch to pool of worker threads.
+
+    User code should override process_event(), which is called
+    from worker threads.  Events can be tagged with tag_done() /
+    tag_retry() as usual.  The batch is finished only after all
+    its events have been processed.
+
+    If parallel_key is set, events with same key value are processed
+    by same worker, in queue order.
+
+    Config template::
+
+        ## Parameters for pgq.ParallelConsumer ##
+
+        # number of worker threads calling process_event()
+        #parallel_workers = 4
+
+        # event field to partition events on: ev_type, ev_extra1, etc.
+        # use data:NAME to take the field from urlencoded ev_data.
+        # if empty, events are processed without ordering guarantees
+        #parallel_key =
+
+        # max number of events waiting per worker
+        #parallel_queue_size = 100
+    """
+
+    _worker_list = None
+    _worker_queues = None
+    _worker_db = None
+    _worker_error = None
+
+    def __init__(self, service_name, db_name, args):
+        Consumer.__init__(self, service_name, db_name, args)
+
+        self._pending = 0
+        self._pending_cond = threading.Condition()
+
+    def reload(self):
+        Consumer.reload(self)
+
+        self.parallel_workers = self.cf.getint("parallel_workers", 4)
+        if self.parallel_workers < 1:
+            raise skytools.UsageError("parallel_workers must be positive")
+        self.parallel_queue_size = self.cf.getint("parallel_queue_size", 100)
+
+        self.parallel_key = self.cf.get("parallel_key", "")
+        self.parallel_key_data = None
+        if self.parallel_key.startswith("data:"):
+            self.parallel_key_data = self.parallel_key[5:]
+
+        # worker count or queue layout may have changed
+        if self._worker_list:
+            self._stop_workers()
+
+    def shutdown(self):
+        self._stop_workers()
+        Consumer.shutdown(self)
+
+    def process_batch(self, db, batch_id, event_list):
+        """Dispatch events to workers, wait until all are processed."""
+
+        if not self._worker_list:
+            self._start_workers()
+
+        self._worker_error = None
+        self._worker_db = db
+        try:
+            for ev in event_list:
+                if self._worker_error:
+                    break
+                self._dispatch(ev)
+        finally:
+            self._wait_pending()
+
+        err = self._worker_error
+        if err:
+            self._worker_error = None
+            raise err[0], err[1], err[2]
+
+    def get_event_key(self, ev):
+        """Returns partitioning key for event.
+
+        Can be overridden by user code.
+        """
+        if self.parallel_key_data is not None:
+            data = skytools.db_urldecode(ev.data or '')
+            return data.get(self.parallel_key_data)
+        return ev[self.parallel_key]
+
+    def _dispatch(self, ev):
+        """Put event into worker queue. (internal)"""
+        if self.parallel_key:
+            key = self.get_event_key(ev)
+            wq = self._worker_queues[hash(key) % len(self._worker_queues)]
+        else:
+            wq = self._worker_queues[0]
+
+        self._pending_cond.acquire()
+        self._pending += 1
+        self._pending_cond.release()
+
+        wq.put(ev)
+
+    def _wait_pending(self):
+        """Wait until workers have processed all dispatched events. (internal)"""
+        self._pending_cond.acquire()
+        try:
+            while self._pending > 0:
+                self._pending_cond.wait(1)
+        finally:
+            self._pending_cond.release()
+
+    def _start_workers(self):
+        """Launch worker threads. (internal)
+
+        Without parallel_key, all workers share single queue.
+        """
+        qsize = self.parallel_queue_size
+        if self.parallel_key:
+            self._worker_queues = [Queue.Queue(qsize) for i in range(self.parallel_workers)]
+        else:
+            self._worker_queues = [Queue.Queue(qsize * self.parallel_workers)]
+
+        self._worker_list = []
+        for i in range(self.parallel_workers):
+            wq = self._worker_queues[i % len(self._worker_queues)]
+            th = threading.Thread(target = self._worker_main, args = (wq,),
+                                  name = 'worker-%d' % i)
+            th.setDaemon(True)
+            th.start()
+            self._worker_list.append(th)
+        self.log.debug("Started %d worker threads", len(self._worker_list))
+
+    def _stop_workers(self):
+        """Stop worker threads. (internal)"""
+        if not self._worker_list:
+            return
+        for i in range(len(self._worker_list)):
+            self._worker_queues[i % len(self._worker_queues)].put(None)
+        for th in self._worker_list:
+            th.join()
+        self._worker_list = None
+        self._worker_queues = None
+
+    def _worker_main(self, wq):
+        """Worker thread main loop. (internal)"""
+        while 1:
+            ev = wq.get()
+            if ev is None:
+                break
+            try:
+                # skip rest of events after failure
+                if not self._worker_error:
+                    self.process_event(self._worker_db, ev)
+            except:
+                if not self._worker_error:
+                    self._worker_error = sys.exc_info()
+            self._pending_cond.acquire()
+            try:
+                self._pending -= 1
+                if self._pending == 0:
+                    self._pending_cond.notifyAll()
+            finally:
+                self._pending_cond.release()
@@ -27,6 +27,10 @@ _fldmap = {
 }
 
 def bulk_insert_events(curs, rows, fields, queue_name):
+    """Insert rows into queue with COPY.
+
+    Rows can be any iterable, they are streamed to database.
+    """
     q = "select pgq.current_event_table(%s)"
     curs.execute(q, [queue_name])
     tbl = curs.fetchone()[0]
@@ -37,6 +37,9 @@ _symbols = {
     # skytools.hashtext
     'hashtext_old': 'skytools.hashtext:hashtext_old',
     'hashtext_new': 'skytools.hashtext:hashtext_new',
+    # skytools.histogram
+    'Histogram': 'skytools.histogram:Histogram',
+    'PhaseStats': 'skytools.histogram:PhaseStats',
     # skytools.natsort
     'natsort': 'skytools.natsort:natsort',
     'natsort_icase': 'skytools.natsort:natsort_icase',
@@ -56,6 +59,10 @@ _symbols = {
     'parse_statements': 'skytools.parsing:parse_statements',
     'parse_tabbed_table': 'skytools.parsing:parse_tabbed_table',
     'sql_tokenizer': 'skytools.parsing:sql_tokenizer',
+    # skytools.profiler
+    'CallProfiler': 'skytools.profiler:CallProfiler',
+    'StackSampler': 'skytools.profiler:StackSampler',
+    'format_collapsed': 'skytools.profiler:format_collapsed',
     # skytools.psycopgwrapper
     'connect_database': 'skytools.psycopgwrapper:connect_database',
     'DBError': 'skytools.psycopgwrapper:DBError',
@@ -74,6 +81,7 @@ _symbols = {
     'run_query_row': 'skytools.querybuilder:run_query_row',
     # skytools.quoting
     'db_urldecode': 'skytools.quoting:db_urldecode',
+    'db_urldecode_batch': 'skytools.quoting:db_urldecode_batch',
     'db_urlencode': 'skytools.quoting:db_urlencode',
     'json_decode': 'skytools.quoting:json_decode',
     'json_encode': 'skytools.quoting:json_encode',
@@ -106,6 +114,8 @@ _symbols = {
     # skytools.sqltools
     'dbdict': 'skytools.sqltools:dbdict',
     'CopyPipe': 'skytools.sqltools:CopyPipe',
+    'CopyRelay': 'skytools.sqltools:CopyRelay',
+    'CopyStream': 'skytools.sqltools:CopyStream',
     'DBFunction': 'skytools.sqltools:DBFunction',
     'DBLanguage': 'skytools.sqltools:DBLanguage',
     'DBObject': 'skytools.sqltools:DBObject',
@@ -161,8 +171,10 @@ elif 1:
     from skytools.fileutil import *
     from skytools.gzlog import *
     from skytools.hashtext import *
+    from skytools.histogram import *
     from skytools.natsort import *
     from skytools.parsing import *
+    from skytools.profiler import *
     from skytools.psycopgwrapper import *
     from skytools.querybuilder import *
     from skytools.skylog import *
@@ -183,8 +195,10 @@ else:
     import skytools.fileutil
     import skytools.gzlog
     import skytools.hashtext
+    import skytools.histogram
     import skytools.natsort
     import skytools.parsing
+    import skytools.profiler
     import skytools.psycopgwrapper
     import skytools.querybuilder
     import skytools.quoting
@@ -201,8 +215,10 @@ else:
             + skytools.fileutil.__all__
             + skytools.gzlog.__all__
             + skytools.hashtext.__all__
+            + skytools.histogram.__all__
             + skytools.natsort.__all__
             + skytools.parsing.__all__
+            + skytools.profiler.__all__
             + skytools.psycopgwrapper.__all__
             + skytools.querybuilder.__all__
             + skytools.quoting.__all__
@@ -9,7 +9,7 @@ import urllib, re
 
 __all__ = [
     "quote_literal", "quote_copy", "quote_bytea_raw",
-    "db_urlencode", "db_urldecode", "unescape",
+    "db_urlencode", "db_urldecode", "db_urldecode_batch", "unescape",
     "unquote_literal",
 ]
 
@@ -118,6 +118,48 @@ def db_urldecode(qs):
             res[name] = urllib.unquote_plus(pair[1])
     return res
 
+def db_urldecode_batch(qs_list):
+    """Database specific urldecode for list of strings.
+
+    Returns tuple (keys, columns), where columns[i][n] is value
+    of keys[i] in n-th string.  Missing keys and keys without '='
+    are decoded as None.
+
+    Python implementation.
+    """
+
+    if not isinstance(qs_list, (list, tuple)):
+        qs_list = list(qs_list)
+    nrows = len(qs_list)
+    keys = []
+    columns = []
+    key_map = {}
+    raw_map = {}
+    for row, qs in enumerate(qs_list):
+        for elem in qs.split('&'):
+            if not elem:
+                continue
+            pair = elem.split('=', 1)
+
+            # decode each distinct key only once
+            try:
+                idx = raw_map[pair[0]]
+            except KeyError:
+                name = intern(str(urllib.unquote_plus(pair[0])))
+                idx = key_map.get(name)
+                if idx is None:
+                    idx = len(keys)
+                    keys.append(name)
+                    columns.append([None] * nrows)
+                    key_map[name] = idx
+                raw_map[pair[0]] = idx
+
+            if len(pair) == 1:
+                columns[idx][row] = None
+            else:
+                columns[idx][row] = urllib.unquote_plus(pair[1])
+    return keys, columns
+
 #
 # Remove C-like backslash escapes
 #
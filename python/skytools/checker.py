@@ -3,7 +3,7 @@
 """Catch moment when tables are in sync on master and slave.
 """
 
-import sys, time, os, subprocess
+import sys, time, os, tempfile
 
 import pkgloader
 pkgloader.require('skytools', '3.0')
@@ -26,8 +26,9 @@ class TableRepair:
         self.total_dst = 0
         self.pkey_list = []
         self.common_fields = []
+        self.key_order = []
         self.apply_fixes = False
-        self.apply_cursor = None
+        self.apply_file = None
 
     def do_repair(self, src_db, dst_db, where, pfx = 'repair', apply_fixes = False):
         """Actual comparison."""
@@ -37,60 +38,54 @@ class TableRepair:
         src_curs = src_db.cursor()
         dst_curs = dst_db.cursor()
 
+        # dst_curs is busy during compare, so fixes are
+        # spooled to temp file and applied afterwards
         self.apply_fixes = apply_fixes
         if apply_fixes:
-            self.apply_cursor = dst_curs
+            self.apply_file = tempfile.TemporaryFile()
 
         self.log.info('Checking %s' % self.table_name)
 
         copy_tbl = self.gen_copy_tbl(src_curs, dst_curs, where)
 
-        dump_src = "%s.%s.src" % (pfx, self.table_name)
-        dump_dst = "%s.%s.dst" % (pfx, self.table_name)
         fix = "%s.%s.fix" % (pfx, self.table_name)
 
-        self.log.info("Dumping src table: %s" % self.table_name)
-        self.dump_table(copy_tbl, src_curs, dump_src)
+        # rows are streamed in pkey order and merged, no local dumps
+        src_stream = skytools.CopyStream(src_curs, copy_tbl)
+        src_stream.start()
+        try:
+            dst_stream = skytools.CopyStream(dst_curs, copy_tbl)
+            dst_stream.start()
+            try:
+                self.dump_compare(src_stream, dst_stream, fix)
+            finally:
+                dst_stream.close()
+        finally:
+            src_stream.close()
         src_db.commit()
-        self.log.info("Dumping dst table: %s" % self.table_name)
-        self.dump_table(copy_tbl, dst_curs, dump_dst)
-        dst_db.commit()
-
-        self.log.info("Sorting src table: %s" % self.table_name)
-        self.do_sort(dump_src, dump_src + '.sorted')
 
-        self.log.info("Sorting dst table: %s" % self.table_name)
-        self.do_sort(dump_dst, dump_dst + '.sorted')
-
-        self.dump_compare(dump_src + ".sorted", dump_dst + ".sorted", fix)
+        if apply_fixes:
+            try:
+                self.apply_spooled(dst_curs)
+            finally:
+                self.apply_file.close()
+                self.apply_file = None
+        dst_db.commit()
 
-        os.unlink(dump_src)
-        os.unlink(dump_dst)
-        os.unlink(dump_src + ".sorted")
-        os.unlink(dump_dst + ".sorted")
+    def apply_spooled(self, curs):
+        """Execute fixes from spool file.
 
-        if apply_fixes:
-            dst_db.commit()
-
-    def do_sort(self, src, dst):
-        p = subprocess.Popen(["sort", "--version"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        s_ver = p.communicate()[0]
-        del p
-
-        xenv = os.environ.copy()
-        xenv['LANG'] = 'C'
-        xenv['LC_ALL'] = 'C'
-
-        cmdline = ['sort', '-T', '.']
-        if s_ver.find("coreutils") > 0:
-            cmdline.append('-S')
-            cmdline.append('30%')
-        cmdline.append('-o')
-        cmdline.append(dst)
-        cmdline.append(src)
-        p = subprocess.Popen(cmdline, env = xenv)
-        if p.wait() != 0:
-            raise Exception('sort failed')
+        Values may contain newlines, so each statement
+        is prefixed with its length.
+        """
+        f = self.apply_file
+        f.seek(0)
+        while 1:
+            ln = f.readline()
+            if not ln:
+                break
+            q = f.read(int(ln))
+            curs.execute(q)
 
     def gen_copy_tbl(self, src_curs, dst_curs, where):
         """Create COPY expession from common fields."""
@@ -115,22 +110,32 @@ class TableRepair:
 
         fqlist = [skytools.quote_ident(col) for col in field_list]
 
+        # integer keys are ordered by value, others as text in C collation,
+        # which sorts same as python str
+        q = "select a.attname, t.typname from pg_catalog.pg_attribute a, pg_catalog.pg_type t"\
+            " where a.attrelid = %s::regclass and a.attnum > 0 and t.oid = a.atttypid"
+        src_curs.execute(q, [self.fq_table_name])
+        typemap = dict(src_curs.fetchall())
+        self.key_order = []
+        order = []
+        for k in self.pkey_list:
+            is_int = typemap.get(k) in ('int2', 'int4', 'int8')
+            self.key_order.append(is_int)
+            if is_int:
+                order.append(skytools.quote_ident(k))
+            else:
+                order.append('%s::text collate "C"' % skytools.quote_ident(k))
+
         tbl_expr = "select %s from %s" % (",".join(fqlist), self.fq_table_name)
         if where:
             tbl_expr += ' where ' + where
+        tbl_expr += ' order by ' + ",".join(order)
         tbl_expr = "COPY (%s) TO STDOUT" % tbl_expr
 
         self.log.debug("using copy expr: %s" % tbl_expr)
 
         return tbl_expr
 
-    def dump_table(self, copy_cmd, curs, fn):
-        """Dump table to disk."""
-        f = open(fn, "w", 64*1024)
-        curs.copy_expert(copy_cmd, f)
-        self.log.info('%s: Got %d bytes' % (self.table_name, f.tell()))
-        f.close()
-
     def get_row(self, ln):
         """Parse a row into dict."""
         if not ln:
@@ -141,11 +146,9 @@ class TableRepair:
             row[self.common_fields[i]] = t[i]
         return row
 
-    def dump_compare(self, src_fn, dst_fn, fix):
-        """Dump + compare single table."""
-        self.log.info("Comparing dumps: %s" % self.table_name)
-        f1 = open(src_fn, "r", 64*1024)
-        f2 = open(dst_fn, "r", 64*1024)
+    def dump_compare(self, f1, f2, fix):
+        """Compare ordered row streams of single table."""
+        self.log.info("Comparing rows: %s" % self.table_name)
         src_ln = f1.readline()
         dst_ln = f2.readline()
         if src_ln: self.total_src += 1
@@ -235,7 +238,7 @@ class TableRepair:
         open(fn, "a").write("%s\n" % q)
 
         if self.apply_fixes:
-            self.apply_cursor.execute(q)
+            self.apply_file.write("%d\n%s" % (len(q), q))
 
     def addeq(self, list, f, v):
         """Add quoted SET."""
@@ -293,9 +296,12 @@ class TableRepair:
         elif dst_row is None:
             return -1
 
-        for k in self.pkey_list:
-            v1 = src_row[k]
-            v2 = dst_row[k]
+        for i, k in enumerate(self.pkey_list):
+            v1 = skytools.unescape_copy(src_row[k])
+            v2 = skytools.unescape_copy(dst_row[k])
+            if self.key_order[i]:
+                v1 = int(v1)
+                v2 = int(v2)
             if v1 < v2:
                 return -1
             elif v1 > v2:
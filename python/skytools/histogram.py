@@ -0,0 +1,150 @@
+"""Latency histograms with bounded memory.
+
+>>> ps = PhaseStats()
+>>> for i in range(1, 101):
+...     ps.add('fetch', i / 1000.0)
+>>> ps.add('commit', 0.25)
+>>> print ps.format_prom('pgq_phase_seconds', {'job': 'c1'}),
+pgq_phase_seconds{job="c1",phase="commit",quantile="0.5"} 0.25
+pgq_phase_seconds{job="c1",phase="commit",quantile="0.9"} 0.25
+pgq_phase_seconds{job="c1",phase="commit",quantile="0.99"} 0.25
+pgq_phase_seconds{job="c1",phase="commit",quantile="1"} 0.25
+pgq_phase_seconds_count{job="c1",phase="commit"} 1
+pgq_phase_seconds_sum{job="c1",phase="commit"} 0.25
+pgq_phase_seconds{job="c1",phase="fetch",quantile="0.5"} 0.0501755
+pgq_phase_seconds{job="c1",phase="fetch",quantile="0.9"} 0.0880635
+pgq_phase_seconds{job="c1",phase="fetch",quantile="0.99"} 0.1
+pgq_phase_seconds{job="c1",phase="fetch",quantile="1"} 0.1
+pgq_phase_seconds_count{job="c1",phase="fetch"} 100
+pgq_phase_seconds_sum{job="c1",phase="fetch"} 5.05
+"""
+
+import socket
+
+import skytools
+
+__all__ = ['Histogram', 'PhaseStats']
+
+class Histogram(object):
+    """Log-linear histogram of durations, in HDR histogram style.
+
+    Values are stored as microseconds with sub_bits bits of
+    precision, so memory use does not depend on number of samples.
+
+    >>> h = Histogram()
+    >>> for v in (0.000001, 0.001, 0.002, 0.003, 1.5):
+    ...     h.add(v)
+    >>> h.count, h.min, h.max
+    (5, 1e-06, 1.5)
+    >>> h.percentile(50), h.percentile(100)
+    (0.0020155, 1.5)
+    >>> len(h.buckets)
+    5
+    """
+
+    def __init__(self, sub_bits = 5):
+        self.sub_bits = sub_bits
+        self.reset()
+
+    def reset(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, secs):
+        """Add duration in seconds."""
+        us = int(secs * 1000000)
+        if us < 0:
+            us = 0
+        # keep sub_bits of precision; int.bit_length() needs 2.7
+        shift = 0
+        while (us >> shift) >> self.sub_bits:
+            shift += 1
+        key = (shift, us >> shift)
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+
+        self.count += 1
+        self.total += secs
+        if self.min is None or secs < self.min:
+            self.min = secs
+        if self.max is None or secs > self.max:
+            self.max = secs
+
+    def percentile(self, pct):
+        """Return approximate value at percentile."""
+        if not self.count:
+            return None
+        if pct >= 100:
+            return self.max
+        limit = self.count * pct / 100.0
+        seen = 0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if seen >= limit:
+                shift, val = key
+                lo = val << shift
+                hi = ((val + 1) << shift) - 1
+                res = (lo + hi) / 2000000.0
+                return min(max(res, self.min), self.max)
+        return self.max
+
+
+class PhaseStats(object):
+    """Set of histograms, one per named phase."""
+
+    quantiles = (50, 90, 99, 100)
+
+    def __init__(self):
+        self.phases = {}
+
+    def add(self, phase, secs):
+        try:
+            h = self.phases[phase]
+        except KeyError:
+            h = self.phases[phase] = Histogram()
+        h.add(secs)
+
+    def reset(self):
+        self.phases = {}
+
+    def format_prom(self, name, labels = None):
+        """Return stats in Prometheus text format."""
+        lbl = ''
+        if labels:
+            lst = ['%s="%s"' % (k, labels[k]) for k in sorted(labels)]
+            lbl = ','.join(lst) + ','
+        lines = []
+        for phase in sorted(self.phases):
+            h = self.phases[phase]
+            plbl = '%sphase="%s"' % (lbl, phase)
+            for q in self.quantiles:
+                qs = '%g' % (q / 100.0)
+                lines.append('%s{%s,quantile="%s"} %g' % (name, plbl, qs, h.percentile(q)))
+            lines.append('%s_count{%s} %d' % (name, plbl, h.count))
+            lines.append('%s_sum{%s} %g' % (name, plbl, h.total))
+        return ''.join([ln + '\n' for ln in lines])
+
+    def write_file(self, fn, name, labels = None):
+        """Write stats into file, for scraping."""
+        skytools.write_atomic(fn, self.format_prom(name, labels))
+
+    def send_udp(self, host, port, name, labels = None, maxlen = 1400):
+        """Send stats as UDP datagrams, split on line boundary."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            buf = ''
+            for ln in self.format_prom(name, labels).splitlines(True):
+                if buf and len(buf) + len(ln) > maxlen:
+                    sock.sendto(buf, (host, port))
+                    buf = ''
+                buf += ln
+            if buf:
+                sock.sendto(buf, (host, port))
+        finally:
+            sock.close()
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
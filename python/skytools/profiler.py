@@ -0,0 +1,104 @@
+"""On-demand profilers for long-running scripts.
+
+StackSampler takes periodic snapshots of all thread stacks and
+writes them in collapsed-stack format, suitable for flamegraph.pl.
+CallProfiler is wrapper around cProfile with same interface.
+
+>>> print format_collapsed({'main;work;fetch': 3, 'main;sleep': 10, 'main;work': 1}),
+main;sleep 10
+main;work 1
+main;work;fetch 3
+"""
+
+import sys
+import os
+import time
+import threading
+
+import skytools
+
+__all__ = ['StackSampler', 'CallProfiler', 'format_collapsed']
+
+def format_collapsed(counts):
+    """Return stack counts in collapsed-stack format."""
+    lines = ['%s %d\n' % (k, counts[k]) for k in sorted(counts)]
+    return ''.join(lines)
+
+class StackSampler(object):
+    """Sample stacks of all threads from background thread.
+
+    Overhead depends only on sampling interval, not on amount
+    of function calls, so it can be used on production process.
+    """
+    suffix = '.folded'
+
+    def __init__(self, interval = 0.01, max_depth = 100):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.counts = {}
+        self.samples = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target = self.run_sampler, name = 'stack-sampler')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def run_sampler(self):
+        my_id = threading.currentThread().ident
+        while self.running:
+            time.sleep(self.interval)
+            names = {}
+            for th in threading.enumerate():
+                names[th.ident] = th.name
+            for tid, frame in sys._current_frames().items():
+                if tid != my_id:
+                    self.add_frame(names.get(tid, 'thread-%s' % tid), frame)
+            self.samples += 1
+
+    def add_frame(self, thread_name, frame):
+        stack = []
+        while frame is not None and len(stack) < self.max_depth:
+            co = frame.f_code
+            fn = os.path.basename(co.co_filename)
+            stack.append('%s (%s:%d)' % (co.co_name, fn, co.co_firstlineno))
+            frame = frame.f_back
+        stack.append(thread_name)
+        stack.reverse()
+        key = ';'.join(stack)
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def write(self, fn):
+        skytools.write_atomic(fn, format_collapsed(self.counts))
+
+class CallProfiler(object):
+    """Deterministic profiling of main thread with cProfile.
+
+    Result is written in pstats format.
+    """
+    suffix = '.prof'
+
+    def __init__(self):
+        import cProfile
+        self.prof = cProfile.Profile()
+
+    def start(self):
+        self.prof.enable()
+
+    def stop(self):
+        self.prof.disable()
+
+    def write(self, fn):
+        self.prof.dump_stats(fn)
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
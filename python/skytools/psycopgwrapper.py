@@ -7,6 +7,8 @@ Connection object methods::
 
     .cursor()
 
+    .cursor(plain = True)   # rows as plain tuples
+
     .commit()
 
     .rollback()
@@ -107,14 +109,20 @@ class _CompatCursor(psycopg2.extras.DictCursor):
 class _CompatConnection(psycopg2.extensions.connection):
     """Connection object that uses _CompatCursor."""
     my_name = '?'
-    def cursor(self, name = None):
+    def cursor(self, name = None, plain = False):
+        """Returns _CompatCursor, or regular cursor
+        that returns plain tuples if plain is set."""
+        if plain:
+            factory = psycopg2.extensions.cursor
+        else:
+            factory = _CompatCursor
         if name:
             return psycopg2.extensions.connection.cursor(self,
-                    cursor_factory = _CompatCursor,
+                    cursor_factory = factory,
                     name = name)
         else:
             return psycopg2.extensions.connection.cursor(self,
-                    cursor_factory = _CompatCursor)
+                    cursor_factory = factory)
 
 def connect_database(connstr, keepalive = True,
                      tcp_keepidle = 4 * 60,     # 7200
@@ -7,7 +7,7 @@ import re
 __all__ = [
     # _pyqoting / _cquoting
     "quote_literal", "quote_copy", "quote_bytea_raw",
-    "db_urlencode", "db_urldecode", "unescape",
+    "db_urlencode", "db_urldecode", "db_urldecode_batch", "unescape",
     "unquote_literal",
     # local
     "quote_bytea_literal", "quote_bytea_copy", "quote_statement",
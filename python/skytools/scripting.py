@@ -225,6 +225,22 @@ class BaseScript(object):
 
         # how many seconds to sleep after catching a exception
         #exception_sleep = 20
+
+        # on-demand profiling, started with SIGUSR2 (--profile)
+        # or profile_start = 1.  Result is written next to pidfile.
+        #   sample   - stack sampler, collapsed-stack format (.folded)
+        #   cprofile - cProfile of main thread, pstats format (.prof)
+        #profile_mode = sample
+
+        # profiling window length, in seconds and/or work() loops
+        #profile_seconds = 30
+        #profile_loops = 0
+
+        # sampling interval for sample mode
+        #profile_interval = 0.01
+
+        # start profiling on startup and on each reload
+        #profile_start = 0
     """
     service_name = None
     job_name = None
@@ -250,6 +266,14 @@ class BaseScript(object):
     # setup logger here, this allows override by subclass
     log = logging.getLogger('skytools.BaseScript')
 
+    # set when several scripts run in one process and logging
+    # is already set up by host, then scripts do not add handlers
+    shared_logging = 0
+
+    # active profiler, and request from signal handler to start one
+    profiler = None
+    profile_request = 0
+
     def __init__(self, service_name, args):
         """Script setup.
 
@@ -301,7 +325,8 @@ class BaseScript(object):
         self.reload()
 
         # init logging
-        _init_log(self.job_name, self.service_name, self.cf, self.log_level, self.go_daemon)
+        if not self.shared_logging:
+            _init_log(self.job_name, self.service_name, self.cf, self.log_level, self.go_daemon)
 
         # send signal, if needed
         if self.options.cmd == "kill":
@@ -310,6 +335,8 @@ class BaseScript(object):
             self.send_signal(signal.SIGINT)
         elif self.options.cmd == "reload":
             self.send_signal(signal.SIGHUP)
+        elif self.options.cmd == "profile":
+            self.send_signal(signal.SIGUSR2)
 
     def print_version(self):
         service = self.service_name
@@ -428,6 +455,9 @@ class BaseScript(object):
         g.add_option("-k", "--kill",
                      action="store_const", const="kill", dest="cmd",
                      help = "kill program immediately (send SIGTERM)")
+        g.add_option("", "--profile",
+                     action="store_const", const="profile", dest="cmd",
+                     help = "profile running process (send SIGUSR2)")
         p.add_option_group(g)
 
         return p
@@ -480,6 +510,14 @@ class BaseScript(object):
         self.exception_quiet = self.cf.getlist("exception_quiet", [])
         self.exception_grace = self.cf.getfloat("exception_grace", 5*60)
         self.exception_reset = self.cf.getfloat("exception_reset", 15*60)
+        self.profile_mode = self.cf.get("profile_mode", "sample")
+        self.profile_seconds = self.cf.getfloat("profile_seconds", 30)
+        self.profile_loops = self.cf.getint("profile_loops", 0)
+        self.profile_interval = self.cf.getfloat("profile_interval", 0.01)
+        if self.profile_mode not in ('sample', 'cprofile'):
+            raise UsageError("Unknown profile_mode: %s" % self.profile_mode)
+        if self.cf.getint("profile_start", 0):
+            self.profile_request = 1
 
     def hook_sighup(self, sig, frame):
         "Internal SIGHUP handler.  Minimal code here."
@@ -495,6 +533,10 @@ class BaseScript(object):
             sys.exit(1)
         self.last_sigint = t
 
+    def hook_sigusr2(self, sig, frame):
+        "Internal SIGUSR2 handler.  Minimal code here."
+        self.profile_request = 1
+
     def stat_get(self, key):
         """Reads a stat value."""
         try:
@@ -544,9 +586,17 @@ class BaseScript(object):
                 self.reload()
                 self.need_reload = 0
 
+            # start profiling, if requested
+            if self.profile_request:
+                self.profile_request = 0
+                self.start_profile()
+
             # do some work
             work = self.run_once()
 
+            if self.profiler:
+                self.check_profile()
+
             if not self.looping or self.loop_delay < 0:
                 break
 
@@ -561,9 +611,51 @@ class BaseScript(object):
                 else:
                     break
 
+        # write out partial profile
+        if self.profiler:
+            self.stop_profile()
+
         # run shutdown, safely?
         self.shutdown()
 
+    def start_profile(self):
+        """Start profiling window, unless already running."""
+        if self.profiler:
+            self.log.info("Profiling already active")
+            return
+        if not self.pidfile:
+            self.log.warning("No pidfile in config, cannot profile")
+            return
+        if self.profile_mode == 'cprofile':
+            self.profiler = skytools.CallProfiler()
+        else:
+            self.profiler = skytools.StackSampler(self.profile_interval)
+        self.profile_start_time = time.time()
+        self.profile_loop_count = 0
+        self.log.info("Profiling started: mode=%s", self.profile_mode)
+        self.profiler.start()
+
+    def check_profile(self):
+        """Stop profiling if window is over."""
+        self.profile_loop_count += 1
+        if self.profile_loops > 0 and self.profile_loop_count >= self.profile_loops:
+            self.stop_profile()
+        elif self.profile_seconds > 0 and time.time() - self.profile_start_time >= self.profile_seconds:
+            self.stop_profile()
+
+    def stop_profile(self):
+        """Stop profiler and write results next to pidfile."""
+        prof = self.profiler
+        self.profiler = None
+        prof.stop()
+        base = os.path.splitext(self.pidfile)[0]
+        fn = "%s.%s%s" % (base, time.strftime("%Y%m%d_%H%M%S"), prof.suffix)
+        try:
+            prof.write(fn)
+            self.log.info("Profile written to %s", fn)
+        except (IOError, OSError), d:
+            self.log.warning("Failed to write profile: %s", str(d))
+
     def run_once(self):
         state = self.run_func_safely(self.work, True)
 
@@ -678,6 +770,8 @@ class BaseScript(object):
             signal.signal(signal.SIGHUP, self.hook_sighup)
         if hasattr(signal, 'SIGINT'):
             signal.signal(signal.SIGINT, self.hook_sigint)
+        if hasattr(signal, 'SIGUSR2'):
+            signal.signal(signal.SIGUSR2, self.hook_sigusr2)
 
     def shutdown(self):
         """Will be called just after exiting main loop.
@@ -711,6 +805,10 @@ class DBScript(BaseScript):
         #connection_lifetime = 1200
     """
 
+    # if set, DBCachedConn-like objects are taken from there,
+    # allows sharing connections between scripts in one process
+    conn_pool = None
+
     def __init__(self, service_name, args):
         """Script setup.
 
@@ -791,7 +889,11 @@ class DBScript(BaseScript):
                 filtered_connstr = connstr[:pos] + ' [...]'
 
             self.log.debug("Connect '%s' to '%s'" % (cache, filtered_connstr))
-            dbc = DBCachedConn(cache, connstr, params['max_age'], setup_func = self.connection_hook)
+            if self.conn_pool is not None:
+                dbc = self.conn_pool.get_cached_conn(self, cache, connstr, params['max_age'],
+                                                     params['isolation_level'])
+            else:
+                dbc = DBCachedConn(cache, connstr, params['max_age'], setup_func = self.connection_hook)
             self.db_cache[cache] = dbc
 
         clist = []
@@ -846,16 +948,30 @@ class DBScript(BaseScript):
         else:
             BaseScript.exception_hook(self, d, emsg)
 
-    def sleep(self, secs):
-        """Make script sleep for some amount of time."""
+    def check_listen(self):
+        """Check connections that listen for notifications.
+
+        Returns tuple of (number of received notifications, list of fds to wait on).
+        """
+        cnt = 0
         fdlist = []
         for dbname in self._listen_map.keys():
             if dbname not in self.db_cache:
                 continue
-            fd = self.db_cache[dbname].fileno()
+            dbc = self.db_cache[dbname]
+            cnt += dbc.drain_notifies()
+            fd = dbc.fileno()
             if fd is None:
                 continue
             fdlist.append(fd)
+        return cnt, fdlist
+
+    def sleep(self, secs):
+        """Make script sleep for some amount of time."""
+        cnt, fdlist = self.check_listen()
+        if cnt:
+            # notification arrived while working, dont miss it
+            return
 
         if not fdlist:
             return BaseScript.sleep(self, secs)
@@ -871,6 +987,8 @@ class DBScript(BaseScript):
         except select.error, d:
             self.log.info('wait canceled')
 
+        self.check_listen()
+
     def _exec_cmd(self, curs, sql, args, quiet = False, prefix = None):
         """Internal tool: Run SQL on cursor."""
         if self.options.verbose:
@@ -1077,6 +1195,18 @@ class DBCachedConn(object):
         # done
         return self.conn
 
+    def drain_notifies(self):
+        """Read and forget pending notifications.
+
+        Returns number of notifications received.
+        """
+        if not self.conn:
+            return 0
+        self.conn.poll()
+        cnt = len(self.conn.notifies)
+        del self.conn.notifies[:]
+        return cnt
+
     def _sync_listen(self, new_clist):
         if not new_clist and not self.listen_channel_list:
             return
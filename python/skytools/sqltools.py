@@ -2,6 +2,10 @@
 """Database tools."""
 
 import os
+import sys
+import itertools
+import threading
+import Queue
 from cStringIO import StringIO
 import skytools
 
@@ -15,7 +19,7 @@ __all__ = [
     "get_table_columns", "exists_schema", "exists_table", "exists_type",
     "exists_sequence", "exists_temp_table", "exists_view",
     "exists_function", "exists_language", "Snapshot", "magic_insert",
-    "CopyPipe", "full_copy", "DBObject", "DBSchema", "DBTable", "DBFunction",
+    "CopyPipe", "CopyRelay", "CopyStream", "full_copy", "DBObject", "DBSchema", "DBTable", "DBFunction",
     "DBLanguage", "db_install", "installer_find_file", "installer_apply_file",
     "dbdict", "mk_insert_sql", "mk_update_sql", "mk_delete_sql",
 ]
@@ -279,24 +283,83 @@ def _gen_list_insert(tbl, row, fields, qfields):
     fmt = "insert into %s (%s) values (%s);"
     return fmt % (tbl, ",".join(qfields), ",".join(tmp))
 
-def magic_insert(curs, tablename, data, fields = None, use_insert = 0, quoted_table = False):
+class _CopyReader(object):
+    """File-like object that renders rows for COPY on demand.
+
+    Only rows needed for current read() are kept in memory.
+    """
+
+    def __init__(self, rows, row_func, qtablename, fields, qfields):
+        self.rows = rows
+        self.row_func = row_func
+        self.qtablename = qtablename
+        self.fields = fields
+        self.qfields = qfields
+        self.buf = ''
+
+    def _fill(self, size, stop_at_newline = False):
+        parts = [self.buf]
+        blen = len(self.buf)
+        while size < 0 or blen < size:
+            if stop_at_newline and blen > 0:
+                break
+            try:
+                row = self.rows.next()
+            except StopIteration:
+                break
+            ln = self.row_func(self.qtablename, row, self.fields, self.qfields) + "\n"
+            parts.append(ln)
+            blen += len(ln)
+        return ''.join(parts)
+
+    def read(self, size = -1):
+        data = self._fill(size)
+        if size < 0 or len(data) <= size:
+            self.buf = ''
+            return data
+        self.buf = data[size:]
+        return data[:size]
+
+    def readline(self, size = -1):
+        data = self._fill(size, True)
+        pos = data.find("\n") + 1
+        if pos <= 0 or (size >= 0 and pos > size):
+            return self.read(size)
+        self.buf = data[pos:]
+        return data[:pos]
+
+def magic_insert(curs, tablename, data, fields = None, use_insert = 0, quoted_table = False,
+                 chunk_size = 64*1024):
     r"""Copy/insert a list of dict/list data to database.
 
     If curs == None, then the copy or insert statements are returned
     as string.  For list of dict the field list is optional, as its
     possible to guess them from dict keys.
 
+    Data can be any iterable, eg. generator.  Rows are rendered
+    lazily, so only about chunk_size bytes of serialized data
+    is kept in memory at once.
+
     Example:
     >>> magic_insert(None, 'tbl', [[1, '1'], [2, '2']], ['col1', 'col2'])
     'COPY public.tbl (col1,col2) FROM STDIN;\n1\t1\n2\t2\n\\.\n'
+    >>> magic_insert(None, 'tbl', ({'a': i} for i in range(2)))
+    'COPY public.tbl (a) FROM STDIN;\n0\n1\n\\.\n'
+    >>> rdr = _CopyReader(iter([[1, 'a'], [2, 'b']]), _gen_list_copy, 'tbl', ['x', 'y'], [])
+    >>> rdr.read(3), rdr.readline(), rdr.read()
+    ('1\ta', '\n', '2\tb\n')
     """
-    if len(data) == 0:
+    rows = iter(data)
+    try:
+        first = rows.next()
+    except StopIteration:
         return
+    rows = itertools.chain([first], rows)
 
     # decide how to process
-    if hasattr(data[0], 'keys'):
+    if hasattr(first, 'keys'):
         if fields == None:
-            fields = data[0].keys()
+            fields = first.keys()
         if use_insert:
             row_func = _gen_dict_insert
         else:
@@ -315,6 +378,13 @@ def magic_insert(curs, tablename, data, fields = None, use_insert = 0, quoted_ta
     else:
         qtablename = skytools.quote_fqident(tablename)
 
+    # stream data to COPY
+    if curs != None and use_insert == 0:
+        rdr = _CopyReader(rows, row_func, qtablename, fields, qfields)
+        hdr = "%s (%s)" % (qtablename, ",".join(qfields))
+        curs.copy_from(rdr, hdr, size = chunk_size)
+        return
+
     # init processing
     buf = StringIO()
     if curs == None and use_insert == 0:
@@ -322,23 +392,25 @@ def magic_insert(curs, tablename, data, fields = None, use_insert = 0, quoted_ta
         buf.write(fmt % (qtablename, ",".join(qfields)))
 
     # process data
-    for row in data:
+    for row in rows:
         buf.write(row_func(qtablename, row, fields, qfields))
         buf.write("\n")
 
+        # send out inserts in chunks
+        if curs != None and buf.tell() >= chunk_size:
+            curs.execute(buf.getvalue())
+            buf.seek(0)
+            buf.truncate()
+
     # if user needs only string, return it
     if curs == None:
         if use_insert == 0:
             buf.write("\\.\n")
         return buf.getvalue()
 
-    # do the actual copy/inserts
-    if use_insert:
+    # do the actual inserts
+    if buf.tell() > 0:
         curs.execute(buf.getvalue())
-    else:
-        buf.seek(0)
-        hdr = "%s (%s)" % (qtablename, ",".join(qfields))
-        curs.copy_from(buf, hdr)
 
 #
 # Full COPY of table from one db to another
@@ -404,10 +476,239 @@ class CopyPipe(object):
         self.buf.truncate()
 
 
+class CopyRelay(object):
+    """Streams COPY data from source to destination concurrently.
+
+    Source COPY writes into it from current thread, destination
+    COPY reads from it in separate thread.  Data is passed in
+    chunks over bounded queue, so memory usage is limited
+    and neither side waits for the other to finish.
+    """
+
+    def __init__(self, dstcurs, sql_from, chunk_size = 64*1024, max_chunks = 16):
+        self.dstcurs = dstcurs
+        self.sql_from = sql_from
+        self.chunk_size = chunk_size
+        self.queue = Queue.Queue(max_chunks)
+        self.thread = None
+        self.error = None
+        # writer side
+        self.buf = []
+        self.buf_len = 0
+        # reader side
+        self.rbuf = ''
+        self.rpos = 0
+        # same hooks as in CopyPipe
+        self.write_hook = None
+        self.flush_hook = None
+        self.total_rows = 0
+        self.total_bytes = 0
+
+    def start(self):
+        """Launch destination COPY."""
+        self.thread = threading.Thread(target = self._copy_in, name = 'copy-relay')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _copy_in(self):
+        try:
+            self.dstcurs.copy_expert(self.sql_from, self)
+        except:
+            self.error = sys.exc_info()
+
+    def _put(self, chunk):
+        while 1:
+            if self.error:
+                raise self.error[0], self.error[1], self.error[2]
+            try:
+                self.queue.put(chunk, True, 1)
+                return
+            except Queue.Full:
+                pass
+
+    def write(self, data):
+        "New data from source COPY."
+        if self.write_hook:
+            data = self.write_hook(self, data)
+
+        self.total_bytes += len(data)
+        self.total_rows += data.count("\n")
+
+        self.buf.append(data)
+        self.buf_len += len(data)
+        if self.buf_len >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        "Pass buffered data to destination."
+
+        if self.flush_hook:
+            self.flush_hook(self)
+
+        if self.buf_len <= 0:
+            return
+        chunk = ''.join(self.buf)
+        self.buf = []
+        self.buf_len = 0
+        self._put(chunk)
+
+    def read(self, size = -1):
+        "Data for destination COPY, called from relay thread."
+        while self.rpos >= len(self.rbuf):
+            chunk = self.queue.get()
+            if chunk is None:
+                return ''
+            elif chunk is False:
+                raise Exception('source COPY failed')
+            self.rbuf = chunk
+            self.rpos = 0
+        if size < 0:
+            size = len(self.rbuf)
+        data = self.rbuf[self.rpos : self.rpos + size]
+        self.rpos += len(data)
+        return data
+
+    def finish(self):
+        "Source COPY done, wait until destination has everything."
+        self.flush()
+        self._put(None)
+        self.thread.join()
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def abort(self):
+        "Source COPY failed, make destination COPY fail too."
+        try:
+            self._put(False)
+        except Exception:
+            pass
+        self.thread.join()
+
+
+class CopyStream(object):
+    """Reads output of COPY TO as lines while COPY is running.
+
+    COPY runs in separate thread and passes data in chunks over
+    bounded queue, so large result can be processed row-by-row
+    with limited memory and without temp files.
+
+    Has readline() and iteration, like file opened for reading.
+    """
+
+    def __init__(self, curs, sql_to, chunk_size = 64*1024, max_chunks = 16):
+        self.curs = curs
+        self.sql_to = sql_to
+        self.chunk_size = chunk_size
+        self.queue = Queue.Queue(max_chunks)
+        self.thread = None
+        self.error = None
+        self.closed = False
+        # writer side
+        self.buf = []
+        self.buf_len = 0
+        # reader side
+        self.lines = []
+        self.lpos = 0
+        self.tail = ''
+        self.eof = False
+        self.total_rows = 0
+        self.total_bytes = 0
+
+    def start(self):
+        """Launch COPY."""
+        self.thread = threading.Thread(target = self._copy_out, name = 'copy-stream')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _copy_out(self):
+        try:
+            try:
+                self.curs.copy_expert(self.sql_to, self)
+                self.flush()
+            except:
+                self.error = sys.exc_info()
+        finally:
+            self._put(None)
+
+    def _put(self, chunk):
+        while 1:
+            if self.closed and chunk is not None:
+                raise Exception('copy stream closed')
+            try:
+                self.queue.put(chunk, True, 1)
+                return
+            except Queue.Full:
+                if self.closed:
+                    return
+
+    def write(self, data):
+        "New data from COPY, called from COPY thread."
+        self.total_bytes += len(data)
+        self.buf.append(data)
+        self.buf_len += len(data)
+        if self.buf_len >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.buf_len <= 0:
+            return
+        chunk = ''.join(self.buf)
+        self.buf = []
+        self.buf_len = 0
+        self._put(chunk)
+
+    def readline(self):
+        "Return next row with newline, or empty string at end."
+        while self.lpos >= len(self.lines):
+            if self.eof:
+                return ''
+            chunk = self.queue.get()
+            if chunk is None:
+                self.eof = True
+                self.thread.join()
+                if self.error:
+                    raise self.error[0], self.error[1], self.error[2]
+                self.lines = self.tail and [self.tail] or []
+                self.tail = ''
+            else:
+                self.lines = (self.tail + chunk).splitlines(True)
+                self.tail = ''
+                if self.lines and self.lines[-1][-1] != '\n':
+                    self.tail = self.lines.pop()
+            self.lpos = 0
+        ln = self.lines[self.lpos]
+        self.lpos += 1
+        self.total_rows += 1
+        return ln
+
+    def __iter__(self):
+        while 1:
+            ln = self.readline()
+            if not ln:
+                break
+            yield ln
+
+    def close(self):
+        "Stop reading, COPY thread is let to fail."
+        if self.eof or not self.thread:
+            return
+        self.closed = True
+        while self.thread.isAlive():
+            try:
+                self.queue.get(True, 1)
+            except Queue.Empty:
+                pass
+        self.thread.join()
+        self.eof = True
+
+
 def full_copy(tablename, src_curs, dst_curs, column_list = [], condition = None,
         dst_tablename = None, dst_column_list = None,
-        write_hook = None, flush_hook = None):
-    """COPY table from one db to another."""
+        write_hook = None, flush_hook = None, relay = False):
+    """COPY table from one db to another.
+
+    With relay=True, source and destination COPY run concurrently.
+    """
 
     # default dst table and dst columns to source ones
     dst_tablename = dst_tablename or tablename
@@ -437,7 +738,21 @@ def full_copy(tablename, src_curs, dst_curs, column_list = [], condition = None,
     else:
         src = build_statement(tablename, column_list)
 
-    if hasattr(src_curs, 'copy_expert'):
+    if relay and hasattr(src_curs, 'copy_expert'):
+        sql_to = "COPY %s TO stdout" % src
+        sql_from = "COPY %s FROM stdin" % dst
+        buf = CopyRelay(dst_curs, sql_from)
+        buf.write_hook = write_hook
+        buf.flush_hook = flush_hook
+        buf.start()
+        try:
+            src_curs.copy_expert(sql_to, buf)
+        except:
+            buf.abort()
+            raise
+        buf.finish()
+        return (buf.total_bytes, buf.total_rows)
+    elif hasattr(src_curs, 'copy_expert'):
         sql_to = "COPY %s TO stdout" % src
         sql_from = "COPY %s FROM stdin" % dst
         buf = CopyPipe(dst_curs, sql_from = sql_from)
@@ -8,6 +8,7 @@ Master commands:
   setup              Configure PostgreSQL for WAL archiving
   sync               Copies in-progress WALs to slave
   syncdaemon         Daemon mode for regular syncing
+  archivedaemon      Daemon that ships WALs for xarchive over persistent connection
   stop               Stop archiving - de-configure PostgreSQL
   periodic           Run periodic command if configured.
   synch-standby      Manage synchronous streaming replication.
@@ -37,10 +38,14 @@ Internal commands:
   xrotate            Rotate backup sets, expire and archive oldest if necessary.
   xpurgewals         Remove WAL files not needed for backup (slave)
   xpartialsync       Append data to WAL file (slave)
+  xreceive           Store compressed WAL file from stdin (slave)
+  xreceiver          Store stream of WAL files from stdin (slave)
+  xreceivefiles      Store stream of backup files from stdin (slave)
 """
 
-import os, sys, re, signal, time, traceback
+import os, sys, re, signal, time, traceback, Queue
 import errno, glob, ConfigParser, shutil, subprocess
+import struct, zlib, socket, threading, select, hashlib, fcntl
 
 import pkgloader
 pkgloader.require('skytools', '3.0')
@@ -51,6 +56,698 @@ DEFAULT_PG_VERSION = "8.3"
 
 XLOG_SEGMENT_SIZE = 16 * 1024**2
 
+# header of compressed WAL file: magic, segment size, stored size
+WALZ_MAGIC = "SKYWALZ1"
+WALZ_HEADER = "!8sII"
+WALZ_HEADER_SIZE = struct.calcsize(WALZ_HEADER)
+
+def is_wal_segment(fname):
+    return re.match("^[0-9A-F]{24}$", fname) is not None
+
+def is_archive_name(fname):
+    """Segment, timeline history or backup label, as given to archive_command."""
+    return re.match(r"^([0-9A-F]{24}(\.partial|\.[0-9A-F]{8}\.backup)?|[0-9A-F]{8}\.history)$",
+                    fname) is not None
+
+def wal_compress(data, level):
+    """Compress WAL segment.
+
+    Zeroed tail of segment is not stored, only its length.
+    """
+    end = len(data.rstrip('\0'))
+    hdr = struct.pack(WALZ_HEADER, WALZ_MAGIC, len(data), end)
+    return hdr + zlib.compress(buffer(data, 0, end), level)
+
+def wal_decompress(srcfile, dstfile):
+    """Decompress WAL file, zeroed tail is restored as sparse area.
+
+    Returns False if srcfile is not compressed.
+    """
+    src = open(srcfile, "rb")
+    try:
+        hdr = src.read(WALZ_HEADER_SIZE)
+        if len(hdr) < WALZ_HEADER_SIZE or hdr[:len(WALZ_MAGIC)] != WALZ_MAGIC:
+            return False
+        magic, total, stored = struct.unpack(WALZ_HEADER, hdr)
+        dec = zlib.decompressobj()
+        dst = open(dstfile, "wb")
+        try:
+            got = 0
+            while 1:
+                buf = src.read(1024*1024)
+                if not buf:
+                    break
+                buf = dec.decompress(buf)
+                got += len(buf)
+                dst.write(buf)
+            buf = dec.flush()
+            got += len(buf)
+            dst.write(buf)
+            if got != stored:
+                raise Exception("%s: corrupt compressed WAL, got %d bytes, expected %d" % (srcfile, got, stored))
+            dst.truncate(total)
+        finally:
+            dst.close()
+        return True
+    finally:
+        src.close()
+
+class ArchiveShipper(object):
+    """Ships WAL files to slave over persistent ssh connection.
+
+    Files are written to single long-running xreceiver process
+    on slave, several files can be in flight.  Slave acknowledges
+    each file after it is fsynced.
+    """
+
+    def __init__(self, cmdline, log, max_inflight, level):
+        self.cmdline = cmdline
+        self.log = log
+        self.max_inflight = max_inflight
+        self.level = level
+        self.cond = threading.Condition()
+        self.send_lock = threading.Lock()
+        self.proc = None
+        self.reader = None
+        # name -> 'sending', 'sent', 'done' or error message
+        self.state = {}
+        self.inflight = []
+        self.done_list = []
+
+    def start(self):
+        """Launch remote receiver.  Called with cond held."""
+        self.log.info("Starting transport: %r", self.cmdline)
+        self.proc = subprocess.Popen(self.cmdline, stdin = subprocess.PIPE,
+                                     stdout = subprocess.PIPE)
+        self.reader = threading.Thread(target = self.read_acks, args = (self.proc,),
+                                       name = 'archive-acks')
+        self.reader.setDaemon(True)
+        self.reader.start()
+
+    def stop(self):
+        """Close transport, wait for remaining acks."""
+        self.cond.acquire()
+        try:
+            proc = self.proc
+            self.proc = None
+        finally:
+            self.cond.release()
+        if proc:
+            proc.stdin.close()
+            self.reader.join()
+
+    def read_acks(self, proc):
+        """Read acknowledgements from slave, in send order."""
+        while 1:
+            ln = proc.stdout.readline()
+            if not ln:
+                break
+            t = ln.split(' ', 2)
+            self.cond.acquire()
+            try:
+                name = t[1].strip()
+                if t[0] == 'OK':
+                    self.state[name] = 'done'
+                    self.done_list.append(name)
+                else:
+                    self.state[name] = ln.strip()
+                if name in self.inflight:
+                    self.inflight.remove(name)
+                self.cond.notifyAll()
+            finally:
+                self.cond.release()
+
+        # transport is gone, fail everything pending
+        proc.wait()
+        self.cond.acquire()
+        try:
+            for name in self.inflight:
+                self.state[name] = 'transport closed, rc=%s' % proc.returncode
+            self.inflight = []
+            if self.proc is proc:
+                self.proc = None
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def pending(self):
+        return len(self.inflight)
+
+    def done_count(self):
+        return len(self.done_list)
+
+    def forget_done(self, keep, count):
+        """Forget first count acknowledged names, except ones in keep.
+
+        Names that are still marked .ready must be remembered,
+        otherwise prefetch would send them again.  Failures of
+        names no longer in keep are forgotten too, nobody waits
+        for them.
+        """
+        self.cond.acquire()
+        try:
+            old = self.done_list[:count]
+            self.done_list = self.done_list[count:]
+            for name in old:
+                if name in keep:
+                    self.done_list.append(name)
+                elif self.state.get(name) == 'done':
+                    del self.state[name]
+            for name, st in self.state.items():
+                if name not in keep and st not in ('sending', 'sent', 'done'):
+                    del self.state[name]
+        finally:
+            self.cond.release()
+
+    def archive(self, srcpath, name, wait = True):
+        """Send file unless already sent, optionally wait for ack.
+
+        Returns None on success, error message otherwise.
+        """
+        do_send = False
+        self.cond.acquire()
+        try:
+            while self.state.get(name) not in ('sending', 'sent', 'done'):
+                if len(self.inflight) < self.max_inflight:
+                    if not self.proc:
+                        self.start()
+                    proc = self.proc
+                    self.state[name] = 'sending'
+                    self.inflight.append(name)
+                    do_send = True
+                    break
+                self.cond.wait()
+        finally:
+            self.cond.release()
+
+        if do_send:
+            try:
+                self.send(proc, srcpath, name)
+            except Exception, d:
+                self.cond.acquire()
+                try:
+                    self.state[name] = 'send failed: %s' % str(d)
+                    if name in self.inflight:
+                        self.inflight.remove(name)
+                    self.cond.notifyAll()
+                finally:
+                    self.cond.release()
+
+        if not wait:
+            return None
+
+        self.cond.acquire()
+        try:
+            while self.state.get(name) in ('sending', 'sent'):
+                self.cond.wait(1)
+            st = self.state.get(name)
+            if st == 'done':
+                return None
+            # allow retry
+            self.state.pop(name, None)
+            return st or 'unknown state'
+        finally:
+            self.cond.release()
+
+    def send(self, proc, srcpath, name):
+        data = open(srcpath, "rb").read()
+        if self.level > 0 and is_wal_segment(name):
+            data = wal_compress(data, self.level)
+        self.send_lock.acquire()
+        try:
+            self.cond.acquire()
+            try:
+                if self.state.get(name) == 'sending':
+                    self.state[name] = 'sent'
+            finally:
+                self.cond.release()
+            proc.stdin.write("%s %d\n" % (name, len(data)))
+            proc.stdin.write(data)
+            proc.stdin.flush()
+        finally:
+            self.send_lock.release()
+        self.log.debug("%s: sent %d bytes", name, len(data))
+
+
+class DirWatcher(object):
+    """Waits until something happens in directories.
+
+    Uses inotify via ctypes when available, otherwise
+    wait() just sleeps.
+    """
+
+    # IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    EVENT_MASK = 0x002 | 0x008 | 0x040 | 0x080 | 0x100 | 0x200
+
+    def __init__(self, dirs):
+        self.fd = None
+        try:
+            import ctypes, ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno = True)
+            fd = libc.inotify_init()
+        except (ImportError, OSError, AttributeError):
+            return
+        if fd < 0:
+            return
+        for d in dirs:
+            if os.path.isdir(d) and libc.inotify_add_watch(fd, d, self.EVENT_MASK) < 0:
+                os.close(fd)
+                return
+        self.fd = fd
+
+    def wait(self, timeout):
+        """Wait for event or timeout."""
+        if self.fd is None:
+            time.sleep(timeout)
+            return
+        try:
+            ready = select.select([self.fd], [], [], timeout)[0]
+        except select.error:
+            return
+        if ready:
+            # drop events, caller checks files anyway
+            os.read(self.fd, 64*1024)
+
+    def read_names(self):
+        """Return file names from pending events, without waiting.
+
+        Returns None if events were lost.
+        """
+        names = []
+        while select.select([self.fd], [], [], 0)[0]:
+            buf = os.read(self.fd, 64*1024)
+            pos = 0
+            while pos + 16 <= len(buf):
+                wd, mask, cookie, nlen = struct.unpack("iIII", buf[pos : pos + 16])
+                # IN_Q_OVERFLOW
+                if mask & 0x4000:
+                    return None
+                names.append(buf[pos + 16 : pos + 16 + nlen].rstrip("\0"))
+                pos += 16 + nlen
+        return names
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class BackupStream(object):
+    """Sends files to slave over one ssh connection.
+
+    Slave side is xreceivefiles, which acknowledges each
+    file with md5 of received data.  Acks are read in
+    separate thread, so files are pipelined.
+    """
+
+    def __init__(self, num, cmdline, log, on_done):
+        self.num = num
+        self.cmdline = cmdline
+        self.log = log
+        self.on_done = on_done
+        self.proc = None
+        self.reader = None
+        # sent files in send order, waiting for ack
+        self.pending = Queue.Queue()
+        self.error = None
+        self.sent_bytes = 0
+
+    def run(self, unit, mkdirs, removes):
+        """Send all files of work unit.  Called in worker thread."""
+        try:
+            self.proc = subprocess.Popen(self.cmdline, stdin = subprocess.PIPE,
+                                         stdout = subprocess.PIPE)
+            self.reader = threading.Thread(target = self.read_acks,
+                                           name = 'backup-acks-%d' % self.num)
+            self.reader.setDaemon(True)
+            self.reader.start()
+            out = self.proc.stdin
+            for rel in mkdirs:
+                out.write("D %s\n" % rel)
+            for rel in removes:
+                out.write("R %s\n" % rel)
+            for rel, srcfile in unit:
+                if self.error:
+                    break
+                self.send_file(out, rel, srcfile)
+            out.close()
+            self.reader.join()
+            if self.proc.wait() != 0 and not self.error:
+                self.error = "xreceivefiles exited with %d" % self.proc.returncode
+            if not self.pending.empty() and not self.error:
+                self.error = "%d files not acknowledged" % self.pending.qsize()
+        except Exception, d:
+            self.log.exception("backup stream %d failed", self.num)
+            self.error = str(d)
+            if self.proc and self.proc.poll() is None:
+                self.proc.kill()
+
+    def send_file(self, out, rel, srcfile):
+        try:
+            f = open(srcfile, "rb")
+        except IOError, d:
+            # file removed by postgres after manifest was built
+            self.log.debug("%s: skipping: %s", rel, d)
+            return
+        try:
+            st = os.fstat(f.fileno())
+            size = st.st_size
+            csum = hashlib.md5()
+            out.write("F %d %s\n" % (size, rel))
+            left = size
+            while left > 0:
+                buf = f.read(min(left, 1024*1024))
+                if not buf:
+                    # file was truncated meanwhile, WAL replay fixes it
+                    buf = '\0' * min(left, 1024*1024)
+                csum.update(buf)
+                out.write(buf)
+                left -= len(buf)
+        finally:
+            f.close()
+        self.pending.put((rel, (size, st.st_mtime, csum.hexdigest())))
+        self.sent_bytes += size
+
+    def read_acks(self):
+        # after error, output is still read until EOF, otherwise
+        # xreceivefiles can block on full pipe and never exit
+        for ln in self.proc.stdout:
+            if self.error:
+                continue
+            t = ln.rstrip('\n').split(' ', 2)
+            if len(t) != 3 or t[0] != 'OK':
+                self.error = ln.strip()
+                continue
+            ack, csum, rel = t
+            if csum == '-':
+                continue
+            # slave acks in send order
+            xrel, info = self.pending.get()
+            if xrel != rel or info[2] != csum:
+                self.error = "%s: checksum mismatch" % rel
+                continue
+            self.on_done(rel, info)
+
+
+class WalCatalog(object):
+    """Catalog of WAL files in archive directory.
+
+    Kept in .walcatalog file as fixed-size records sorted
+    by name, so lookups can bisect the file without reading
+    all of it.  First record is header:
+
+        WALCATALOG <directory mtime> <records> <deleted>
+
+    Others are:
+
+        <flag><name> <size> <timeline> <archive time> <md5>
+
+    where flag is 'D' for removed files.  Removed records are
+    dropped when they make up most of the file.
+
+    Files that walmgr itself adds or removes are recorded
+    there, so cleanup does not need to list the directory.
+    If directory mtime does not match recorded one, something
+    else (rsync, pg_receivexlog) has changed it, then directory
+    is rescanned.  Mtime is recorded only if inotify shows
+    that no other process added or removed WAL files meanwhile,
+    changes to other files (PROGRESS, PAUSE) are ignored.
+    """
+
+    catalog_name = ".walcatalog"
+    rec_fmt = "%s%-40s %12d %8s %12d %-32s\n"
+    rec_size = 110
+    name_len = 40
+
+    # later changes get different mtime after this many seconds
+    mtime_precision = 0.02
+
+    def __init__(self, path, log):
+        self.path = path
+        self.log = log
+        self.fn = os.path.join(path, self.catalog_name)
+        self.lock_fn = self.fn + ".lock"
+        self.lock_file = None
+        self.f = None
+        self.watcher = None
+        self.dir_mtime = '-'
+        self.nrec = 0
+        self.ndel = 0
+
+    def close(self):
+        if self.watcher:
+            self.watcher.close()
+            self.watcher = None
+
+    def is_wal_name(self, fname):
+        # segments, also .backup and .partial files
+        return len(fname) <= self.name_len and re.match("^[0-9A-F]{24}", fname) is not None
+
+    def lock(self, exclusive = True):
+        """Lock catalog, load header.
+
+        Files are created before directory mtime is looked at.
+        """
+        self.lock_file = open(self.lock_fn, "a")
+        if exclusive:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX)
+        else:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_SH)
+        fd = os.open(self.fn, os.O_RDWR | os.O_CREAT, 0600)
+        self.f = os.fdopen(fd, "r+b")
+        self.read_header()
+
+    def unlock(self):
+        self.f.close()
+        self.f = None
+        self.lock_file.close()
+        self.lock_file = None
+
+    def read_header(self):
+        self.dir_mtime = '-'
+        self.nrec = self.ndel = 0
+        self.f.seek(0)
+        t = self.f.read(self.rec_size).split()
+        if len(t) != 4 or t[0] != 'WALCATALOG':
+            return
+        nrec, ndel = int(t[2]), int(t[3])
+        # unfinished write, rescan
+        if os.fstat(self.f.fileno()).st_size != (nrec + 1) * self.rec_size:
+            self.log.warning("%s: damaged catalog, rebuilding", self.fn)
+            return
+        self.dir_mtime, self.nrec, self.ndel = t[1], nrec, ndel
+
+    def write_header(self):
+        hdr = "WALCATALOG %s %d %d" % (self.dir_mtime, self.nrec, self.ndel)
+        self.f.seek(0)
+        self.f.write(hdr.ljust(self.rec_size - 1) + "\n")
+        self.f.flush()
+
+    def read_rec(self, i):
+        """Return (name, deleted) of record i."""
+        self.f.seek((i + 1) * self.rec_size)
+        buf = self.f.read(self.name_len + 1)
+        return buf[1:].rstrip(), buf[0] == 'D'
+
+    def find(self, fname):
+        """Return position of first record with name >= fname."""
+        lo, hi = 0, self.nrec
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.read_rec(mid)[0] < fname:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def make_rec(self, fname, md5):
+        st = os.stat(os.path.join(self.path, fname))
+        return self.rec_fmt % (' ', fname, st.st_size, fname[:8], st.st_mtime, md5 or '-')
+
+    def load_recs(self):
+        """Return name -> record for live records."""
+        res = {}
+        self.f.seek(self.rec_size)
+        for i in range(self.nrec):
+            rec = self.f.read(self.rec_size)
+            if rec[0] != 'D':
+                res[rec[1 : self.name_len + 1].rstrip()] = rec
+        return res
+
+    def rewrite(self, recs):
+        """Write all records, in place so directory is not touched."""
+        names = recs.keys()
+        names.sort()
+        self.nrec = len(names)
+        self.ndel = 0
+        self.f.seek(self.rec_size)
+        self.f.write("".join([recs[n] for n in names]))
+        self.f.truncate()
+        self.write_header()
+
+    def get_dir_mtime(self):
+        return repr(os.stat(self.path).st_mtime)
+
+    def start_watch(self):
+        """Ignore events so far, returns False if inotify is not available."""
+        if not self.watcher:
+            self.watcher = DirWatcher([self.path])
+        if self.watcher.fd is None:
+            return False
+        self.watcher.read_names()
+        return True
+
+    def verify_mtime(self, mtime, own_names):
+        """Return mtime if only own_names or non-WAL files were changed
+        since start_watch(), otherwise '-'.
+        """
+        # wait until next change would get different mtime
+        delay = float(mtime) + self.mtime_precision - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        names = self.watcher.read_names()
+        if names is None:
+            return '-'
+        for fname in names:
+            if fname not in own_names and self.is_wal_name(fname):
+                return '-'
+        return mtime
+
+    def change(self, func, own_names = ()):
+        """Run func that modifies directory, record resulting mtime.
+
+        Mtime is recorded only if directory was in sync before,
+        otherwise next sync() picks up the changes.
+        """
+        self.lock()
+        try:
+            self.apply_change(func, own_names)
+            self.write_header()
+        finally:
+            self.unlock()
+
+    def apply_change(self, func, own_names):
+        own_names = dict.fromkeys(own_names)
+        watching = self.start_watch()
+        before = self.get_dir_mtime()
+        func()
+        if watching and before == self.dir_mtime:
+            self.dir_mtime = self.verify_mtime(self.get_dir_mtime(), own_names)
+        else:
+            self.dir_mtime = '-'
+
+    def sync(self):
+        """Rescan directory if it was changed outside of catalog."""
+        self.lock()
+        try:
+            watching = self.start_watch()
+            mtime = self.get_dir_mtime()
+            if mtime == self.dir_mtime:
+                return
+            self.log.debug("%s: rescanning", self.path)
+            found = [fn for fn in os.listdir(self.path) if self.is_wal_name(fn)]
+            recs = self.load_recs()
+            changed = self.ndel > 0 or len(found) != len(recs)
+            for fname in found:
+                if fname not in recs:
+                    try:
+                        recs[fname] = self.make_rec(fname, None)
+                    except OSError:
+                        continue
+                    changed = True
+            if changed:
+                found = dict.fromkeys(found)
+                for fname in recs.keys():
+                    if fname not in found:
+                        del recs[fname]
+            self.dir_mtime = '-'
+            if watching and mtime == self.get_dir_mtime():
+                self.dir_mtime = self.verify_mtime(mtime, ())
+            if changed:
+                self.rewrite(recs)
+            else:
+                self.write_header()
+        finally:
+            self.unlock()
+
+    def range(self, start, end):
+        """Return names with start <= name < end."""
+        self.lock(False)
+        try:
+            res = []
+            i = self.find(start)
+            while i < self.nrec:
+                fname, deleted = self.read_rec(i)
+                if fname >= end:
+                    break
+                if not deleted:
+                    res.append(fname)
+                i += 1
+            return res
+        finally:
+            self.unlock()
+
+    def add(self, fname, func, md5):
+        """Run func that creates file, record it."""
+        self.lock()
+        try:
+            self.apply_change(func, (fname,))
+            rec = self.make_rec(fname, md5)
+            i = self.find(fname)
+            if i < self.nrec and self.read_rec(i)[0] == fname:
+                # overwritten file
+                if self.read_rec(i)[1]:
+                    self.ndel -= 1
+                self.f.seek((i + 1) * self.rec_size)
+                self.f.write(rec)
+            elif i == self.nrec:
+                # usual case, newest file
+                self.f.seek((i + 1) * self.rec_size)
+                self.f.write(rec)
+                self.nrec += 1
+            else:
+                recs = self.load_recs()
+                recs[fname] = rec
+                self.rewrite(recs)
+            self.write_header()
+        finally:
+            self.unlock()
+
+    def remove(self, fname_list, not_really = False):
+        """Delete files and record it."""
+        def do_remove():
+            for fname in fname_list:
+                full = os.path.join(self.path, fname)
+                self.log.debug("deleting %s", full)
+                if not_really:
+                    continue
+                try:
+                    os.remove(full)
+                except OSError:
+                    # don't report the errors if the file has been already removed
+                    # happens due to conflicts with pg_archivecleanup for instance.
+                    pass
+        if not_really:
+            do_remove()
+            return
+
+        self.lock()
+        try:
+            self.apply_change(do_remove, fname_list)
+            for fname in fname_list:
+                i = self.find(fname)
+                if i < self.nrec and self.read_rec(i) == (fname, False):
+                    self.f.seek((i + 1) * self.rec_size)
+                    self.f.write('D')
+                    self.ndel += 1
+            if self.ndel > 1000 and self.ndel * 2 > self.nrec:
+                self.rewrite(self.load_recs())
+            else:
+                self.write_header()
+        finally:
+            self.unlock()
+
+
 def usage(err):
     if err > 0:
         print >>sys.stderr, __doc__
@@ -468,10 +1165,16 @@ class WalMgr(skytools.DBScript):
             self.cfgfile = None
             self.args = []
 
-        if self.cmd not in ('sync', 'syncdaemon'):
+        if self.cmd not in ('sync', 'syncdaemon', 'archivedaemon'):
             # don't let pidfile interfere with normal operations, but
             # disallow concurrent syncing
             self.pidfile = None
+        elif self.cmd == 'archivedaemon' and self.pidfile:
+            self.pidfile += ".archiver"
+
+        self.archive_sock = None
+        self.archive_shipper = None
+        self.archive_lock = threading.Lock()
 
         cmdtab = {
             'init_master':   self.walmgr_init_master,
@@ -484,6 +1187,7 @@ class WalMgr(skytools.DBScript):
             'periodic':      self.master_periodic,
             'sync':          self.master_sync,
             'syncdaemon':    self.master_syncdaemon,
+            'archivedaemon': self.master_archivedaemon,
             'pause':         self.slave_pause,
             'continue':      self.slave_continue,
             'boot':          self.slave_boot,
@@ -497,6 +1201,9 @@ class WalMgr(skytools.DBScript):
             'xarchive':      self.master_xarchive,
             'xrestore':      self.xrestore,
             'xpartialsync':  self.slave_append_partial,
+            'xreceive':      self.slave_receive_compressed,
+            'xreceiver':     self.slave_receiver,
+            'xreceivefiles': self.slave_receive_files,
         }
 
         if not cmdtab.has_key(self.cmd):
@@ -617,14 +1324,17 @@ class WalMgr(skytools.DBScript):
 
         self.exec_big_rsync(cmdline + [ source_dir, dst_loc ])
 
-    def exec_cmd(self, cmdline, allow_error=False):
+    def exec_cmd(self, cmdline, allow_error=False, stdin_data=None):
         cmd = "' '".join(cmdline)
         self.log.debug("Execute cmd: %r", cmd)
         if self.not_really:
             return
 
-        process = subprocess.Popen(cmdline,stdout=subprocess.PIPE)
-        output = process.communicate()
+        if stdin_data is None:
+            process = subprocess.Popen(cmdline,stdout=subprocess.PIPE)
+        else:
+            process = subprocess.Popen(cmdline,stdout=subprocess.PIPE,stdin=subprocess.PIPE)
+        output = process.communicate(stdin_data)
         res = process.returncode
 
         if res != 0 and not allow_error:
@@ -936,9 +1646,13 @@ class WalMgr(skytools.DBScript):
             cmdline = ["ssh", "-nT", host, "mkdir", "-p", path]
             self.exec_cmd(cmdline)
 
-    def remote_walmgr(self, command, stdin_disabled = True, allow_error=False):
+    def remote_walmgr(self, command, stdin_disabled = True, allow_error=False, stdin_data=None):
         """Pass a command to slave WalManager"""
 
+        cmdline = self.remote_walmgr_cmdline(command, stdin_disabled and stdin_data is None)
+        return self.exec_cmd(cmdline, allow_error, stdin_data)
+
+    def remote_walmgr_cmdline(self, command, stdin_disabled = True):
         sshopt = "-T"
         if stdin_disabled:
             sshopt += "n"
@@ -953,8 +1667,7 @@ class WalMgr(skytools.DBScript):
 
         if self.not_really:
             cmdline += ["--not-really"]
-
-        return self.exec_cmd(cmdline, allow_error)
+        return cmdline
 
     def remote_xlock(self):
         """
@@ -1324,75 +2037,17 @@ primary_conninfo     = %(primary_conninfo)s
 
         try:
             self.pg_start_backup("FullBackup")
-            self.remote_walmgr("xrotate")
 
             data_dir = self.cf.getfile("master_data")
             dst_loc = self.cf.getfile("full_backup")
             if dst_loc[-1] != "/":
                 dst_loc += "/"
 
-            master_spc_dir = os.path.join(data_dir, "pg_tblspc")
-            slave_spc_dir = dst_loc + "tmpspc"
-
-            # copy data
-            self.chdir(data_dir)
-            cmdline = [
-                    "--delete",
-                    "--exclude", ".*",
-                    "--exclude", "*.pid",
-                    "--exclude", "*.opts",
-                    "--exclude", "*.conf",
-                    "--exclude", "pg_xlog",
-                    "--exclude", "pg_tblspc",
-                    "--exclude", "pg_log",
-                    "--exclude", "base/pgsql_tmp",
-                    "--copy-unsafe-links",
-                    ".", dst_loc]
-            self.exec_big_rsync(cmdline)
-
-            # copy tblspc first, to test
-            if os.path.isdir(master_spc_dir):
-                self.log.info("Checking tablespaces")
-                list = os.listdir(master_spc_dir)
-                if len(list) > 0:
-                    self.remote_mkdir(slave_spc_dir)
-                for tblspc in list:
-                    if tblspc[0] == ".":
-                        continue
-                    tfn = os.path.join(master_spc_dir, tblspc)
-                    if not os.path.islink(tfn):
-                        self.log.info("Suspicious pg_tblspc entry: %s", tblspc)
-                        continue
-                    spc_path = os.path.realpath(tfn)
-                    self.log.info("Got tablespace %s: %s", tblspc, spc_path)
-                    dstfn = slave_spc_dir + "/" + tblspc
-
-                    try:
-                        os.chdir(spc_path)
-                    except Exception, det:
-                        self.log.warning("Broken link: %s", det)
-                        continue
-                    cmdline = [ "--delete", "--exclude", ".*", "--copy-unsafe-links", ".", dstfn]
-                    self.exec_big_rsync(cmdline)
-
-            # copy the pg_log and pg_xlog directories, these may be
-            # symlinked to nonstandard location, so pay attention
-            self.rsync_log_directory(os.path.join(data_dir, "pg_log"),  dst_loc)
-            self.rsync_log_directory(os.path.join(data_dir, "pg_xlog"), dst_loc)
-
-            # copy config files
-            conf_dst_loc = self.cf.getfile("config_backup", "")
-            if conf_dst_loc:
-                master_conf_dir = os.path.dirname(self.cf.getfile("master_config"))
-                self.log.info("Backup conf files from %s", master_conf_dir)
-                self.chdir(master_conf_dir)
-                cmdline = [
-                     "--include", "*.conf",
-                     "--exclude", "*",
-                     ".", conf_dst_loc]
-                self.exec_big_rsync(cmdline)
-
-            self.remote_walmgr("xpurgewals")
+            if self.cf.getint("backup_streams", 0) > 0:
+                self.master_backup_streams(data_dir)
+            else:
+                self.master_backup_rsync(data_dir, dst_loc)
+            self.master_backup_finish(data_dir, dst_loc)
         except Exception, e:
             self.log.error(e)
             errors = True
@@ -1412,6 +2067,306 @@ primary_conninfo     = %(primary_conninfo)s
         else:
             self.log.error("Full backup failed.")
 
+    def master_backup_rsync(self, data_dir, dst_loc):
+        """Copy data directory and tablespaces with rsync."""
+        self.remote_walmgr("xrotate")
+
+        master_spc_dir = os.path.join(data_dir, "pg_tblspc")
+        slave_spc_dir = dst_loc + "tmpspc"
+
+        # copy data
+        self.chdir(data_dir)
+        cmdline = [
+                "--delete",
+                "--exclude", ".*",
+                "--exclude", "*.pid",
+                "--exclude", "*.opts",
+                "--exclude", "*.conf",
+                "--exclude", "pg_xlog",
+                "--exclude", "pg_tblspc",
+                "--exclude", "pg_log",
+                "--exclude", "base/pgsql_tmp",
+                "--copy-unsafe-links",
+                ".", dst_loc]
+        self.exec_big_rsync(cmdline)
+
+        # copy tblspc first, to test
+        if os.path.isdir(master_spc_dir):
+            self.log.info("Checking tablespaces")
+            list = os.listdir(master_spc_dir)
+            if len(list) > 0:
+                self.remote_mkdir(slave_spc_dir)
+            for tblspc in list:
+                if tblspc[0] == ".":
+                    continue
+                tfn = os.path.join(master_spc_dir, tblspc)
+                if not os.path.islink(tfn):
+                    self.log.info("Suspicious pg_tblspc entry: %s", tblspc)
+                    continue
+                spc_path = os.path.realpath(tfn)
+                self.log.info("Got tablespace %s: %s", tblspc, spc_path)
+                dstfn = slave_spc_dir + "/" + tblspc
+
+                try:
+                    os.chdir(spc_path)
+                except Exception, det:
+                    self.log.warning("Broken link: %s", det)
+                    continue
+                cmdline = [ "--delete", "--exclude", ".*", "--copy-unsafe-links", ".", dstfn]
+                self.exec_big_rsync(cmdline)
+
+    def master_backup_finish(self, data_dir, dst_loc):
+        """Copy log dirs and config, purge old WAL-s on slave."""
+
+        # copy the pg_log and pg_xlog directories, these may be
+        # symlinked to nonstandard location, so pay attention
+        self.rsync_log_directory(os.path.join(data_dir, "pg_log"),  dst_loc)
+        self.rsync_log_directory(os.path.join(data_dir, "pg_xlog"), dst_loc)
+
+        # copy config files
+        conf_dst_loc = self.cf.getfile("config_backup", "")
+        if conf_dst_loc:
+            master_conf_dir = os.path.dirname(self.cf.getfile("master_config"))
+            self.log.info("Backup conf files from %s", master_conf_dir)
+            self.chdir(master_conf_dir)
+            cmdline = [
+                 "--include", "*.conf",
+                 "--exclude", "*",
+                 ".", conf_dst_loc]
+            self.exec_big_rsync(cmdline)
+
+        self.remote_walmgr("xpurgewals")
+
+    def build_backup_manifest(self, data_dir):
+        """Find files to back up.
+
+        Returns (files, dirs), where files is dict of
+        relpath -> (srcfile, size, mtime) and dirs is list of relpaths.
+        Same files are skipped as in rsync based backup.
+        """
+        files = {}
+        dirs = []
+
+        def skip(name):
+            return name[0] == "." or os.path.splitext(name)[1] in (".pid", ".opts", ".conf")
+
+        def walk(src_root, dst_root, top_skip):
+            for dirpath, dirnames, filenames in os.walk(src_root, followlinks = True):
+                rel_dir = os.path.relpath(dirpath, src_root)
+                if rel_dir == ".":
+                    rel_dir = ""
+                for d in dirnames[:]:
+                    rel = os.path.join(rel_dir, d)
+                    if skip(d) or rel in top_skip:
+                        dirnames.remove(d)
+                    else:
+                        dirs.append(os.path.join(dst_root, rel))
+                for fn in filenames:
+                    if skip(fn):
+                        continue
+                    src = os.path.join(dirpath, fn)
+                    try:
+                        st = os.stat(src)
+                    except OSError:
+                        continue
+                    files[os.path.join(dst_root, rel_dir, fn)] = (src, st.st_size, st.st_mtime)
+
+        walk(data_dir, "", ("pg_xlog", "pg_tblspc", "pg_log", "base/pgsql_tmp"))
+
+        master_spc_dir = os.path.join(data_dir, "pg_tblspc")
+        if os.path.isdir(master_spc_dir):
+            for tblspc in os.listdir(master_spc_dir):
+                if tblspc[0] == ".":
+                    continue
+                tfn = os.path.join(master_spc_dir, tblspc)
+                if not os.path.islink(tfn):
+                    self.log.info("Suspicious pg_tblspc entry: %s", tblspc)
+                    continue
+                spc_path = os.path.realpath(tfn)
+                if not os.path.isdir(spc_path):
+                    self.log.warning("Broken link: %s", tfn)
+                    continue
+                self.log.info("Got tablespace %s: %s", tblspc, spc_path)
+                dirs.append(os.path.join("tmpspc", tblspc))
+                walk(spc_path, os.path.join("tmpspc", tblspc), ())
+        return files, dirs
+
+    def master_backup_streams(self, data_dir):
+        """
+        Copy data directory and tablespaces over parallel streams.
+
+        Progress is kept in manifest file with size, mtime and md5
+        of each sent file.  Interrupted backup continues where it
+        stopped, with backup_incremental also finished backup is
+        updated in place by sending only changed files.
+        """
+        manifest_fn = self.cf.getfile("backup_manifest",
+                os.path.join(data_dir, ".walshipping.manifest"))
+        nstreams = self.cf.getint("backup_streams", 0)
+
+        old = None
+        if os.path.isfile(manifest_fn):
+            old = skytools.json_decode(open(manifest_fn).read())
+        if old and old['state'] == 'running':
+            self.log.info("Resuming interrupted backup")
+        elif old and old['state'] == 'done' and self.cf.getint("backup_incremental", 0):
+            self.log.info("Incremental backup")
+        else:
+            old = None
+            self.remote_walmgr("xrotate")
+        old_files = old and old['files'] or {}
+        old_dirs = old and old.get('dirs') or []
+
+        files, dirs = self.build_backup_manifest(data_dir)
+
+        # find changed files
+        manifest = {'state': 'running', 'files': {}, 'dirs': dirs}
+        send_list = []
+        for rel, (src, size, mtime) in files.items():
+            prev = old_files.get(rel)
+            if prev and prev[0] == size and prev[1] == mtime and prev[2]:
+                manifest['files'][rel] = prev
+            else:
+                send_list.append((size, rel, src))
+        removes = [rel for rel in old_files if rel not in files]
+        # directories of dropped databases and tablespaces, after files
+        cur_dirs = dict.fromkeys(dirs)
+        removes += [rel for rel in old_dirs if rel not in cur_dirs]
+
+        total = sum([x[0] for x in send_list])
+        self.log.info("Backup: %d files, sending %d files (%d MB), removing %d",
+                      len(files), len(send_list), total / (1024*1024), len(removes))
+        self.write_manifest(manifest_fn, manifest)
+
+        # balance work units by size, biggest files first
+        send_list.sort(reverse = True)
+        units = [[] for i in range(max(nstreams, 1))]
+        unit_size = [0] * len(units)
+        for size, rel, src in send_list:
+            i = unit_size.index(min(unit_size))
+            units[i].append((rel, src))
+            unit_size[i] += size
+
+        lock = threading.Lock()
+        def on_done(rel, info):
+            lock.acquire()
+            try:
+                manifest['files'][rel] = info
+            finally:
+                lock.release()
+
+        cmdline = self.remote_walmgr_cmdline("xreceivefiles", False)
+        streams = []
+        threads = []
+        for i, unit in enumerate(units):
+            bs = BackupStream(i, cmdline, self.log, on_done)
+            streams.append(bs)
+            # first stream also creates directories and removes old files
+            args = (unit, i == 0 and dirs or [], i == 0 and removes or [])
+            th = threading.Thread(target = bs.run, args = args, name = 'backup-%d' % i)
+            th.start()
+            threads.append(th)
+
+        # save progress while streams run
+        start = time.time()
+        for th in threads:
+            while th.isAlive():
+                th.join(30)
+                lock.acquire()
+                try:
+                    self.write_manifest(manifest_fn, manifest)
+                finally:
+                    lock.release()
+                sent = sum([bs.sent_bytes for bs in streams])
+                self.log.info("Backup progress: %d / %d MB", sent / (1024*1024), total / (1024*1024))
+
+        errs = [bs.error for bs in streams if bs.error]
+        if errs:
+            raise Exception("backup failed: %s" % "; ".join(errs))
+
+        manifest['state'] = 'done'
+        self.write_manifest(manifest_fn, manifest)
+        self.log.info("Backup data sent in %d seconds", time.time() - start)
+
+    def write_manifest(self, fn, manifest):
+        if not self.not_really:
+            skytools.write_atomic(fn, skytools.json_encode(manifest))
+
+    def slave_receive_files(self):
+        """
+        Read stream of backup files from stdin and store them under
+        full_backup.  Commands, one per line:
+
+            F <size> <relpath>  - file data follows, acked with md5
+            D <relpath>         - create directory
+            R <relpath>         - remove file or directory tree
+        """
+        self.assert_is_master(False)
+        dst_dir = self.cf.getfile("full_backup")
+        while 1:
+            hdr = sys.stdin.readline()
+            if not hdr:
+                break
+            t = hdr.rstrip('\n').split(' ', 2)
+            if t[0] == 'F':
+                size, rel = int(t[1]), t[2]
+            else:
+                size, rel = 0, t[1]
+            if rel.startswith('/') or '..' in rel.split('/'):
+                die(1, "xreceivefiles: bad path: %s" % rel)
+            fn = os.path.join(dst_dir, rel)
+            csum = '-'
+            if t[0] == 'D':
+                self.makedirs_safe(fn)
+            elif t[0] == 'R':
+                if self.not_really:
+                    pass
+                elif os.path.isdir(fn) and not os.path.islink(fn):
+                    shutil.rmtree(fn)
+                elif os.path.isfile(fn):
+                    os.remove(fn)
+            elif t[0] == 'F':
+                csum = self.receive_file(fn, size)
+            else:
+                die(1, "xreceivefiles: bad command: %s" % hdr)
+            sys.stdout.write("OK %s %s\n" % (csum, rel))
+            sys.stdout.flush()
+
+    def makedirs_safe(self, dirname):
+        """Create directory, other streams may create it concurrently."""
+        if os.path.isdir(dirname) or self.not_really:
+            return
+        try:
+            os.makedirs(dirname)
+        except OSError, d:
+            if d.errno != errno.EEXIST:
+                raise
+
+    def receive_file(self, fn, size):
+        """Write size bytes from stdin to fn, return md5."""
+        dirname = os.path.dirname(fn)
+        self.makedirs_safe(dirname)
+        tmp = os.path.join(dirname, ".%s.tmp" % os.path.basename(fn))
+        f = None
+        if not self.not_really:
+            f = open(tmp, "wb")
+        csum = hashlib.md5()
+        left = size
+        while left > 0:
+            buf = sys.stdin.read(min(left, 1024*1024))
+            if not buf:
+                die(1, "xreceivefiles: %s: unexpected end of data" % fn)
+            csum.update(buf)
+            if f:
+                f.write(buf)
+            left -= len(buf)
+        if f:
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            os.rename(tmp, fn)
+        return csum.hexdigest()
+
     def slave_backup(self):
         """
         Create backup on slave host.
@@ -1525,6 +2480,11 @@ STOP TIME: %(stop_time)s
         srcpath = self.args[0]
         srcname = self.args[1]
 
+        # hand over to archivedaemon, if it is running
+        sock_fn = self.cf.getfile("archive_socket", "")
+        if sock_fn and self.archive_via_daemon(sock_fn, srcpath, srcname):
+            return
+
         start_time = time.time()
         self.log.debug("%s: start copy", srcname)
 
@@ -1534,14 +2494,23 @@ STOP TIME: %(stop_time)s
         if dst_loc[-1] != "/":
             dst_loc += "/"
 
-        # copy data
-        self.exec_rsync([ srcpath, dst_loc ], True)
+        level = self.cf.getint("archive_compression", 0)
+        if level > 0 and is_wal_segment(srcname):
+            # compress here, slave writes and fsyncs the file
+            data = open(srcpath, "rb").read()
+            zdata = wal_compress(data, level)
+            self.log.debug("%s: compressed %d -> %d bytes", srcname, len(data), len(zdata))
+            self.remote_walmgr("xreceive %s" % srcname, stdin_data = zdata)
+            self.stat_add('bytes', len(zdata))
+        else:
+            # copy data
+            self.exec_rsync([ srcpath, dst_loc ], True)
 
-        # sync the buffers to disk - this is should reduce the chance
-        # of WAL file corruption in case the slave crashes.
-        slave = self.cf.get("slave")
-        cmdline = ["ssh", "-nT", slave, "sync" ]
-        self.exec_cmd(cmdline)
+            # sync the buffers to disk - this is should reduce the chance
+            # of WAL file corruption in case the slave crashes.
+            slave = self.cf.get("slave")
+            cmdline = ["ssh", "-nT", slave, "sync" ]
+            self.exec_cmd(cmdline)
 
         # slave has the file now, set markers
         self.set_last_complete(srcname)
@@ -1602,6 +2571,249 @@ STOP TIME: %(stop_time)s
 
         xlog.close()
 
+    def archive_via_daemon(self, sock_fn, srcpath, srcname):
+        """Ask archivedaemon to archive the file.
+
+        Returns False if daemon is not running.
+        """
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            try:
+                s.connect(sock_fn)
+            except socket.error, d:
+                self.log.warning("archivedaemon not available (%s), archiving directly", str(d))
+                return False
+            s.sendall("xarchive %s %s\n" % (os.path.abspath(srcpath), srcname))
+            reply = s.makefile().readline().strip()
+        finally:
+            s.close()
+        if reply != "OK":
+            self.log.error("%s: archivedaemon failed: %s", srcname, reply or "no reply")
+            sys.exit(1)
+        self.log.debug("%s: archived by daemon", srcname)
+        return True
+
+    def master_archivedaemon(self):
+        """
+        Serve xarchive requests from archive_socket.  Files are shipped
+        over persistent connection to slave, segments marked .ready
+        in pg_xlog are sent ahead so they are on slave when asked.
+        """
+        self.assert_is_master(True)
+        self.set_single_loop(0)
+        self.work = self.master_archive_work
+        return self.work()
+
+    def master_archive_work(self):
+        if not self.archive_sock:
+            sock_fn = self.cf.getfile("archive_socket")
+            if os.path.exists(sock_fn):
+                os.remove(sock_fn)
+            self.archive_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            # only same user may ask to archive files
+            old_umask = os.umask(0177)
+            try:
+                self.archive_sock.bind(sock_fn)
+            finally:
+                os.umask(old_umask)
+            self.archive_sock.listen(16)
+            self.archive_shipper = ArchiveShipper(self.remote_walmgr_cmdline("xreceiver", False),
+                    self.log, self.cf.getint("archive_inflight", 4),
+                    self.cf.getint("archive_compression", 0))
+            self.log.info("Listening on %s", sock_fn)
+
+        # wait for requests until loop_delay passes
+        end = time.time() + max(self.loop_delay, 0.1)
+        while self.looping:
+            self.archive_prefetch()
+            left = end - time.time()
+            if left <= 0:
+                break
+            self.archive_sock.settimeout(min(left, 1.0))
+            try:
+                conn, addr = self.archive_sock.accept()
+            except socket.timeout:
+                continue
+            except socket.error, d:
+                if d.args[0] == errno.EINTR:
+                    continue
+                raise
+            conn.settimeout(None)
+            th = threading.Thread(target = self.archive_client, args = (conn,))
+            th.setDaemon(True)
+            th.start()
+        return 1
+
+    def archive_prefetch(self):
+        """Start sending segments that postgres has marked as ready."""
+        shipper = self.archive_shipper
+        if shipper.pending() >= shipper.max_inflight:
+            return
+        # names acked after listing may be missing from it
+        done_count = shipper.done_count()
+        xlog_dir = os.path.join(self.cf.getfile("master_data"), "pg_xlog")
+        ready = [os.path.basename(fn)[:-6] for fn in
+                 glob.glob(os.path.join(xlog_dir, "archive_status", "*.ready"))]
+        ready.sort()
+        shipper.forget_done(set(ready), done_count)
+        for name in ready:
+            if shipper.pending() >= shipper.max_inflight:
+                break
+            try:
+                shipper.archive(os.path.join(xlog_dir, name), name, False)
+            except Exception, d:
+                self.log.warning("%s: prefetch failed: %s", name, str(d))
+                break
+
+    def archive_client(self, conn):
+        """Handle one xarchive request."""
+        try:
+            t = conn.makefile().readline().split()
+            if len(t) != 3 or t[0] != 'xarchive':
+                conn.sendall("ERR bad request\n")
+                return
+            srcpath, srcname = t[1], t[2]
+            # accept only WAL files from own pg_xlog
+            xlog_dir = os.path.realpath(os.path.join(self.cf.getfile("master_data"), "pg_xlog"))
+            if not is_archive_name(srcname) \
+                    or os.path.realpath(srcpath) != os.path.join(xlog_dir, srcname):
+                self.log.error("bad xarchive request: %s %s", srcpath, srcname)
+                conn.sendall("ERR bad request\n")
+                return
+            start_time = time.time()
+            try:
+                err = self.archive_shipper.archive(srcpath, srcname)
+            except Exception, d:
+                err = str(d)
+            if err:
+                self.log.error("%s: archiving failed: %s", srcname, err)
+                conn.sendall("ERR %s\n" % err)
+                return
+
+            self.archive_lock.acquire()
+            try:
+                self.master_periodic()
+                self.set_last_complete(srcname)
+                self.stat_add('count', 1)
+                self.stat_add('duration', time.time() - start_time)
+                self.send_stats()
+            finally:
+                self.archive_lock.release()
+            self.log.debug("%s: done", srcname)
+            conn.sendall("OK\n")
+        except Exception:
+            self.log.exception("archive request failed")
+        finally:
+            conn.close()
+
+    def shutdown(self):
+        if self.archive_sock:
+            self.archive_sock.close()
+            self.archive_sock = None
+            sock_fn = self.cf.getfile("archive_socket")
+            if os.path.exists(sock_fn):
+                os.remove(sock_fn)
+        if self.archive_shipper:
+            self.archive_shipper.stop()
+            self.archive_shipper = None
+        skytools.DBScript.shutdown(self)
+
+    def store_wal_file(self, filename, data, cat = None):
+        """Write file durably into completed_wals.
+
+        Long-running receiver can pass in its WalCatalog.
+        """
+        xlog_dir = self.cf.getfile("completed_wals")
+        name = os.path.join(xlog_dir, filename)
+        if self.not_really:
+            self.log.info("Receiving: %s", name)
+            return
+
+        def write_file():
+            tmpname = os.path.join(xlog_dir, ".%s.tmp" % filename)
+            f = open(tmpname, "wb")
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            os.rename(tmpname, name)
+
+            # make rename durable too
+            fd = os.open(xlog_dir, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        if is_wal_segment(filename):
+            own_cat = cat is None
+            if own_cat:
+                cat = WalCatalog(xlog_dir, self.log)
+            try:
+                cat.add(filename, write_file, hashlib.md5(data).hexdigest())
+            finally:
+                if own_cat:
+                    cat.close()
+        else:
+            write_file()
+        self.log.debug("Slave: received %s, %d bytes", filename, len(data))
+
+    def slave_receiver(self):
+        """
+        Read stream of WAL files from stdin, each prefixed with
+        "<filename> <size>" line.  Each file is acknowledged on
+        stdout after it is stored.
+        """
+        self.assert_is_master(False)
+        cat = WalCatalog(self.cf.getfile("completed_wals"), self.log)
+        while 1:
+            hdr = sys.stdin.readline()
+            if not hdr:
+                break
+            filename, size = hdr.split()
+            size = int(size)
+            if '/' in filename or filename.startswith('.'):
+                die(1, "xreceiver: bad filename: %s" % filename)
+            data = sys.stdin.read(size)
+            if len(data) != size:
+                self.log.error("Slave: %s: not enough data, expected %d, got %d",
+                               filename, size, len(data))
+                sys.exit(1)
+            self.store_wal_file(filename, data, cat)
+            sys.stdout.write("OK %s\n" % filename)
+            sys.stdout.flush()
+        cat.close()
+
+    def slave_receive_compressed(self):
+        """
+        Read compressed WAL file from stdin, store it in completed_wals.
+        The file is fsynced before it becomes visible under final name.
+        """
+        self.assert_is_master(False)
+        if len(self.args) < 1:
+            die(1, "usage: xreceive <filename>")
+
+        filename = self.args[0]
+        if not is_wal_segment(filename):
+            die(1, "xreceive: bad filename: %s" % filename)
+
+        data = sys.stdin.read()
+        if data[:len(WALZ_MAGIC)] != WALZ_MAGIC:
+            self.log.error("Slave: %s: data not in compressed format", filename)
+            sys.exit(1)
+
+        self.store_wal_file(filename, data)
+
+    def restore_wal_file(self, srcfile, dstpath):
+        """Copy WAL file to dstpath, decompressing if needed."""
+        if self.not_really:
+            self.log.info("Restore %s to %s", srcfile, dstpath)
+            return
+        if os.path.isdir(dstpath):
+            dstpath = os.path.join(dstpath, os.path.basename(srcfile))
+        if not wal_decompress(srcfile, dstpath):
+            self.exec_cmd(["cp", srcfile, dstpath])
+
     def master_send_partial(self, xlog_dir, chunk, daemon_mode):
         """
         Send the partial log chunk to slave. Use SSH with input redirection for the copy,
@@ -1796,6 +3008,11 @@ STOP TIME: %(stop_time)s
             self.log.debug("Looking in %s", src)
             srcfile = os.path.join(src, srcname)
             if self.exec_rsync([srcfile, dstpath]) == 0:
+                # archived file may be compressed
+                if not self.not_really and os.path.isfile(dstpath):
+                    tmp = dstpath + ".tmp"
+                    if wal_decompress(dstpath, tmp):
+                        os.rename(tmp, dstpath)
                 return
         self.log.warning("Could not restore file %s", srcname)
 
@@ -1826,16 +3043,27 @@ STOP TIME: %(stop_time)s
 
             sys.exit(1)
 
+        # with cleanup, PROGRESS changes are recorded in WAL catalog,
+        # so they do not cause directory rescan
+        cat = None
+        if self.cf.getint("keep_backups", 0) == 0:
+            cat = WalCatalog(srcdir, self.log)
+
         # assume that postgres has processed the WAL file and is
         # asking for next - hence work not in progress anymore
         if os.path.isfile(prgrfile):
-            os.remove(prgrfile)
+            if cat:
+                cat.change(lambda: os.remove(prgrfile))
+            else:
+                os.remove(prgrfile)
 
-        # loop until srcfile or stopfile appears
+        # loop until srcfile or stopfile appears, watcher wakes
+        # us up when something changes in wal directories
+        watcher = DirWatcher([srcdir, partdir])
         while 1:
             if os.path.isfile(pausefile):
                 self.log.info("pause requested, sleeping")
-                time.sleep(20)
+                watcher.wait(20)
                 continue
 
             if os.path.isfile(srcfile):
@@ -1865,11 +3093,11 @@ STOP TIME: %(stop_time)s
 
             # nothing to do, sleep
             self.log.debug("%s: not found, sleeping", srcname)
-            time.sleep(1)
+            watcher.wait(1)
+        watcher.close()
 
         # got one, copy it
-        cmdline = ["cp", srcfile, dstpath]
-        self.exec_cmd(cmdline)
+        self.restore_wal_file(srcfile, dstpath)
 
         if self.cf.getint("keep_backups", 0) == 0:
             # cleanup only if we don't keep backup history, keep the files needed
@@ -1885,7 +3113,11 @@ STOP TIME: %(stop_time)s
             self.slave_cleanup(lstname)
 
         # create a PROGRESS file to notify that postgres is processing the WAL
-        open(prgrfile, "w").write("1")
+        if cat:
+            cat.change(lambda: open(prgrfile, "w").write("1"))
+            cat.close()
+        else:
+            open(prgrfile, "w").write("1")
 
         # it would be nice to have apply time too
         self.stat_add('count', 1)
@@ -2536,34 +3768,25 @@ STOP TIME: %(stop_time)s
         self.log.debug("cleaning done")
 
     def del_wals(self, path, last):
+        """Delete WAL segments older than last, in same timeline."""
         dot = last.find(".")
         if dot > 0:
             last = last[:dot]
-        list = os.listdir(path)
-        list.sort()
-        cur_last = None
-        n = len(list)
-        for i in range(n):
-            fname = list[i]
-            full = os.path.join(path, fname)
-            if fname[0] < "0" or fname[0] > "9":
-                continue
-            if not fname.startswith(last[0:8]):
-                # only look at WAL segments in a same timeline
-                continue
-
-            ok_del = 0
-            if fname < last:
-                self.log.debug("deleting %s", full)
-                if not self.not_really:
-                    try:
-                        os.remove(full)
-                    except:
-                        # don't report the errors if the file has been already removed
-                        # happens due to conflicts with pg_archivecleanup for instance.
-                        pass
-            cur_last = fname
-        return cur_last
+        cat = WalCatalog(path, self.log)
+        try:
+            cat.sync()
+
+            # only look at WAL segments in a same timeline
+            tli = last[0:8]
+            old = cat.range(tli, last)
+            if old:
+                cat.remove(old, self.not_really)
+            newer = cat.range(last, tli + "G")
+        finally:
+            cat.close()
+        if newer:
+            return newer[-1]
+        return old and old[-1] or None
 
 if __name__ == "__main__":
     script = WalMgr(sys.argv[1:])
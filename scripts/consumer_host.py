@@ -0,0 +1,355 @@
+#! /usr/bin/env python
+
+"""Run many consumers in one process.
+
+Reads a bunch of job config files, like scriptmgr, but instead of
+launching separate processes, loads the script classes and calls
+their work() in turn from single process.  Jobs that have nothing
+to do cost nothing, jobs with pgq_listen = 1 are woken up by tick
+notification.  Connections with same cache name and connect string
+are shared between jobs.
+
+Jobs must not keep transaction open between work() calls,
+otherwise share_connections must be disabled.
+
+Config template::
+
+    [consumer_host]
+    job_name = consumer_host_cphdb5
+    config_list = ~/random/conf/*.ini
+    logfile = ~/log/%(job_name)s.log
+    pidfile = ~/pid/%(job_name)s.pid
+
+    # max time to wait between checking jobs
+    #loop_delay = 1.0
+
+    # share connections between jobs
+    #share_connections = 1
+
+    # service descriptions: file to load and class to run
+
+    [queue_mover3]
+    script = /usr/bin/queue_mover3
+    class = QueueMover
+
+    [simple_consumer3]
+    script = /usr/bin/simple_consumer3
+    class = SimpleConsumer
+    #args = -v
+"""
+
+import sys, os, glob, time, select, imp, logging, ConfigParser
+
+import pkgloader
+pkgloader.require('skytools', '3.0')
+import skytools
+
+from skytools.scripting import DBCachedConn
+
+
+class SharedConn(DBCachedConn):
+    """Connection shared by several jobs.
+
+    Listens on union of channels of all jobs and keeps
+    received notifications separately for each job.
+    """
+
+    def __init__(self, name, loc, max_age, setup_func):
+        DBCachedConn.__init__(self, name, loc, max_age, setup_func = setup_func)
+        self.job_channels = {}
+        self.job_pending = {}
+
+    def get_job_connection(self, job_id, isolation_level, listen_channel_list):
+        self.job_channels[job_id] = listen_channel_list[:]
+        clist = []
+        for jclist in self.job_channels.values():
+            for ch in jclist:
+                if ch not in clist:
+                    clist.append(ch)
+        return self.get_connection(isolation_level, clist)
+
+    def drain_notifies(self):
+        if not self.conn:
+            return 0
+        self.conn.poll()
+        cnt = len(self.conn.notifies)
+        for n in self.conn.notifies:
+            for job_id, clist in self.job_channels.items():
+                if n[1] in clist:
+                    self.job_pending[job_id] = self.job_pending.get(job_id, 0) + 1
+        del self.conn.notifies[:]
+        return cnt
+
+    def take_job_notifies(self, job_id):
+        self.drain_notifies()
+        return self.job_pending.pop(job_id, 0)
+
+    def detach_job(self, job_id):
+        """Forget job state, connection stays open for other jobs.
+
+        Job may have failed in the middle of transaction,
+        so that is rolled back.
+        """
+        self.job_channels.pop(job_id, None)
+        self.job_pending.pop(job_id, None)
+        if not self.conn:
+            return
+        try:
+            self.conn.rollback()
+        except Exception:
+            # connection is unusable for everybody
+            self.reset()
+
+
+class JobConnRef(object):
+    """Per-job view to SharedConn, used instead of DBCachedConn in job."""
+
+    def __init__(self, pool, shared, job_id):
+        self.pool = pool
+        self.shared = shared
+        self.job_id = job_id
+
+    def get_connection(self, isolation_level = -1, listen_channel_list = []):
+        return self.shared.get_job_connection(self.job_id, isolation_level, listen_channel_list)
+
+    def fileno(self):
+        return self.shared.fileno()
+
+    def drain_notifies(self):
+        return self.shared.take_job_notifies(self.job_id)
+
+    def refresh(self):
+        self.shared.refresh()
+
+    def reset(self):
+        self.shared.detach_job(self.job_id)
+
+    def check_connstr(self, connstr):
+        if self.shared.loc != connstr:
+            self.shared.detach_job(self.job_id)
+            self.shared = self.pool.get_shared(self.shared.name, connstr,
+                        self.shared.max_age, self.shared.isolation_level,
+                        self.shared.setup_func)
+
+
+class ConnPool(object):
+    """Shared connections, keyed on cache name, connect string and isolation level.
+
+    Only same cache of different jobs is shared, separate caches
+    of one job always get separate sessions.
+    """
+
+    def __init__(self):
+        self.conn_map = {}
+
+    def get_shared(self, cache, connstr, max_age, isolation_level, setup_func):
+        key = (cache, connstr, isolation_level, setup_func)
+        shared = self.conn_map.get(key)
+        if shared is None:
+            shared = SharedConn(cache, connstr, max_age, setup_func)
+            shared.isolation_level = isolation_level
+            self.conn_map[key] = shared
+        return shared
+
+    def get_cached_conn(self, script, cache, connstr, max_age, isolation_level):
+        """Called from DBScript.get_database()."""
+        # connections with custom setup are not shared
+        setup_func = type(script).connection_hook.im_func
+        if setup_func is skytools.DBScript.connection_hook.im_func:
+            setup_func = None
+        else:
+            setup_func = script.connection_hook
+        shared = self.get_shared(cache, connstr, max_age, isolation_level, setup_func)
+        return JobConnRef(self, shared, id(script))
+
+    def reset(self):
+        for shared in self.conn_map.values():
+            shared.reset()
+        self.conn_map = {}
+
+
+class HostedJob(object):
+    """Script instance running in host."""
+
+    def __init__(self, script, cf_file):
+        self.script = script
+        self.cf_file = cf_file
+        self.next_run = 0
+        script.log = logging.getLogger(script.job_name)
+        # host does the waiting
+        script.sleep_on_exception = self.delay_on_exception
+
+    def delay_on_exception(self):
+        self.next_run = time.time() + self.script.exception_sleep
+
+    def check_wakeup(self):
+        """Wake up job if it got notification, returns fds to wait on."""
+        cnt, fdlist = self.script.check_listen()
+        if cnt:
+            self.next_run = 0
+        return fdlist
+
+    def run(self):
+        """Call work() once and schedule next run."""
+        script = self.script
+        if script.need_reload:
+            script.reload()
+            script.need_reload = 0
+
+        now = time.time()
+        state = script.run_once()
+        script.work_state = state
+        if state > 0:
+            self.next_run = now
+        elif state == 0:
+            self.next_run = now + script.loop_delay
+        return state
+
+
+class ConsumerHost(skytools.DBScript):
+    __doc__ = __doc__
+    job_list = []
+
+    def __init__(self, args):
+        skytools.DBScript.__init__(self, 'consumer_host', args)
+        self.job_list = []
+        self.job_pool = ConnPool()
+
+    def reload(self):
+        skytools.DBScript.reload(self)
+        self.share_connections = self.cf.getint('share_connections', 1)
+        for job in self.job_list:
+            job.script.need_reload = 1
+
+    def startup(self):
+        self.load_jobs()
+        for job in self.job_list[:]:
+            try:
+                job.script.startup()
+            except (Exception, SystemExit):
+                self.log.exception("%s: startup failed, skipping", job.script.job_name)
+                self.job_list.remove(job)
+
+        # jobs set their own signal handlers
+        skytools.DBScript.startup(self)
+
+    def load_jobs(self):
+        """Instantiate scripts for all configured jobs."""
+
+        svc_map = {}
+        for svc_name in self.cf.sections():
+            if svc_name == self.service_name:
+                continue
+            cf = self.cf.clone(svc_name)
+            svc_map[svc_name] = {
+                'script': cf.getfile('script'),
+                'class': cf.get('class'),
+                'args': cf.get('args', '').split(),
+            }
+
+        config_list = []
+        for tmp in self.cf.getlist('config_list'):
+            tmp = os.path.expanduser(tmp)
+            tmp = os.path.expandvars(tmp)
+            config_list.extend(glob.glob(tmp))
+
+        # scripts must not add their own log handlers
+        skytools.BaseScript.shared_logging = 1
+
+        for fn in config_list:
+            raw = ConfigParser.SafeConfigParser({'job_name':'?', 'service_name':'?'})
+            raw.read(fn)
+
+            # skip its own config
+            if raw.has_section(self.service_name):
+                continue
+
+            got = 0
+            for sect in raw.sections():
+                if sect in svc_map:
+                    got = 1
+                    self.add_job(fn, svc_map[sect])
+            if not got:
+                self.log.warning('Cannot find service for %s', fn)
+
+        self.log.info("Loaded %d jobs", len(self.job_list))
+
+    def add_job(self, cf_file, svc):
+        try:
+            mod_name = 'hosted_' + os.path.basename(svc['script']).replace('.', '_')
+            mod = sys.modules.get(mod_name)
+            if mod is None:
+                mod = imp.load_source(mod_name, svc['script'])
+            cls = getattr(mod, svc['class'])
+
+            args = svc['args'][:]
+            if self.options.verbose:
+                args.append('-' + 'v' * self.options.verbose)
+            args.append(cf_file)
+            script = cls(args)
+        except (Exception, SystemExit):
+            self.log.exception("Cannot load job from %s, skipping", cf_file)
+            return
+
+        if self.share_connections:
+            script.conn_pool = self.job_pool
+        self.job_list.append(HostedJob(script, cf_file))
+
+    def work(self):
+        """Run work() of each job that is due."""
+        more = 0
+        now = time.time()
+        for job in self.job_list[:]:
+            if job.next_run > now:
+                job.check_wakeup()
+                if job.next_run > now:
+                    continue
+            try:
+                if job.run() > 0:
+                    more = 1
+            except SystemExit:
+                if not self.looping:
+                    raise
+                self.log.error("%s: job exited, removing", job.script.job_name)
+                self.job_list.remove(job)
+                continue
+            if not job.script.looping:
+                self.log.info("%s: job stopped, removing", job.script.job_name)
+                self.job_list.remove(job)
+        if not self.job_list:
+            self.log.error("No jobs left, exiting")
+            sys.exit(1)
+        return more
+
+    def sleep(self, secs):
+        """Wait until some job is due or gets notification."""
+        fdlist = []
+        for job in self.job_list:
+            for fd in job.check_wakeup():
+                if fd not in fdlist:
+                    fdlist.append(fd)
+
+        now = time.time()
+        for job in self.job_list:
+            secs = min(secs, job.next_run - now)
+        if secs <= 0:
+            return
+        if not fdlist:
+            return skytools.BaseScript.sleep(self, secs)
+        try:
+            select.select(fdlist, [], [], secs)
+        except select.error, d:
+            self.log.info('wait canceled')
+
+    def shutdown(self):
+        for job in self.job_list:
+            try:
+                job.script.shutdown()
+            except (Exception, SystemExit):
+                self.log.exception("%s: shutdown failed", job.script.job_name)
+        self.job_pool.reset()
+        skytools.DBScript.shutdown(self)
+
+if __name__ == '__main__':
+    script = ConsumerHost(sys.argv[1:])
+    script.start()
@@ -28,11 +28,9 @@ class QueueMover(pgq.SerialConsumer):
 
     def process_remote_batch(self, db, batch_id, ev_list, dst_db):
 
-        # load data
-        rows = []
-        for ev in ev_list:
-            data = [ev.type, ev.data, ev.extra1, ev.extra2, ev.extra3, ev.extra4, ev.time]
-            rows.append(data)
+        # rows are streamed to COPY
+        rows = ([ev.type, ev.data, ev.extra1, ev.extra2, ev.extra3, ev.extra4, ev.time]
+                for ev in ev_list)
         fields = ['type', 'data', 'extra1', 'extra2', 'extra3', 'extra4', 'time']
 
         # insert data
@@ -34,6 +34,7 @@ ac_ver = m.group(1)
 sfx_scripts = [
     'python/londiste.py',
     'python/walmgr.py',
+    'scripts/consumer_host.py',
     'scripts/data_maintainer.py',
     'scripts/queue_mover.py',
     'scripts/queue_splitter.py',
@@ -0,0 +1,73 @@
+create or replace function pgq.event_retry_list(
+    i_batch_id bigint,
+    i_event_ids bigint[],
+    i_retry_seconds integer[])
+returns integer as $$
+-- ----------------------------------------------------------------------
+-- Function: pgq.event_retry_list(3)
+--
+--     Put list of events into retry queue, to be processed again later.
+--
+--     Set-based version of pgq.event_retry(3b), tags
+--     all given events with single call.
+--
+-- Parameters:
+--      i_batch_id      - ID of active batch.
+--      i_event_ids     - array of event ids
+--      i_retry_seconds - array of retry delays in seconds,
+--                        one for each event id
+--
+-- Returns:
+--     number of events inserted.  Raises exception if some of the
+--     events are not in batch or already in retry queue.
+-- Calls:
+--      None
+-- Tables directly manipulated:
+--      insert - pgq.retry_queue
+-- ----------------------------------------------------------------------
+declare
+    _cnt   integer;
+    _total integer;
+    _s     record;
+begin
+    if coalesce(array_upper(i_event_ids, 1), 0) <> coalesce(array_upper(i_retry_seconds, 1), 0) then
+        raise exception 'event_retry_list: array lengths do not match';
+    end if;
+
+    select * into _s from pgq.subscription where sub_batch = i_batch_id;
+    if not found then
+        raise exception 'event_retry_list: batch % not found', i_batch_id;
+    end if;
+
+    select count(distinct i_event_ids[i]) into _total
+      from generate_series(1, array_upper(i_event_ids, 1)) i;
+
+    insert into pgq.retry_queue (ev_retry_after, ev_queue,
+        ev_id, ev_time, ev_txid, ev_owner, ev_retry,
+        ev_type, ev_data, ev_extra1, ev_extra2,
+        ev_extra3, ev_extra4)
+    select distinct on (b.ev_id)
+           current_timestamp + ((r.retry_seconds::text || ' seconds')::interval),
+           _s.sub_queue,
+           b.ev_id, b.ev_time, NULL::int8, _s.sub_id, coalesce(b.ev_retry, 0) + 1,
+           b.ev_type, b.ev_data, b.ev_extra1, b.ev_extra2,
+           b.ev_extra3, b.ev_extra4
+      from pgq.get_batch_events(i_batch_id) b
+           join (select i_event_ids[i] as ev_id, i_retry_seconds[i] as retry_seconds
+                   from generate_series(1, array_upper(i_event_ids, 1)) i) r
+                  on (r.ev_id = b.ev_id)
+           left join pgq.retry_queue rq
+                  on (rq.ev_id = b.ev_id
+                      and rq.ev_owner = _s.sub_id
+                      and rq.ev_queue = _s.sub_queue)
+      where rq.ev_id is null;
+
+    GET DIAGNOSTICS _cnt = ROW_COUNT;
+    if _cnt <> _total then
+        raise exception 'event_retry_list: % of % events not in batch or already in retry queue',
+                        _total - _cnt, _total;
+    end if;
+    return _cnt;
+end;
+$$ language plpgsql security definer;
+
@@ -5,6 +5,8 @@ returns bigint as $$
 --
 --     External ticker: Insert a tick with a particular tick_id and timestamp.
 --
+--     Sends notification on channel "pgq.<queue_name>".
+--
 -- Parameters:
 --     i_queue_name     - Name of the queue
 --     i_tick_id        - Id of new tick.
@@ -29,6 +31,9 @@ begin
         from pgq.queue
         where queue_name = i_queue_name;
 
+    -- wake up listening consumers
+    execute 'notify ' || quote_ident('pgq.' || i_queue_name);
+
     return i_tick_id;
 end;
 $$ language plpgsql security definer; -- unsure about access
@@ -43,6 +48,8 @@ returns bigint as $$
 --
 --     For pgqadm usage.
 --
+--     Sends notification on channel "pgq.<queue_name>" if tick was done.
+--
 -- Parameters:
 --     i_queue_name     - Name of the queue
 --
@@ -131,6 +138,9 @@ begin
     insert into pgq.tick (tick_queue, tick_id, tick_event_seq)
         values (q.queue_id, nextval(q.queue_tick_seq), q.event_seq);
 
+    -- wake up listening consumers
+    execute 'notify ' || quote_ident('pgq.' || i_queue_name);
+
     return currval(q.queue_tick_seq);
 end;
 $$ language plpgsql security definer; -- unsure about access
@@ -68,6 +68,38 @@ select pgq.event_retry(3, 2, 0);
 select pgq.batch_retry(3, 0);
 select pgq.finish_batch(3);
 
+-- test retry list on fresh batch
+select pgq.create_queue('retryqueue');
+update pgq.queue set queue_ticker_max_lag = '0', queue_ticker_idle_period = '0'
+    where queue_name = 'retryqueue';
+select pgq.register_consumer('retryqueue', 'consumer');
+select pgq.insert_event('retryqueue', 'r1', 'data1');
+select pgq.insert_event('retryqueue', 'r2', 'data2');
+select pgq.insert_event('retryqueue', 'r3', 'data3');
+select pgq.ticker('retryqueue') is not null as ticked;
+select pgq.next_batch('retryqueue', 'consumer') is not null as got_batch;
+select pgq.event_retry_list(s.sub_batch, array[1, 3], array[0, 60])
+    from pgq.subscription s, pgq.queue q
+    where s.sub_queue = q.queue_id and q.queue_name = 'retryqueue';
+select rq.ev_id, rq.ev_retry, rq.ev_type, rq.ev_data,
+       rq.ev_retry_after > now() + '30 seconds' as delayed
+    from pgq.retry_queue rq, pgq.queue q
+    where rq.ev_queue = q.queue_id and q.queue_name = 'retryqueue'
+    order by 1;
+select pgq.event_retry_list(s.sub_batch, array[2, 3], array[0, 0])
+    from pgq.subscription s, pgq.queue q
+    where s.sub_queue = q.queue_id and q.queue_name = 'retryqueue';
+select pgq.event_retry_list(s.sub_batch, array[2, 99], array[0, 0])
+    from pgq.subscription s, pgq.queue q
+    where s.sub_queue = q.queue_id and q.queue_name = 'retryqueue';
+select count(*) from pgq.retry_queue rq, pgq.queue q
+    where rq.ev_queue = q.queue_id and q.queue_name = 'retryqueue';
+select pgq.finish_batch(s.sub_batch)
+    from pgq.subscription s, pgq.queue q
+    where s.sub_queue = q.queue_id and q.queue_name = 'retryqueue';
+select pgq.unregister_consumer('retryqueue', 'consumer');
+select pgq.drop_queue('retryqueue');
+
 select pgq.event_retry_raw('myqueue', 'consumer', now(), 666, now(), 0,
         'rawtest', 'data', null, null, null, null);
 
@@ -58,6 +58,7 @@
 \i functions/pgq.get_batch_events.sql
 \i functions/pgq.get_batch_cursor.sql
 \i functions/pgq.event_retry.sql
+\i functions/pgq.event_retry_list.sql
 \i functions/pgq.batch_retry.sql
 \i functions/pgq.finish_batch.sql
 
@@ -0,0 +1,98 @@
+#! /bin/bash
+
+. ../testlib.sh
+
+../zstop.sh
+
+v='-q'
+v=''
+
+db_list="db1 db2 db3"
+
+kdb_list=`echo $db_list | sed 's/ /,/g'`
+
+title Parallel copy test
+
+# create ticker conf
+cat > conf/pgqd.ini <<EOF
+[pgqd]
+database_list = $kdb_list
+logfile = log/pgqd.log
+pidfile = pid/pgqd.pid
+EOF
+
+# londiste3 configs
+for db in $db_list; do
+cat > conf/londiste_$db.ini <<EOF
+[londiste3]
+job_name = londiste_$db
+db = dbname=$db
+queue_name = replika
+logfile = log/%(job_name)s.log
+pidfile = pid/%(job_name)s.pid
+
+pgq_autocommit = 1
+pgq_lazy_fetch = 0
+copy_workers = 4
+EOF
+done
+
+for db in $db_list; do
+  cleardb $db
+done
+
+clearlogs
+
+set -e
+
+msg "Install londiste3 and initialize nodes"
+run londiste3 $v conf/londiste_db1.ini create-root node1 'dbname=db1'
+run londiste3 $v conf/londiste_db2.ini create-branch node2 'dbname=db2' --provider='dbname=db1'
+run londiste3 $v conf/londiste_db3.ini create-leaf node3 'dbname=db3' --provider='dbname=db2'
+
+msg "Run ticker"
+run pgqd $v -d conf/pgqd.ini
+run sleep 5
+
+msg "Run londiste3 daemon for each node"
+for db in $db_list; do
+  run psql -d $db -c "update pgq.queue set queue_ticker_idle_period='2 secs'" || true
+  run londiste3 $v -d conf/londiste_$db.ini worker
+done
+
+msg "Create table on root node and fill it"
+run psql -d db1 -c "create table mytable (id int4 primary key, data text)"
+run psql -d db1 -c "insert into mytable select i, 'row' || i from generate_series(1, 10000) i"
+run londiste3 $v conf/londiste_db1.ini add-table mytable
+
+msg "Create table on other nodes, record replication role of copy connections"
+for db in db2 db3; do
+  run psql -d $db -c "create table mytable (id int4 primary key, data text)"
+  run psql -d $db -c "create table copy_role (role text)"
+  run psql -d $db -c "create function copy_role_trg() returns trigger as \$\$
+      begin
+        insert into copy_role values (current_setting('session_replication_role'));
+        return null;
+      end; \$\$ language plpgsql"
+  run psql -d $db -c "create trigger copy_role_trg after insert on mytable
+      for each row execute procedure copy_role_trg()"
+  run psql -d $db -c "alter table mytable enable always trigger copy_role_trg"
+done
+
+msg "Copy table with parallel workers"
+run londiste3 $v conf/londiste_db2.ini add-table mytable
+run londiste3 $v conf/londiste_db3.ini add-table mytable
+run londiste3 conf/londiste_db3.ini wait-sync
+
+msg "Check that all rows were copied in replica role"
+for db in db2 db3; do
+  run_sql $db "select role, count(*) from copy_role group by 1"
+  cnt=`psql -A -t -d $db -c "select count(*) from copy_role where role <> 'replica'"`
+  test "$cnt" = "0"
+  cnt=`psql -A -t -d $db -c "select count(*) from mytable"`
+  test "$cnt" = "10000"
+done
+
+run londiste3 conf/londiste_db3.ini compare
+
+../zcheck.sh
@@ -0,0 +1,134 @@
+#! /usr/bin/env python
+
+"""Tests for londiste parallel apply: prepare, commit and recovery
+of worker transactions, without database."""
+
+import sys, os, logging
+
+src = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(src, '../../python'))
+from londiste.playback import Replicator, ApplyWorker
+
+bad = 0
+def check(name, res, exp):
+    global bad
+    if res != exp:
+        print("failure: %s = %s (expected %s)" % (name, repr(res), repr(exp)))
+        bad += 1
+
+class FakeCursor:
+    def __init__(self, db):
+        self.db = db
+    def execute(self, q, args = None):
+        self.db.log.append(('execute', q))
+    def fetchall(self):
+        return [(gid,) for gid in self.db.prepared]
+
+class FakeDB:
+    def __init__(self):
+        self.log = []
+        self.prepared = []
+    def cursor(self):
+        return FakeCursor(self)
+    def commit(self):
+        pass
+    def tpc_begin(self, gid):
+        self.log.append(('begin', gid))
+    def tpc_prepare(self):
+        self.log.append(('prepare',))
+    def tpc_commit(self, gid = None):
+        self.log.append(('commit', gid))
+    def tpc_rollback(self, gid = None):
+        self.log.append(('rollback', gid))
+
+class FakeHandler:
+    def __init__(self, fail = False):
+        self.fail = fail
+    def prepare_batch(self, batch_info, curs):
+        pass
+    def finish_batch(self, batch_info, curs):
+        pass
+    def process_event(self, ev, sql_queue_func, arg):
+        if self.fail:
+            raise ValueError('apply failed')
+        sql_queue_func('insert ...', arg)
+
+def mkrepl(nworkers):
+    repl = Replicator.__new__(Replicator)
+    repl.log = logging.getLogger('apply-test')
+    repl.queue_name = 'replika'
+    repl.consumer_name = 'node2'
+    repl.apply_workers = nworkers
+    repl.pgq_lazy_fetch = 0
+    repl.cur_tick = 100
+    repl.batch_info = {}
+    repl.apply_prepared = []
+    repl.closed = []
+    repl.db_map = {}
+    def get_database(dbname, cache = None):
+        return repl.db_map.setdefault(cache, FakeDB())
+    repl.get_database = get_database
+    repl.close_database = repl.closed.append
+    repl.apply_worker_list = [ApplyWorker(repl, i) for i in range(nworkers)]
+    return repl
+
+# successful batch: all workers prepare, commit after main transaction
+repl = mkrepl(3)
+repl.apply_worker_list[0].add_row(FakeHandler(), 'ev1')
+repl.apply_worker_list[2].add_row(FakeHandler(), 'ev2')
+repl.run_apply_workers()
+db0 = repl.db_map['db_apply_0']
+db2 = repl.db_map['db_apply_2']
+check('run/idle', 'db_apply_1' in repl.db_map, False)
+check('run/gid', db0.log[0], ('begin', 'londiste:replika:node2:100:0'))
+check('run/prepared', db2.log[-1], ('prepare',))
+check('run/pending', len(repl.apply_prepared), 2)
+repl.commit_apply_workers()
+check('commit/db0', db0.log[-1], ('commit', None))
+check('commit/db2', db2.log[-1], ('commit', None))
+check('commit/recover', repl.apply_recover_needed, False)
+
+# failing worker: all are rolled back, error is raised
+repl = mkrepl(2)
+repl.apply_worker_list[0].add_row(FakeHandler(), 'ev1')
+repl.apply_worker_list[1].add_row(FakeHandler(True), 'ev2')
+try:
+    repl.run_apply_workers()
+    check('fail/raised', None, ValueError)
+except ValueError:
+    pass
+check('fail/rollback0', repl.db_map['db_apply_0'].log[-1], ('rollback', None))
+check('fail/rollback1', repl.db_map['db_apply_1'].log[-1], ('rollback', None))
+check('fail/nothing_pending', repl.apply_prepared, [])
+check('fail/recover', repl.apply_recover_needed, True)
+check('fail/reset', [len(w.row_list) for w in repl.apply_worker_list], [0, 0])
+
+# recovery: ticks up to completed one are committed, later rolled back
+repl = mkrepl(2)
+repl._consumer_state = {'completed_tick': 100}
+db = FakeDB()
+db.prepared = ['londiste:replika:node2:99:0', 'londiste:replika:node2:100:1',
+               'londiste:replika:node2:101:0', 'londiste:replika:node2:20:1',
+               'londiste:replika:node2:1000:0']
+repl.db_map['db_apply_0'] = db
+repl.recover_apply_workers()
+res = [x for x in db.log if x[0] != 'execute']
+check('recover/actions', res, [
+    ('commit', 'londiste:replika:node2:99:0'),
+    ('commit', 'londiste:replika:node2:100:1'),
+    ('rollback', 'londiste:replika:node2:101:0'),
+    ('commit', 'londiste:replika:node2:20:1'),
+    ('rollback', 'londiste:replika:node2:1000:0')])
+check('recover/done', repl.apply_recover_needed, False)
+check('recover/keep_conn', repl.closed, [])
+
+# serial apply does not need recovery connection afterwards
+repl = mkrepl(1)
+repl._consumer_state = {'completed_tick': 5}
+repl.recover_apply_workers()
+check('recover/serial_close', repl.closed, ['db_apply_0'])
+
+if bad:
+    print("%-20s: failed" % 'ApplyWorkers')
+    sys.exit(1)
+print("%-20s: OK" % 'ApplyWorkers')
@@ -0,0 +1,116 @@
+#! /usr/bin/env python
+
+"""Tests for connection sharing in scripts/consumer_host.py, without database."""
+
+import sys, os, imp
+
+src = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(src, '../../python'))
+import skytools
+consumer_host = imp.load_source('consumer_host', os.path.join(src, '../../scripts/consumer_host.py'))
+
+bad = 0
+def check(name, res, exp):
+    global bad
+    if res != exp:
+        print("failure: %s = %s (expected %s)" % (name, repr(res), repr(exp)))
+        bad += 1
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+    def execute(self, q, args = None):
+        self.conn.queries.append(q)
+
+class FakeConn:
+    fail_rollback = False
+    def __init__(self, connstr):
+        self.connstr = connstr
+        self.queries = []
+        self.notifies = []
+        self.rollbacks = 0
+        self.closed = 0
+    def cursor(self):
+        return FakeCursor(self)
+    def set_isolation_level(self, lev):
+        self.isolation_level = lev
+    def commit(self):
+        pass
+    def rollback(self):
+        if self.fail_rollback:
+            raise Exception('connection lost')
+        self.rollbacks += 1
+    def poll(self):
+        pass
+    def close(self):
+        self.closed = 1
+
+conn_list = []
+def fake_connect(connstr):
+    conn = FakeConn(connstr)
+    conn_list.append(conn)
+    return conn
+skytools.connect_database = fake_connect
+
+class PlainJob(skytools.DBScript):
+    pass
+
+class HookJob(skytools.DBScript):
+    def connection_hook(self, dbname, conn):
+        pass
+
+pool = consumer_host.ConnPool()
+job1 = PlainJob.__new__(PlainJob)
+job2 = PlainJob.__new__(PlainJob)
+job3 = HookJob.__new__(HookJob)
+
+# same cache, connstr and isolation level is shared
+r1 = pool.get_cached_conn(job1, 'db', 'dbname=x', 0, 1)
+r2 = pool.get_cached_conn(job2, 'db', 'dbname=x', 0, 1)
+check('share/same', r1.shared is r2.shared, True)
+check('share/other_cache', pool.get_cached_conn(job1, 'db2', 'dbname=x', 0, 1).shared is r1.shared, False)
+check('share/other_connstr', pool.get_cached_conn(job1, 'db', 'dbname=y', 0, 1).shared is r1.shared, False)
+check('share/other_isolation', pool.get_cached_conn(job1, 'db', 'dbname=x', 0, 0).shared is r1.shared, False)
+
+# connection_hook makes connection private to job
+r3 = pool.get_cached_conn(job3, 'db', 'dbname=x', 0, 1)
+check('share/hook', r3.shared is r1.shared, False)
+
+# one connection listens on channels of both jobs
+c1 = r1.get_connection(1, ['ch_a'])
+c2 = r2.get_connection(1, ['ch_b'])
+check('listen/conn', c1 is c2, True)
+check('listen/queries', c1.queries, ['LISTEN ch_a', 'LISTEN ch_b'])
+
+# notifications are routed to jobs listening on them
+c1.notifies.extend([(1, 'ch_a'), (1, 'ch_a'), (1, 'ch_b')])
+check('notify/job1', r1.drain_notifies(), 2)
+check('notify/job2', r2.drain_notifies(), 1)
+check('notify/again', r1.drain_notifies(), 0)
+
+# job reset rolls back, but keeps connection for others
+r1.reset()
+check('reset/rollback', c1.rollbacks, 1)
+check('reset/open', r2.shared.conn is c1, True)
+c1.notifies.append((1, 'ch_a'))
+check('reset/no_notify', r2.drain_notifies(), 0)
+
+# broken connection is dropped for everybody
+c1.fail_rollback = True
+r2.reset()
+check('broken/closed', c1.closed, 1)
+check('broken/dropped', r1.shared.conn, None)
+check('broken/new', r2.get_connection(1, ['ch_b']) is c1, False)
+
+# changed connect string moves job to other shared connection
+r2.check_connstr('dbname=z')
+check('connstr/moved', r2.shared is r1.shared, False)
+check('connstr/loc', r2.shared.loc, 'dbname=z')
+
+pool.reset()
+check('pool/reset', pool.conn_map, {})
+
+if bad:
+    print("%-20s: failed" % 'ConsumerHost')
+    sys.exit(1)
+print("%-20s: OK" % 'ConsumerHost')
@@ -0,0 +1,123 @@
+#! /usr/bin/env python
+
+"""Tests for pgq.ParallelConsumer, without database."""
+
+import sys, os, time, random, tempfile, threading
+
+src = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(src, '../../python'))
+
+import pgq
+from pgq.consumer import EV_RETRY
+
+bad = 0
+def check(name, res, exp):
+    global bad
+    if res != exp:
+        print("failure: %s = %s (expected %s)" % (name, repr(res), repr(exp)))
+        bad += 1
+
+class FakeCursor:
+    def __init__(self):
+        self.queries = []
+    def execute(self, q, args = None):
+        self.queries.append((q, args))
+
+class TestConsumer(pgq.ParallelConsumer):
+    fail_id = None
+    def process_event(self, db, ev):
+        # let other workers overtake
+        time.sleep(random.random() * 0.002)
+        if ev.id == self.fail_id:
+            raise ValueError("event %d failed" % ev.id)
+        if ev.id % 5 == 0:
+            ev.tag_retry(30)
+        self.lock.acquire()
+        try:
+            self.done.append((ev.extra1, ev.id, threading.currentThread().getName()))
+        finally:
+            self.lock.release()
+
+def mkbatch(c, first, n, nkeys = 4):
+    res = []
+    for i in range(first, first + n):
+        row = {'ev_id': i, 'ev_time': None, 'ev_txid': i, 'ev_retry': None,
+               'ev_type': 'test', 'ev_data': 'id=%d' % i,
+               'ev_extra1': 'key%d' % (i % nkeys), 'ev_extra2': None,
+               'ev_extra3': None, 'ev_extra4': None}
+        res.append(c._make_event('testq', row))
+    return res
+
+tmp = tempfile.mkdtemp()
+cf_file = os.path.join(tmp, 'test.ini')
+open(cf_file, 'w').write("""
+[parallel_test]
+job_name = parallel_test
+db = dbname=unused
+queue_name = testq
+logfile = %s/test.log
+pidfile = %s/test.pid
+parallel_workers = 3
+parallel_key = ev_extra1
+pgq_lazy_fetch = 0
+pgq_bulk_retry = 0
+""" % (tmp, tmp))
+
+c = TestConsumer('parallel_test', 'db', [cf_file])
+c.lock = threading.Lock()
+try:
+    # per-key ordering
+    c.done = []
+    batch = mkbatch(c, 1, 200)
+    c.process_batch(None, 1, batch)
+    check('order/count', len(c.done), 200)
+    for key in ('key0', 'key1', 'key2', 'key3'):
+        ids = [ev_id for k, ev_id, th in c.done if k == key]
+        xids = ids[:]
+        xids.sort()
+        check('order/' + key, ids, xids)
+        check('order/%s/threads' % key, len(dict.fromkeys([th for k, ev_id, th in c.done if k == key])), 1)
+    check('order/threads', len(dict.fromkeys([th for k, ev_id, th in c.done])) > 1, True)
+
+    # retry tags set in workers reach retry tagging
+    curs = FakeCursor()
+    c._flush_retry(curs, 1, batch)
+    retried = [args[1] for q, args in curs.queries if 'pgq.event_retry(' in q]
+    retried.sort()
+    check('retry/ids', retried, range(5, 201, 5))
+    check('retry/time', dict.fromkeys([args[2] for q, args in curs.queries]).keys(), [30])
+
+    # worker exception is raised from process_batch, so batch is not finished
+    c.done = []
+    c.fail_id = 250
+    try:
+        c.process_batch(None, 2, mkbatch(c, 201, 100))
+        check('error/raised', None, ValueError)
+    except ValueError, d:
+        check('error/msg', str(d), 'event 250 failed')
+    check('error/failed_not_done', [x for x in c.done if x[1] == 250], [])
+    check('error/pending', c._pending, 0)
+
+    # next batch works normally
+    c.done = []
+    c.fail_id = None
+    c.process_batch(None, 3, mkbatch(c, 301, 50))
+    check('after_error/count', len(c.done), 50)
+
+    # without parallel_key, events are spread over shared queue
+    c._stop_workers()
+    c.parallel_key = ''
+    c.done = []
+    c.process_batch(None, 4, mkbatch(c, 401, 50))
+    check('nokey/count', len(c.done), 50)
+    check('nokey/queues', len(c._worker_queues), 1)
+finally:
+    c._stop_workers()
+    for fn in os.listdir(tmp):
+        os.remove(os.path.join(tmp, fn))
+    os.rmdir(tmp)
+
+if bad:
+    print("%-20s: failed" % 'ParallelConsumer')
+    sys.exit(1)
+print("%-20s: OK" % 'ParallelConsumer')
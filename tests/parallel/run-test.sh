@@ -0,0 +1,11 @@
+#! /bin/sh
+
+# consumer and apply tests that do not need database
+
+set -e
+
+cd `dirname $0`
+
+python parallelconsumer-test.py
+python consumer-host-test.py
+python apply-workers-test.py
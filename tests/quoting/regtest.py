@@ -94,6 +94,15 @@ t_urldec = [
 regtest("db_urldecode/c", skytools._cquoting.db_urldecode, t_urldec)
 regtest("db_urldecode/py", skytools._pyquoting.db_urldecode, t_urldec)
 
+t_urldec_batch = [
+    [[], ([], [])],
+    [["a=b&c", "c=d", "&&b=%45"], (['a', 'c', 'b'], [['b', None, None], [None, 'd', None], [None, None, 'E']])],
+    [["a=1&b=2", "b=3&a=4", "a=5&a=6"], (['a', 'b'], [['1', '4', '6'], ['2', '3', None]])],
+    [[u"abc=qwe", "abc="], (['abc'], [['qwe', '']])],
+]
+regtest("db_urldecode_batch/c", skytools._cquoting.db_urldecode_batch, t_urldec_batch)
+regtest("db_urldecode_batch/py", skytools._pyquoting.db_urldecode_batch, t_urldec_batch)
+
 t_unesc = [
     ["", ""],
     ["\\N", "N"],
@@ -0,0 +1,174 @@
+#! /usr/bin/env python
+
+"""Tests for WalCatalog in walmgr.py."""
+
+import sys, os, imp, shutil, tempfile, logging
+
+src = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(src, '../../python'))
+walmgr = imp.load_source('walmgr', os.path.join(src, '../../python/walmgr.py'))
+
+class LogCapture(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.msgs = []
+    def emit(self, rec):
+        self.msgs.append(rec.getMessage())
+
+log = logging.getLogger('catalog-test')
+log.setLevel(logging.DEBUG)
+cap = LogCapture()
+log.addHandler(cap)
+
+bad = 0
+def check(name, res, exp):
+    global bad
+    if res != exp:
+        print("failure: %s = %s (expected %s)" % (name, repr(res), repr(exp)))
+        bad += 1
+
+def rescans():
+    n = len([m for m in cap.msgs if m.endswith('rescanning')])
+    del cap.msgs[:]
+    return n
+
+def touch(fn, data = 'x'):
+    open(os.path.join(tmp, fn), 'w').write(data)
+
+def seg(n, tli = 1):
+    return '%08X%08X%08X' % (tli, 0, n)
+
+def read_rec(fn):
+    for ln in open(os.path.join(tmp, '.walcatalog')):
+        t = ln.split()
+        if t[0] == fn:
+            return t
+    return None
+
+class NoWatcher:
+    """DirWatcher without inotify."""
+    fd = None
+    def close(self):
+        pass
+
+tmp = tempfile.mkdtemp()
+try:
+    for i in (3, 1, 2, 5):
+        touch(seg(i))
+    touch(seg(4, 2))
+    touch(seg(2) + '.00000028.backup')
+    touch('PROGRESS')
+
+    cat = walmgr.WalCatalog(tmp, log)
+
+    # sync: first call lists directory, non-WAL files are skipped
+    cat.sync()
+    check('sync/rescan', rescans(), 1)
+    check('sync/all', cat.range('0', 'G'),
+          [seg(1), seg(2), seg(2) + '.00000028.backup', seg(3), seg(5), seg(4, 2)])
+
+    # records have size and timeline
+    check('rec/fields', read_rec(seg(4, 2))[1:3], ['1', '00000002'])
+
+    # range: same timeline, start inclusive, end exclusive
+    check('range/tli', cat.range('00000001', seg(3)),
+          [seg(1), seg(2), seg(2) + '.00000028.backup'])
+    check('range/empty', cat.range(seg(6), '00000001G'), [])
+
+    # remove: files and records are gone
+    cat.remove(cat.range('00000001', seg(3)))
+    check('remove/files', os.path.exists(os.path.join(tmp, seg(1))), False)
+    check('remove/range', cat.range('0', 'G'), [seg(3), seg(5), seg(4, 2)])
+
+    # not_really keeps everything
+    cat.remove([seg(3)], True)
+    check('remove/not_really', cat.range('0', 'G'), [seg(3), seg(5), seg(4, 2)])
+
+    # files written by other processes cause rescan
+    touch(seg(6))
+    cat.sync()
+    check('external/rescan', rescans(), 1)
+    check('external/range', cat.range(seg(5), '00000001G'), [seg(5), seg(6)])
+
+    # out-of-order add goes to right place
+    cat.add(seg(4), lambda: touch(seg(4)), None)
+    check('add/range', cat.range('00000001', '00000001G'), [seg(3), seg(4), seg(5), seg(6)])
+
+    # new catalog instance sees same data
+    cat2 = walmgr.WalCatalog(tmp, log)
+    check('reload/range', cat2.range('0', 'G'), [seg(3), seg(4), seg(5), seg(6), seg(4, 2)])
+    cat2.close()
+
+    if cat.start_watch():
+        # own changes and control files do not cause rescan
+        cat.sync()
+        rescans()
+        cat.add(seg(7), lambda: touch(seg(7)), None)
+        cat.change(lambda: os.remove(os.path.join(tmp, 'PROGRESS')))
+        cat.remove([seg(3)])
+        cat.sync()
+        check('own/rescan', rescans(), 0)
+
+        # WAL file written by other process during own change is noticed
+        def race():
+            touch(seg(8))
+            touch(seg(9))
+        cat.add(seg(8), race, None)
+        cat.sync()
+        check('race/rescan', rescans(), 1)
+        check('race/range', cat.range(seg(8), '00000001G'), [seg(8), seg(9)])
+
+        # mtime is recorded after rescan
+        cat.sync()
+        check('rescan/again', rescans(), 0)
+
+        # non-WAL file written by other process during own change is ignored
+        cat.change(lambda: touch('PAUSE'))
+        cat.sync()
+        check('nonwal/rescan', rescans(), 0)
+
+        # file removed by other process is noticed
+        os.remove(os.path.join(tmp, seg(9)))
+        cat.sync()
+        check('extremove/rescan', rescans(), 1)
+        check('extremove/range', cat.range(seg(8), '00000001G'), [seg(8)])
+
+        # lost inotify events cause rescan
+        real_read = cat.watcher.read_names
+        cat.watcher.read_names = lambda: None
+        cat.add(seg(9), lambda: touch(seg(9)), None)
+        cat.watcher.read_names = real_read
+        cat.sync()
+        check('lost/rescan', rescans(), 1)
+        check('lost/range', cat.range(seg(8), '00000001G'), [seg(8), seg(9)])
+    else:
+        print("inotify not available, skipping mtime tests")
+
+    # without inotify, mtime cannot be trusted after changes
+    cat3 = walmgr.WalCatalog(tmp, log)
+    cat3.watcher = NoWatcher()
+    cat3.sync()
+    rescans()
+    cat3.add(seg(10), lambda: touch(seg(10)), None)
+    check('nowatch/range', seg(10) in cat3.range('0', 'G'), True)
+    cat3.sync()
+    cat3.sync()
+    check('nowatch/rescan', rescans(), 2)
+    cat3.close()
+
+    # damaged catalog is rebuilt
+    names = cat.range('0', 'G')
+    f = open(os.path.join(tmp, '.walcatalog'), 'a')
+    f.write('garbage')
+    f.close()
+    cat.sync()
+    check('damaged/range', cat.range('0', 'G'), names)
+    check('damaged/rescan', rescans(), 1)
+    cat.close()
+finally:
+    shutil.rmtree(tmp)
+
+if bad:
+    print("%-20s: failed" % 'WalCatalog')
+    sys.exit(1)
+print("%-20s: OK" % 'WalCatalog')
@@ -8,6 +8,9 @@ tmp=/tmp/waltest
 src=$PWD
 walmgr=$src/../../python/walmgr.py
 
+echo '####' catalog-test.py
+python $src/catalog-test.py
+
 test -f $tmp/data.master/postmaster.pid \
 && kill `head -1 $tmp/data.master/postmaster.pid` || true
 test -f $tmp/data.slave/postmaster.pid \